@@ -1,12 +1,31 @@
+import argparse
 from datetime import date
+import os
 
+import pandas as pd
+
+import accounts
+import analytics
+import compact
+import coverage
+import daemon
+import dashboard
+import export
+import forecast
+import jobs
+import ledger
+import metrics
 import plot
+import reconcile
+import rollups
+import scheduler
+import server
 import utils
 from e_redes import consumption_history
+import energy_meters.shelly as shelly
 from erse import losses_profiles
 from omie import energy_prices
-from providers import repsol
-import shelly.shelly as shelly
+from providers import repsol, tariffs
 
 
 def download_consumption_history(debug: bool = False) -> None:
@@ -36,12 +55,15 @@ def update_losses(debug: bool = False) -> None:
     losses_profiles.update_losses_profiles()
 
 
-def update_prices(debug: bool = False) -> None:
+def update_prices(pack_prices: bool = False, debug: bool = False) -> None:
     """
     Update the energy prices from the OMIE and REPSOL modules.
+    If `pack_prices` is set, pack the OMIE files of closed months into monthly archives.
     """
     energy_prices.update_prices()
     repsol.update_prices()
+    if pack_prices:
+        energy_prices.pack_prices(debug=debug)
 
 
 def main(
@@ -49,41 +71,316 @@ def main(
     _update_prices: bool = True,
     _update_shelly: bool = True,
     _update_losses: bool = False,
+    pack_prices: bool = False,
+    _export: bool = False,
+    _dashboard: bool = False,
     override: bool = False,
     start_date: str = None,
+    window_days: int = 7,
+    window_start: str = None,
+    window_end: str = None,
+    show: bool = False,
     debug: bool = False,
 ) -> None:
     """
     Main function that orchestrates the download and processing of consumption history,
     updating of losses profiles and prices, and plotting of Repsol prices.
     """
-    if _update_losses:
-        update_losses(debug=debug)
+    # Write the metrics of the run for the node exporter, failed runs included
+    try:
+        if _update_losses:
+            update_losses(debug=debug)
 
-    if _update_history:
-        download_consumption_history(debug=debug)
-        process_consumption_history(debug=debug)
+        if _update_history:
+            download_consumption_history(debug=debug)
+            process_consumption_history(debug=debug)
 
-    if _update_prices:
-        update_prices(debug=debug)
+        if _update_prices:
+            update_prices(pack_prices=pack_prices, debug=debug)
 
+        if _update_shelly:
+            shelly.process_energy_history(debug=debug)
+            ledger.update_daily_costs(debug=debug)
 
-    if _update_shelly:
-        shelly.save_yesterday_solar_production(debug=debug)
-        shelly.download_grid_data(debug=debug)
+        # Catch up the rollups with any data saved outside the stages above
+        rollups.update_all(debug=debug)
 
-    plot.providers_indexed_prices(start_date=start_date, override=override, debug=debug)
-    plot.weekly_energy_consumption(debug=debug)
+        # Compare the new E-REDES and Shelly days, for the calibration of the charts
+        reconcile.update_daily(debug=debug)
 
+        if _export:
+            export.export(debug=debug)
 
-if __name__ == "__main__":
-    args = utils.parser_args()
-    main(
-        _update_history=not args.no_history,
-        _update_prices=not args.no_prices,
-        _update_shelly=not args.no_shelly,
+        plot.providers_indexed_prices(
+            start_date=start_date, override=override, debug=debug
+        )
+        plot.weekly_energy_consumption(
+            days=window_days,
+            start_date=window_start,
+            end_date=window_end,
+            show=show,
+            debug=debug,
+        )
+
+        if _dashboard:
+            dashboard.build(debug=debug)
+    finally:
+        metrics.write(debug=debug)
+
+
+def backfill(missing: dict[str, list[tuple]], workers: int = 1, debug: bool = False) -> None:
+    """
+    Queue the missing ranges of each dataset as backfill jobs and run the queue,
+    so an interrupted backfill resumes where it stopped on the next run.
+    """
+    for dataset, ranges in missing.items():
+        added = sum(jobs.enqueue(dataset, start, end) for start, end in ranges)
+        if debug:
+            print(f"Queued {added} {dataset} jobs")
+
+    done = jobs.run(workers=workers, debug=debug)
+    print(f"\nBackfill jobs done: {done or 'none'}")
+    print(f"\nBackfill queue:\n{jobs.status()}")
+
+
+def gaps(
+    datasets: list[str] = None,
+    start_date: str = None,
+    end_date: str = None,
+    rebuild: bool = False,
+    _backfill: bool = False,
+    workers: int = 1,
+    debug: bool = False,
+) -> None:
+    """
+    Print the missing quarter-hours of each dataset, from its coverage bitmap,
+    and re-download only the missing ranges if `_backfill` is set.
+    """
+    missing_ranges = {}
+    for dataset in datasets or list(coverage.DATASETS):
+        if rebuild:
+            coverage.rebuild(dataset)
+
+        # Default to the whole coverage, up to the last complete day
+        start = utils.parse_date(start_date) if start_date else coverage.first_slot(dataset)
+        if start is None:
+            print(f"\n{dataset}: no coverage yet, run with --rebuild")
+            continue
+        if end_date:
+            end = utils.parse_date(end_date) + pd.Timedelta(days=1)
+        elif dataset in ("omie", "repsol") and energy_prices.is_available(utils.tomorrow()):
+            end = utils.tomorrow() + pd.Timedelta(days=1)
+        elif dataset in ("omie", "repsol"):
+            end = utils.tomorrow()
+        else:
+            end = utils.today()
+
+        missing = coverage.gaps(dataset, start, end)
+        print(f"\n{dataset}: {len(missing)} gaps from {start.date()} to {end.date()}")
+        for gap_start, gap_end in missing:
+            slots = (gap_end - gap_start) // coverage.SLOT
+            print(f"  {gap_start} to {gap_end} ({slots} slots)")
+
+        if missing:
+            missing_ranges[dataset] = missing
+
+    if _backfill and missing_ranges:
+        backfill(missing_ranges, workers=workers, debug=debug)
+
+
+def dtypes() -> None:
+    """
+    Print the memory used by the datasets in their current and compact dtypes.
+    """
+    # Load the current dtypes, whatever the compact mode
+    compact.ENABLED = False
+
+    # The datasets to compare, by name: the files they are loaded from and their loader
+    datasets = {
+        name: (export.DATASETS[name]["paths"], export.DATASETS[name]["loader"])
+        for name in ["omie_prices", "repsol_prices", "losses", "consumption", "shelly"]
+    }
+    for source in shelly.EnergySource:
+        datasets[f"shelly_{source.id_label}_minutes"] = (
+            [utils.data_path("shelly", f"em_data.{source.id_label}.csv")],
+            source.get_data,
+        )
+
+    # Skip the datasets without any data saved yet
+    loaders = {
+        name: loader
+        for name, (paths, loader) in datasets.items()
+        if any(os.path.exists(path) for path in paths)
+    }
+    print(compact.benchmark(loaders).round(6))
+
+
+def forecast_day(date: str = None, model: str = "regression") -> None:
+    """
+    Print the hourly forecast of a day and its totals.
+    """
+    day = utils.parse_date(date) if date else None
+    df = forecast.forecast(day=day, model=model)
+
+    hourly_df = df.drop(columns=["€/kWh"]).resample("1h").sum()
+    hourly_df.index = hourly_df.index.tz_convert(forecast.TIMEZONE)
+    print(f"\nForecast ({model}):\n{hourly_df.round(3)}")
+    print(
+        f"\nTotal: consumed {df['consumed_kWh'].sum():.3f} kWh, "
+        f"solar {df['solar_kWh'].sum():.3f} kWh, "
+        f"E-REDES grid {df['e_redes_grid_kWh'].sum():.3f} kWh, "
+        f"expected cost {df['cost_€'].sum():.2f} €"
+    )
+
+
+def compare_tariffs(
+    path: str,
+    start_date: str = None,
+    end_date: str = None,
+    repsol_daily_charge: float = 0.0,
+) -> None:
+    """
+    Print the yearly cost of the E-REDES consumption with each fixed-price
+    tariff and with the Repsol indexed prices.
+    """
+    start = utils.parse_date(start_date) if start_date else None
+    end = utils.parse_date(end_date) + pd.Timedelta(days=1) if end_date else None
+    df = tariffs.compare(
+        tariffs.load_tariffs(path),
+        start=start,
+        end=end,
+        repsol_daily_charge=repsol_daily_charge,
+    )
+    print(f"\nTariffs by yearly cost:\n{df.round(3).to_string(index=False)}")
+
+
+def run_accounts(
+    names: list[str],
+    profiles_path: str,
+    workers: int = None,
+    args: argparse.Namespace = None,
+) -> None:
+    """
+    Run the pipeline of the accounts in parallel, with the pipeline flags given
+    before the command, the shared prices and losses updated once.
+    """
+    profiles = accounts.load_profiles(profiles_path, names=names)
+
+    # The prices are shared, every account runs without updating them
+    flags = {
+        "--no-history": args.no_history,
+        "--no-shelly": args.no_shelly,
+        "--export": args.export,
+        "--dashboard": args.dashboard,
+        "--override": args.override,
+        "--debug": args.debug,
+    }
+    pipeline_args = [flag for flag, enabled in flags.items() if enabled]
+    pipeline_args += ["--window-days", str(args.window_days)]
+    for flag, value in [
+        ("--start-date", args.start_date),
+        ("--window-start", args.window_start),
+        ("--window-end", args.window_end),
+    ]:
+        if value:
+            pipeline_args += [flag, value]
+
+    results = accounts.run(
+        profiles,
+        args=pipeline_args,
+        workers=workers,
         _update_losses=args.losses,
-        override=args.override,
-        start_date=args.start_date,
         debug=args.debug,
     )
+    failed = [name for name, code in results.items() if code != 0]
+    if failed:
+        print(
+            f"\nFailed accounts: {', '.join(failed)}, "
+            "see the pipeline.log in their data directories."
+        )
+
+
+def schedule(loads_path: str, date: str = None, days: int = 1) -> None:
+    """
+    Print the cheapest schedule of the deferrable loads in a JSON file.
+    """
+    loads = scheduler.load_loads(loads_path)
+    day = utils.parse_date(date) if date else None
+    entries = scheduler.schedule(loads, day=day, days=days)
+    print(scheduler.schedule_to_json(loads, entries))
+
+
+if __name__ == "__main__":
+    args = utils.parser_args()
+    if args.command == "schedule":
+        schedule(args.loads, date=args.date, days=args.days)
+    elif args.command == "gaps":
+        gaps(
+            datasets=args.datasets,
+            start_date=args.start,
+            end_date=args.end,
+            rebuild=args.rebuild,
+            _backfill=args.backfill,
+            workers=args.workers,
+            debug=args.debug,
+        )
+    elif args.command == "query":
+        analytics.sync(force=args.force, debug=args.debug)
+        if args.sql is None:
+            print(analytics.tables().to_string(index=False))
+        elif args.csv:
+            print(analytics.query(args.sql, _sync=False).to_csv(index=False), end="")
+        else:
+            print(analytics.query(args.sql, _sync=False).to_string(index=False))
+    elif args.command == "jobs":
+        if args.action == "add":
+            start = utils.parse_date(args.start)
+            end = utils.parse_date(args.end) + pd.Timedelta(days=1)
+            added = jobs.enqueue(args.dataset, start, end)
+            print(f"\nQueued {added} {args.dataset} jobs.")
+        elif args.action == "run":
+            done = jobs.run(workers=args.workers, debug=args.debug)
+            print(f"\nJobs done: {done or 'none'}")
+        elif args.action == "retry":
+            print(f"\nRetrying {jobs.retry_failed()} failed jobs.")
+        print(f"\nBackfill queue:\n{jobs.status()}")
+    elif args.command == "forecast":
+        forecast_day(date=args.date, model=args.model)
+    elif args.command == "tariffs":
+        compare_tariffs(
+            args.tariffs,
+            start_date=args.start,
+            end_date=args.end,
+            repsol_daily_charge=args.repsol_daily_charge,
+        )
+    elif args.command == "export":
+        exported = export.export(args.datasets, force=args.force, debug=args.debug)
+        print(f"\nExported {', '.join(exported) or 'nothing, all up to date'}.")
+    elif args.command == "dtypes":
+        dtypes()
+    elif args.command == "dashboard":
+        written = dashboard.build(force=args.force, debug=args.debug)
+        print(f"\nBuilt {len(written)} dashboard files in {dashboard.SITE_DIR}.")
+    elif args.command == "accounts":
+        run_accounts(args.names, args.profiles, workers=args.workers, args=args)
+    elif args.command == "daemon":
+        daemon.run(_export=args.export, once=args.once, debug=args.debug)
+    elif args.command == "serve":
+        server.serve(host=args.host, port=args.port, debug=args.debug)
+    else:
+        main(
+            _update_history=not args.no_history,
+            _update_prices=not args.no_prices,
+            _update_shelly=not args.no_shelly,
+            _update_losses=args.losses,
+            pack_prices=args.pack_prices,
+            _export=args.export,
+            _dashboard=args.dashboard,
+            override=args.override,
+            start_date=args.start_date,
+            window_days=args.window_days,
+            window_start=args.window_start,
+            window_end=args.window_end,
+            show=args.show,
+            debug=args.debug,
+        )
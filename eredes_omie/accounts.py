@@ -0,0 +1,197 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import json
+import os
+import subprocess
+import sys
+import time
+
+from erse import losses_profiles
+from omie import energy_prices
+import providers.repsol as repsol
+import utils
+
+# File with the account profiles, a JSON list with one object per account
+PROFILES_PATH = "/workspace/accounts.json"
+
+# Tariffs the accounts can be billed with, and the module computing their prices
+TARIFFS = {"repsol": repsol}
+
+# Directory of this package, run as a script for each account
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@dataclass
+class Profile:
+    """
+    Dataclass to represent an account: a household with its E-REDES login and
+    meter point, its Shelly EM and its tariff, and the directory of its data.
+
+    The password is not kept in the profile, only the name of the environment
+    variable holding it, which can be set in the .env file.
+
+    The downloads directory is where the browser of its Selenium server saves
+    the exports, shared with the other accounts by default: each account moves
+    its exports to its data directory while it holds the lock of the directory.
+    """
+
+    name: str
+    data_dir: str
+    eredes_username: str = ""
+    eredes_password_env: str = ""
+    meter_point: str = ""
+    shelly_origin: str = ""
+    tariff: str = "repsol"
+    output_dir: str = ""
+    downloads_dir: str = ""
+    selenium_remote_url: str = ""
+
+    def environment(self, shared_dir: str) -> dict[str, str]:
+        """
+        The environment of the pipeline of the account: the paths and settings
+        read by `utils` and the modules, and the E-REDES credentials.
+        """
+        env = dict(os.environ)
+        env.update(
+            {
+                "EREDES_OMIE_DATA_DIR": self.data_dir,
+                "EREDES_OMIE_SHARED_DIR": shared_dir,
+                "EREDES_OMIE_OUTPUT_DIR": self.output_dir or self.data_dir,
+                "EREDES_USERNAME": self.eredes_username,
+                "EREDES_PASSWORD": os.getenv(self.eredes_password_env, "")
+                if self.eredes_password_env
+                else "",
+                "EREDES_METER_POINT": self.meter_point,
+            }
+        )
+        if self.downloads_dir:
+            env["EREDES_OMIE_DOWNLOADS_DIR"] = self.downloads_dir
+        if self.shelly_origin:
+            env["EREDES_OMIE_SHELLY_ORIGIN"] = self.shelly_origin
+        if self.selenium_remote_url:
+            env["SELENIUM_REMOTE_URL"] = self.selenium_remote_url
+        return env
+
+
+def load_profiles(path: str = PROFILES_PATH, names: list[str] = None) -> list[Profile]:
+    """
+    Loads the account profiles from a JSON file with one object per account.
+
+    Args:
+        path (str): The path to the profiles file.
+        names (list[str], optional): The accounts to load. Defaults to every account.
+
+    Returns:
+        list[Profile]: The profiles, in the order of the file.
+
+    Raises:
+        ValueError: If a profile is invalid, or an account in `names` does not exist.
+    """
+    with open(path) as file:
+        profiles = [Profile(**profile) for profile in json.load(file)]
+
+    for profile in profiles:
+        if profile.tariff not in TARIFFS:
+            raise ValueError(
+                f"Invalid tariff of {profile.name}: {profile.tariff}, "
+                f"expected one of {list(TARIFFS)}"
+            )
+
+    # Accounts sharing a data directory would overwrite each other's files
+    for key in ("name", "data_dir"):
+        values = [getattr(profile, key) for profile in profiles]
+        duplicates = sorted({value for value in values if values.count(value) > 1})
+        if duplicates:
+            raise ValueError(f"Duplicate {key} in {path}: {duplicates}")
+
+    if names:
+        missing = set(names) - {profile.name for profile in profiles}
+        if missing:
+            raise ValueError(f"Unknown accounts: {sorted(missing)}")
+        profiles = [profile for profile in profiles if profile.name in names]
+
+    return profiles
+
+
+def update_shared(
+    tariffs: set[str], _update_losses: bool = False, debug: bool = False
+) -> None:
+    """
+    Updates the datasets shared by every account, once: downloads and parses the
+    OMIE prices, the ERSE losses profiles if requested, and the prices of the tariffs.
+    """
+    if _update_losses:
+        losses_profiles.update_losses_profiles()
+
+    energy_prices.update_prices()
+    for tariff in sorted(tariffs):
+        TARIFFS[tariff].update_prices()
+        TARIFFS[tariff].plot_prices(debug=debug)
+
+
+def run_profile(profile: Profile, args: list[str], shared_dir: str) -> tuple[int, float]:
+    """
+    Runs the pipeline of an account in its own process, without updating the
+    shared datasets, with its output saved to pipeline.log in its data directory.
+
+    Returns:
+        tuple[int, float]: The exit code of the pipeline and the seconds it took.
+    """
+    os.makedirs(profile.data_dir, exist_ok=True)
+    start = time.perf_counter()
+    with open(os.path.join(profile.data_dir, "pipeline.log"), "w") as log:
+        result = subprocess.run(
+            [sys.executable, PACKAGE_DIR, "--no-prices", *args],
+            env=profile.environment(shared_dir),
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+    return result.returncode, time.perf_counter() - start
+
+
+def run(
+    profiles: list[Profile],
+    args: list[str] = None,
+    workers: int = None,
+    _update_losses: bool = False,
+    debug: bool = False,
+) -> dict[str, int]:
+    """
+    Runs the pipeline of many accounts in parallel, after updating the shared
+    datasets once for all of them.
+
+    Each account runs in its own process, so the paths and settings of one
+    never leak into another, and reads the shared datasets from `utils.SHARED_DIR`.
+
+    Args:
+        profiles (list[Profile]): The accounts to run.
+        args (list[str], optional): The pipeline arguments passed to every account.
+        workers (int, optional): The number of accounts run at once. Defaults to all of them.
+        _update_losses (bool): If True, updates the shared losses profiles first. Defaults to False.
+        debug (bool): If True, prints debug information. Defaults to False.
+
+    Returns:
+        dict[str, int]: The exit code of the pipeline of each account, by name.
+    """
+    if len(profiles) == 0:
+        return {}
+
+    update_shared(
+        {profile.tariff for profile in profiles}, _update_losses=_update_losses, debug=debug
+    )
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers or len(profiles)) as executor:
+        futures = {
+            profile.name: executor.submit(run_profile, profile, args or [], utils.SHARED_DIR)
+            for profile in profiles
+        }
+        for name, future in futures.items():
+            code, seconds = future.result()
+            results[name] = code
+            print(
+                f"\n{name}: {'ok' if code == 0 else f'failed with exit code {code}'} "
+                f"in {seconds:.1f}s"
+            )
+
+    return results
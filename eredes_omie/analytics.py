@@ -0,0 +1,292 @@
+from contextlib import closing
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+import export
+import utils
+
+# Database with a table of each dataset, for ad-hoc SQL queries
+DATABASE_PATH = utils.data_path("analytics.sqlite")
+
+# Timezone of the local_datetime column of each table
+TIMEZONE = "Europe/Lisbon"
+
+# Format of the timestamps in the tables, which sorts as text in time order
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Tables of the database: the datasets of the Arrow export, their sources and loaders
+TABLES = export.DATASETS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    name TEXT PRIMARY KEY,
+    versions TEXT NOT NULL,
+    rows INTEGER NOT NULL,
+    synced REAL NOT NULL
+);
+"""
+
+
+def connect(path: str = DATABASE_PATH) -> sqlite3.Connection:
+    """
+    Opens the analytics database, creating it if needed, in WAL mode so that
+    queries can run while the tables are synced.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def _versions(name: str) -> str:
+    """The modification time and size of each source file of a table."""
+    return repr(
+        [
+            (os.stat(path).st_mtime_ns, os.stat(path).st_size)
+            if os.path.exists(path)
+            else None
+            for path in TABLES[name]["paths"]
+        ]
+    )
+
+
+def _format(timestamps: pd.DatetimeIndex, timezone: str) -> np.ndarray:
+    """
+    Formats timestamps as 'YYYY-MM-DD HH:MM:SS' in a timezone, much faster
+    than `strftime` on large indexes.
+    """
+    local = timestamps.tz_convert(timezone).tz_localize(None).to_numpy("datetime64[s]")
+    return np.char.replace(np.datetime_as_string(local, unit="s"), "T", " ")
+
+
+def _to_table(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts a dataset to the rows of its table: the UTC starting_datetime and
+    the local_datetime as text, then the columns of the dataset.
+    """
+    # The Shelly history and the cost ledger are indexed by their timestamps
+    if isinstance(df.index, pd.DatetimeIndex):
+        df = df.rename_axis("starting_datetime").reset_index()
+
+    timestamps = pd.DatetimeIndex(df["starting_datetime"])
+    df = df.drop(columns=["starting_datetime"])
+    df.insert(0, "local_datetime", _format(timestamps, TIMEZONE))
+    df.insert(0, "starting_datetime", _format(timestamps, "UTC"))
+
+    # A dataset may repeat a timestamp across its sources, the last one wins
+    return df.drop_duplicates("starting_datetime", keep="last")
+
+
+def _column_type(dtype: np.dtype) -> str:
+    if pd.api.types.is_integer_dtype(dtype):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(dtype):
+        return "REAL"
+    return "TEXT"
+
+
+def _replace_table(connection: sqlite3.Connection, name: str, df: pd.DataFrame) -> None:
+    """
+    Replaces the rows of a table in a single transaction, so that queries see
+    either the previous or the new rows.
+
+    The tables are clustered on starting_datetime, so a range of timestamps is
+    read from contiguous pages of the table, and local_datetime is indexed.
+    """
+    columns = ", ".join(
+        f'"{column}" {_column_type(df[column].dtype)}' for column in df.columns[2:]
+    )
+    placeholders = ", ".join("?" * len(df.columns))
+    # Missing values are stored as NULL
+    rows = zip(
+        *(
+            [None if value != value else value for value in df[column].tolist()]
+            if df[column].hasnans
+            else df[column].tolist()
+            for column in df.columns
+        )
+    )
+
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        connection.execute(f'DROP TABLE IF EXISTS "{name}"')
+        connection.execute(
+            f"""
+            CREATE TABLE "{name}" (
+                starting_datetime TEXT PRIMARY KEY,
+                local_datetime TEXT NOT NULL,
+                {columns}
+            ) WITHOUT ROWID
+            """
+        )
+        connection.execute(
+            f'CREATE INDEX "{name}_local_datetime" ON "{name}" (local_datetime)'
+        )
+        connection.executemany(f'INSERT INTO "{name}" VALUES ({placeholders})', rows)
+        connection.execute(
+            "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+            (name, _versions(name), len(df), time.time()),
+        )
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+
+
+def sync(
+    names: list[str] = None,
+    path: str = DATABASE_PATH,
+    force: bool = False,
+    debug: bool = False,
+) -> list[str]:
+    """
+    Loads the datasets whose sources changed since their last sync into their tables.
+
+    Args:
+        names (list[str], optional): The tables to sync. Defaults to all of `TABLES`.
+        path (str): The path to the analytics database.
+        force (bool): If True, loads the datasets even if their sources did not change.
+        debug (bool): If True, prints debug information. Defaults to False.
+
+    Returns:
+        list[str]: The names of the synced tables.
+    """
+    synced = []
+    with closing(connect(path)) as connection:
+        saved = dict(connection.execute("SELECT name, versions FROM sources"))
+        for name in names or list(TABLES):
+            if not any(os.path.exists(source) for source in TABLES[name]["paths"]):
+                if debug:
+                    print(f"Skipping {name}, no data saved yet")
+                continue
+            if not force and saved.get(name) == _versions(name):
+                continue
+
+            start = time.perf_counter()
+            df = _to_table(TABLES[name]["loader"]())
+            _replace_table(connection, name, df)
+            synced.append(name)
+
+            if debug:
+                seconds = time.perf_counter() - start
+                print(f"Synced {len(df)} rows of {name} in {seconds:.2f}s")
+
+    return synced
+
+
+def query(
+    sql: str,
+    params: tuple | dict = (),
+    path: str = DATABASE_PATH,
+    _sync: bool = True,
+) -> pd.DataFrame:
+    """
+    Runs a SQL query over the tables of the datasets.
+
+    Each table has a starting_datetime column with the UTC start of each
+    quarter-hour, or day for the cost_ledger, and a local_datetime column with
+    the same time in Lisbon, both as 'YYYY-MM-DD HH:MM:SS' text, so they can be
+    compared with date strings and passed to the SQLite date functions.
+    Columns with symbols in their names are quoted, like "€/kWh".
+
+    Example:
+        query(
+            'SELECT AVG("€/kWh") FROM repsol_prices '
+            "WHERE strftime('%H', local_datetime) = '19' "
+            "AND strftime('%w', local_datetime) BETWEEN '1' AND '5'"
+        )
+
+    Args:
+        sql (str): The query.
+        params (tuple | dict): The parameters of the query.
+        path (str): The path to the analytics database.
+        _sync (bool): If True, syncs the tables with changed sources first. Defaults to True.
+
+    Returns:
+        pd.DataFrame: The result of the query.
+    """
+    if _sync:
+        sync(path=path)
+
+    with closing(connect(path)) as connection:
+        return pd.read_sql_query(sql, connection, params=params)
+
+
+def get(
+    name: str,
+    start: pd.Timestamp = None,
+    end: pd.Timestamp = None,
+    columns: list[str] = None,
+    path: str = DATABASE_PATH,
+    _sync: bool = True,
+) -> pd.DataFrame:
+    """
+    Loads the rows in [start, end) of a table, read through its starting_datetime key.
+
+    Args:
+        name (str): The table, one of `TABLES`.
+        start (pd.Timestamp, optional): The first timestamp to load. Defaults to the start of the table.
+        end (pd.Timestamp, optional): The first timestamp not to load. Defaults to the end of the table.
+        columns (list[str], optional): The columns to load. Defaults to all of them.
+        path (str): The path to the analytics database.
+        _sync (bool): If True, syncs the table first if its sources changed. Defaults to True.
+
+    Returns:
+        pd.DataFrame: The rows, indexed by starting_datetime in UTC.
+    """
+    if name not in TABLES:
+        raise ValueError(f"Invalid table: {name}, expected one of {list(TABLES)}")
+    if _sync:
+        sync([name], path=path)
+
+    selected = "*" if columns is None else ", ".join(
+        ["starting_datetime"] + [f'"{column}"' for column in columns]
+    )
+    conditions, params = [], []
+    for operator, timestamp in ((">=", start), ("<", end)):
+        if timestamp is not None:
+            conditions.append(f"starting_datetime {operator} ?")
+            params.append(timestamp.tz_convert("UTC").strftime(TIMESTAMP_FORMAT))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    with closing(connect(path)) as connection:
+        df = pd.read_sql_query(
+            f'SELECT {selected} FROM "{name}" {where} ORDER BY starting_datetime',
+            connection,
+            params=params,
+        )
+
+    df.index = pd.to_datetime(df.pop("starting_datetime")).dt.tz_localize("UTC")
+    return df
+
+
+def tables(path: str = DATABASE_PATH) -> pd.DataFrame:
+    """
+    Lists the synced tables with their columns and number of rows.
+
+    Returns:
+        pd.DataFrame: One row per table.
+    """
+    with closing(connect(path)) as connection:
+        rows = connection.execute("SELECT name, rows, synced FROM sources").fetchall()
+        return pd.DataFrame(
+            [
+                {
+                    "table": name,
+                    "rows": count,
+                    "synced": pd.Timestamp(synced, unit="s", tz="UTC").floor("s"),
+                    "columns": ", ".join(
+                        column
+                        for _, column, *_ in connection.execute(
+                            f'PRAGMA table_info("{name}")'
+                        )
+                    ),
+                }
+                for name, count, synced in rows
+            ]
+        )
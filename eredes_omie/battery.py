@@ -0,0 +1,263 @@
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import os
+
+import numpy as np
+import pandas as pd
+
+import energy_meters.shelly as shelly
+import providers.repsol as repsol
+
+# Dispatch strategies supported by the simulator
+STRATEGIES = ["self_consumption", "arbitrage"]
+
+# Energy of a quarter-hour at 1 kW, in kWh
+SLOT_HOURS = 0.25
+
+
+def load_history(start: pd.Timestamp = None, end: pd.Timestamp = None) -> pd.DataFrame:
+    """
+    Loads the quarter-hour grid energy and price history used by the simulator.
+
+    Args:
+        start (pd.Timestamp, optional): The first timestamp to load. Defaults to the start of the history.
+        end (pd.Timestamp, optional): The first timestamp not to load. Defaults to the end of the history.
+
+    Returns:
+        pd.DataFrame: The grid_kWh and €/kWh of each quarter-hour with both values, indexed by timestamp.
+    """
+    energy_df = shelly.get_energy_history(start=start, end=end)
+    prices_df = repsol.get_prices(start=start, end=end).set_index("starting_datetime")
+
+    return energy_df[["grid_kWh"]].join(prices_df[["€/kWh"]], how="inner").dropna()
+
+
+def cheap_slots(
+    history_df: pd.DataFrame, quantile: float = 0.25, efficiency: float = 0.9
+) -> np.ndarray:
+    """
+    Flags the quarter-hours worth charging from the grid: those in the cheapest
+    `quantile` of their day whose price is below the most expensive later price
+    of the day, after the round-trip `efficiency` losses.
+    """
+    price = history_df["€/kWh"]
+    day = history_df.index.date
+    low = price.groupby(day).transform("quantile", quantile)
+
+    # Most expensive price after each quarter-hour of the day, walking it backwards
+    reversed_price = price.iloc[::-1]
+    reversed_day = day[::-1]
+    later = (
+        reversed_price.groupby(reversed_day)
+        .shift()
+        .groupby(reversed_day)
+        .cummax()
+        .iloc[::-1]
+    )
+
+    return ((price <= low) & (price < later * efficiency)).to_numpy()
+
+
+def dispatch(
+    grid: np.ndarray,
+    price: np.ndarray,
+    cheap: np.ndarray,
+    capacity: np.ndarray,
+    power: np.ndarray,
+    efficiency: float = 0.9,
+    strategy: str = "self_consumption",
+) -> dict[str, np.ndarray]:
+    """
+    Simulates the dispatch of many batteries at once over the same quarter-hours.
+
+    Every battery starts empty. Solar surplus always charges the battery and any
+    deficit is covered by it. With the "arbitrage" strategy, the battery also
+    charges from the grid in cheap quarter-hours and only discharges outside them.
+    Exported energy is not paid, as with the current contract.
+
+    Args:
+        grid (np.ndarray): The net grid energy of each quarter-hour, in kWh (positive when bought).
+        price (np.ndarray): The price of each quarter-hour, in €/kWh.
+        cheap (np.ndarray): The quarter-hours where charging from the grid is allowed, see `cheap_slots`.
+        capacity (np.ndarray): The usable capacity of each battery, in kWh.
+        power (np.ndarray): The maximum charge and discharge power of each battery, in kW.
+        efficiency (float): The round-trip efficiency, split evenly between charge and discharge. Defaults to 0.9.
+        strategy (str): One of `STRATEGIES`. Defaults to "self_consumption".
+
+    Returns:
+        dict[str, np.ndarray]: The bought and exported energy, the cost, and the energy
+        charged and discharged by each battery over all the quarter-hours.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Invalid strategy: {strategy}, expected one of {STRATEGIES}")
+
+    arbitrage = strategy == "arbitrage"
+
+    capacity = np.asarray(capacity, dtype="float64")
+    power = np.asarray(power, dtype="float64")
+
+    # Energy limit of each quarter-hour and one-way efficiency
+    limit = power * SLOT_HOURS
+    one_way = np.sqrt(efficiency)
+
+    # State of charge and totals of each battery
+    soc = np.zeros_like(capacity)
+    bought = np.zeros_like(capacity)
+    exported = np.zeros_like(capacity)
+    cost = np.zeros_like(capacity)
+    charged = np.zeros_like(capacity)
+    discharged = np.zeros_like(capacity)
+    zeros = np.zeros_like(capacity)
+
+    # The state of charge depends on the previous quarter-hour, so only the
+    # batteries are vectorized and the quarter-hours are walked in order
+    for g, p, c in zip(grid.tolist(), price.tolist(), cheap.tolist()):
+        # Energy accepted from the input side until the battery is full
+        room = (capacity - soc) / one_way
+
+        if arbitrage and c:
+            # Charge as much as possible, from the surplus first and then from the grid
+            charge = np.minimum(limit, room)
+            discharge = zeros
+        elif g < 0:
+            # Charge from the solar surplus
+            charge = np.minimum(np.minimum(limit, room), -g)
+            discharge = zeros
+        else:
+            # Cover the deficit
+            charge = zeros
+            discharge = np.minimum(np.minimum(limit, soc * one_way), g)
+
+        soc = soc + charge * one_way - discharge / one_way
+        net = g + charge - discharge
+
+        bought += np.maximum(net, 0)
+        exported += np.maximum(-net, 0)
+        cost += p * np.maximum(net, 0)
+        charged += charge
+        discharged += discharge
+
+    return {
+        "bought_kWh": bought,
+        "exported_kWh": exported,
+        "cost_€": cost,
+        "charged_kWh": charged,
+        "discharged_kWh": discharged,
+    }
+
+
+def _sweep_task(
+    year: int,
+    strategy: str,
+    grid: np.ndarray,
+    price: np.ndarray,
+    cheap: np.ndarray,
+    capacity: np.ndarray,
+    power: np.ndarray,
+    efficiency: float,
+) -> pd.DataFrame:
+    """
+    Simulates a chunk of battery configurations over one year, in a worker process.
+    """
+    totals = dispatch(grid, price, cheap, capacity, power, efficiency, strategy)
+
+    df = pd.DataFrame(totals)
+    df.insert(0, "year", year)
+    df.insert(1, "strategy", strategy)
+    df.insert(2, "capacity_kWh", capacity)
+    df.insert(3, "power_kW", power)
+    df["baseline_cost_€"] = float(np.sum(price * np.maximum(grid, 0)))
+
+    return df
+
+
+def sweep(
+    capacities: list[float],
+    powers: list[float],
+    efficiency: float = 0.9,
+    strategies: list[str] = STRATEGIES,
+    start: pd.Timestamp = None,
+    end: pd.Timestamp = None,
+    workers: int = None,
+    debug: bool = False,
+) -> pd.DataFrame:
+    """
+    Simulates every combination of battery capacity and power over the history,
+    and computes the annual savings of each one.
+
+    Each year is simulated independently, starting with an empty battery. The
+    combinations are split in chunks and the chunks of every year and strategy
+    run in parallel in a process pool.
+
+    Args:
+        capacities (list[float]): The battery capacities to simulate, in kWh.
+        powers (list[float]): The battery powers to simulate, in kW.
+        efficiency (float): The round-trip efficiency. Defaults to 0.9.
+        strategies (list[str]): The strategies to simulate. Defaults to all of `STRATEGIES`.
+        start (pd.Timestamp, optional): The start of the history to simulate. Defaults to the start of the history.
+        end (pd.Timestamp, optional): The end of the history to simulate. Defaults to the end of the history.
+        workers (int, optional): The number of worker processes. Defaults to the number of CPUs.
+        debug (bool): If True, prints debug information. Defaults to False.
+
+    Returns:
+        pd.DataFrame: One row per year, strategy, capacity and power, with the
+        totals of `dispatch`, the baseline cost without battery and the savings.
+    """
+    history_df = load_history(start=start, end=end)
+    cheap = cheap_slots(history_df, efficiency=efficiency)
+
+    # All the combinations of capacity and power
+    combinations = np.array(list(itertools.product(capacities, powers)), dtype="float64")
+    workers = workers or os.cpu_count() or 1
+
+    # Split the combinations so that every worker gets a share of every year
+    chunks = np.array_split(combinations, min(workers, len(combinations)))
+
+    if debug:
+        print(
+            f"Simulating {len(combinations)} batteries x {len(strategies)} strategies "
+            f"over {len(history_df)} quarter-hours with {workers} workers..."
+        )
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for year, year_df in history_df.groupby(history_df.index.year):
+            mask = history_df.index.year == year
+            for strategy in strategies:
+                for chunk in chunks:
+                    futures.append(
+                        executor.submit(
+                            _sweep_task,
+                            year,
+                            strategy,
+                            year_df["grid_kWh"].to_numpy(dtype="float64"),
+                            year_df["€/kWh"].to_numpy(dtype="float64"),
+                            cheap[mask],
+                            chunk[:, 0],
+                            chunk[:, 1],
+                            efficiency,
+                        )
+                    )
+
+        df = pd.concat([future.result() for future in futures], ignore_index=True)
+
+    # Savings against the same year without battery
+    df["savings_€"] = df["baseline_cost_€"] - df["cost_€"]
+    df["cycles"] = df["discharged_kWh"] / df["capacity_kWh"].where(
+        df["capacity_kWh"] > 0
+    )
+
+    return df.sort_values(["strategy", "capacity_kWh", "power_kW", "year"]).reset_index(
+        drop=True
+    )
+
+
+def savings_table(sweep_df: pd.DataFrame, strategy: str = "self_consumption") -> pd.DataFrame:
+    """
+    Pivots the results of `sweep` into a table of mean annual savings per capacity and power.
+    """
+    df = sweep_df[sweep_df["strategy"] == strategy]
+
+    return df.pivot_table(
+        index="capacity_kWh", columns="power_kW", values="savings_€", aggfunc="mean"
+    )
@@ -0,0 +1,163 @@
+from collections import OrderedDict
+import os
+import threading
+from typing import Callable
+
+import pandas as pd
+
+# Maximum memory used by the cached datasets, in MiB
+MAX_MEGABYTES = int(os.getenv("EREDES_OMIE_CACHE_MB") or 512)
+
+# Cached datasets by path, least recently used first: (version, size in bytes, DataFrame)
+_entries: OrderedDict[str, tuple[tuple[int, int], int, pd.DataFrame]] = OrderedDict()
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def _version(path: str) -> tuple[int, int] | None:
+    """
+    The modification time and size of a file, or None if it does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _evict() -> None:
+    """
+    Evicts the least recently used datasets until the cache fits its memory limit.
+    """
+    max_bytes = MAX_MEGABYTES * 1024 * 1024
+    while _entries and sum(size for _, size, _ in _entries.values()) > max_bytes:
+        _entries.popitem(last=False)
+        _stats["evictions"] += 1
+
+
+def _slice(
+    df: pd.DataFrame, start: pd.Timestamp, end: pd.Timestamp, column: str
+) -> pd.DataFrame:
+    """
+    Selects the rows in [start, end) of a DataFrame sorted by a timestamp column or index.
+    """
+    if start is None and end is None:
+        return df
+
+    timestamps = df.index if column is None else pd.DatetimeIndex(df[column])
+    first = 0 if start is None else timestamps.searchsorted(start)
+    last = len(df) if end is None else timestamps.searchsorted(end)
+    return df.iloc[first:last]
+
+
+def put(path: str, df: pd.DataFrame) -> None:
+    """
+    Caches a dataset just written to a file, so that it is not parsed again.
+
+    Must be called right after the file is written, with a DataFrame equal to
+    what the loader of the file returns.
+    """
+    version = _version(path)
+    if version is None:
+        return
+
+    size = int(df.memory_usage(deep=True).sum())
+    with _lock:
+        _entries[path] = (version, size, df.copy())
+        _entries.move_to_end(path)
+        _evict()
+
+
+def get(
+    path: str,
+    start: pd.Timestamp = None,
+    end: pd.Timestamp = None,
+    column: str = None,
+) -> pd.DataFrame | None:
+    """
+    Gets a copy of a cached dataset, or of the rows in [start, end) of it, if the
+    file did not change since it was cached.
+
+    Args:
+        path (str): The path of the dataset file.
+        start (pd.Timestamp, optional): The first timestamp to include.
+        end (pd.Timestamp, optional): The first timestamp not to include.
+        column (str, optional): The timestamp column the dataset is sorted by. Defaults to the index.
+
+    Returns:
+        pd.DataFrame | None: The cached rows, or None if the dataset is not cached or changed.
+    """
+    version = _version(path)
+    with _lock:
+        entry = _entries.get(path)
+        if entry is None or entry[0] != version:
+            _stats["misses"] += 1
+            return None
+
+        _entries.move_to_end(path)
+        _stats["hits"] += 1
+        df = entry[2]
+
+    return _slice(df, start, end, column).copy()
+
+
+def load(
+    path: str,
+    loader: Callable[[str], pd.DataFrame],
+    start: pd.Timestamp = None,
+    end: pd.Timestamp = None,
+    column: str = None,
+    range_loader: Callable[[str, pd.Timestamp, pd.Timestamp], pd.DataFrame] = None,
+) -> pd.DataFrame:
+    """
+    Gets a copy of a dataset, or of the rows in [start, end) of it, from the cache.
+
+    On a miss, the full dataset is loaded with `loader` and cached. If only a range
+    was requested and a `range_loader` is given, only that range is loaded instead,
+    and it is not cached.
+
+    Args:
+        path (str): The path of the dataset file.
+        loader (Callable[[str], pd.DataFrame]): Loads the full dataset from the path.
+        start (pd.Timestamp, optional): The first timestamp to include.
+        end (pd.Timestamp, optional): The first timestamp not to include.
+        column (str, optional): The timestamp column the dataset is sorted by. Defaults to the index.
+        range_loader (Callable, optional): Loads the rows in [start, end) from the path.
+
+    Returns:
+        pd.DataFrame: The requested rows.
+    """
+    df = get(path, start=start, end=end, column=column)
+    if df is not None:
+        return df
+
+    if range_loader is not None and (start is not None or end is not None):
+        return range_loader(path, start, end)
+
+    df = loader(path)
+    put(path, df)
+    return _slice(df, start, end, column)
+
+
+def invalidate(path: str = None) -> None:
+    """
+    Drops a dataset from the cache, or all of them if no path is given.
+    """
+    with _lock:
+        if path is None:
+            _entries.clear()
+        else:
+            _entries.pop(path, None)
+
+
+def stats() -> dict[str, int]:
+    """
+    Gets the number of hits, misses and evictions, and the current number of
+    datasets and bytes in the cache.
+    """
+    with _lock:
+        return {
+            **_stats,
+            "datasets": len(_entries),
+            "bytes": sum(size for _, size, _ in _entries.values()),
+        }
@@ -0,0 +1,117 @@
+import os
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+# Whether the loaders convert the datasets to compact dtypes, see `apply`
+ENABLED = os.getenv("EREDES_OMIE_COMPACT", "") == "1"
+
+# Maximum share of distinct values of a text column converted to categorical
+MAX_CATEGORY_RATIO = 0.5
+
+# Precision kept by the compact dtypes:
+#
+# - Timestamps are datetime64 in UTC, which are int64 epoch offsets underneath,
+#   8 bytes per value with no loss. Text and object timestamps are converted.
+# - Numbers are float32, 4 bytes per value instead of 9 for the nullable Float64
+#   (value and mask) or 8 for float64. float32 keeps 24 bits of mantissa, so the
+#   relative error is at most 2**-24 (6e-8): an energy below 8 kWh (or 8000 Wh)
+#   is off by at most 2.4e-7 kWh (Wh), and rounding it to 6 (3) decimals gives
+#   back the saved value. Missing values become NaN.
+#   Sums over many values must be computed in float64, see `to_float64`.
+# - Text columns with few distinct values are categorical, 1 to 4 bytes per
+#   value and one copy of each label.
+#
+# Scaled integers would be exact, but every consumer would then need to know the
+# scale of each column, so the float32 columns keep their names and units.
+PRECISION = {"float32_relative_error": 2.0**-24}
+
+
+def compact(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts a DataFrame to compact dtypes, see `PRECISION`.
+    """
+    df = df.copy()
+
+    if not isinstance(df.index, pd.DatetimeIndex) and df.index.dtype == object:
+        try:
+            df.index = pd.to_datetime(df.index, utc=True)
+        except (TypeError, ValueError):
+            pass
+
+    for column in df.columns:
+        series = df[column]
+        if pd.api.types.is_bool_dtype(series.dtype):
+            continue
+        if pd.api.types.is_numeric_dtype(series.dtype):
+            df[column] = series.astype("float32")
+        elif pd.api.types.is_object_dtype(series.dtype) or pd.api.types.is_string_dtype(
+            series.dtype
+        ):
+            if series.nunique() <= MAX_CATEGORY_RATIO * len(series):
+                df[column] = series.astype("category")
+
+    return df
+
+
+def apply(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts a DataFrame to compact dtypes if the compact mode is enabled with
+    the EREDES_OMIE_COMPACT=1 environment variable, or returns it unchanged.
+    """
+    return compact(df) if ENABLED else df
+
+
+def to_float64(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts the float32 columns back to float64, before summing many values.
+    """
+    columns = df.select_dtypes("float32").columns
+    return df.astype({column: "float64" for column in columns})
+
+
+def memory_usage(df: pd.DataFrame) -> int:
+    """
+    The bytes used by a DataFrame, its index and the contents of its objects included.
+    """
+    return int(df.memory_usage(deep=True, index=True).sum())
+
+
+def benchmark(loaders: dict[str, Callable[[], pd.DataFrame]]) -> pd.DataFrame:
+    """
+    Compares the memory used by datasets in their current dtypes and in the
+    compact dtypes, and the largest error of the compact values.
+
+    Args:
+        loaders (dict[str, Callable[[], pd.DataFrame]]): Load each dataset in its current dtypes, by name.
+
+    Returns:
+        pd.DataFrame: The rows, current and compact MiB, ratio and maximum absolute error of each dataset.
+    """
+    rows = []
+    for name, loader in loaders.items():
+        df = loader()
+        compact_df = compact(df)
+
+        numeric = df.select_dtypes("number").columns
+        if len(numeric) > 0:
+            current = df[numeric].astype("float64").to_numpy()
+            converted = compact_df[numeric].astype("float64").to_numpy()
+            error = float(np.nanmax(np.abs(current - converted), initial=0.0))
+        else:
+            error = 0.0
+
+        current_bytes, compact_bytes = memory_usage(df), memory_usage(compact_df)
+        rows.append(
+            {
+                "dataset": name,
+                "rows": len(df),
+                "current_MiB": current_bytes / 2**20,
+                "compact_MiB": compact_bytes / 2**20,
+                "ratio": current_bytes / max(compact_bytes, 1),
+                "max_abs_error": error,
+            }
+        )
+
+    return pd.DataFrame(rows).set_index("dataset")
@@ -0,0 +1,212 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import utils
+
+# Directory where the coverage bitmaps are saved
+COVERAGE_DIR = utils.data_path("coverage")
+
+# First quarter-hour slot of every bitmap
+EPOCH = pd.Timestamp("2020-01-01", tz="UTC")
+
+# Duration of a slot
+SLOT = pd.Timedelta(minutes=15)
+
+# A 64-bit word with all its slots present
+FULL_WORD = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+# Datasets with a coverage bitmap, and the CSV files it can be rebuilt from
+DATASETS = {
+    "omie": [utils.shared_path("energy_prices.csv")],
+    "repsol": [utils.shared_path("repsol_indexed_prices.csv")],
+    "losses": [utils.shared_path("losses_profiles.csv")],
+    "consumption": [
+        utils.data_path("consumption_history.csv"),
+        utils.data_path("current_month_consumption_history.csv"),
+    ],
+    "shelly": [
+        utils.data_path("shelly", "em_data.grid.csv"),
+        utils.data_path("shelly", "em_data.solar.csv"),
+    ],
+}
+
+
+def slot_index(timestamps) -> np.ndarray:
+    """
+    Converts timestamps into the indexes of their quarter-hour slots since `EPOCH`.
+    """
+    timestamps = pd.DatetimeIndex(timestamps)
+    if timestamps.tz is None:
+        timestamps = timestamps.tz_localize("UTC")
+    return ((timestamps - EPOCH) // SLOT).to_numpy(dtype="int64")
+
+
+def slot_timestamp(index: int) -> pd.Timestamp:
+    """
+    Converts the index of a quarter-hour slot into its starting timestamp.
+    """
+    return EPOCH + SLOT * int(index)
+
+
+def _bitmap_path(dataset: str, coverage_dir: str) -> str:
+    return f"{coverage_dir}/{dataset}.npy"
+
+
+def load(dataset: str, coverage_dir: str = COVERAGE_DIR) -> np.ndarray:
+    """
+    Loads the coverage bitmap of a dataset: bit i of word w is set when slot 64 * w + i is present.
+    """
+    path = _bitmap_path(dataset, coverage_dir)
+    if not os.path.exists(path):
+        return np.zeros(0, dtype=np.uint64)
+    return np.load(path)
+
+
+def save(dataset: str, bitmap: np.ndarray, coverage_dir: str = COVERAGE_DIR) -> None:
+    """
+    Saves the coverage bitmap of a dataset, replacing the previous one at once.
+    """
+    os.makedirs(coverage_dir, exist_ok=True)
+    path = _bitmap_path(dataset, coverage_dir)
+    with open(f"{path}.tmp", "wb") as file:
+        np.save(file, bitmap)
+    os.replace(f"{path}.tmp", path)
+
+
+def mark(
+    dataset: str, timestamps, reset: bool = False, coverage_dir: str = COVERAGE_DIR
+) -> None:
+    """
+    Marks the quarter-hour slots of the given timestamps as present in a dataset.
+
+    Args:
+        dataset (str): The name of the dataset, one of `DATASETS`.
+        timestamps: The timestamps present in the dataset, any precision.
+        reset (bool): If True, clears the bitmap first. Defaults to False.
+        coverage_dir (str): The directory where the bitmaps are saved.
+    """
+    slots = slot_index(timestamps)
+    slots = np.unique(slots[slots >= 0])
+
+    bitmap = np.zeros(0, dtype=np.uint64) if reset else load(dataset, coverage_dir)
+    if len(slots) > 0:
+        # Grow the bitmap to hold the last slot
+        words = int(slots[-1] // 64) + 1
+        if words > len(bitmap):
+            bitmap = np.concatenate([bitmap, np.zeros(words - len(bitmap), np.uint64)])
+
+        np.bitwise_or.at(
+            bitmap, slots // 64, np.left_shift(np.uint64(1), (slots % 64).astype(np.uint64))
+        )
+
+    save(dataset, bitmap, coverage_dir)
+
+
+def _range_words(
+    bitmap: np.ndarray, start: pd.Timestamp, end: pd.Timestamp
+) -> tuple[np.ndarray, int, int, int]:
+    """
+    Gets the words covering the slots in [start, end), with the first and last
+    partial words masked to the range, and the index of the first word.
+    """
+    first = max(int(slot_index([start])[0]), 0)
+    last = max(int(slot_index([end])[0]), first)
+
+    first_word, last_word = first // 64, -(-last // 64)
+    words = np.zeros(last_word - first_word, dtype=np.uint64)
+
+    # Copy the words present in the bitmap, the rest are missing
+    available = bitmap[first_word : min(last_word, len(bitmap))]
+    words[: len(available)] = available
+
+    # Mask out the slots before the start and after the end of the range
+    if len(words) > 0:
+        words[0] &= FULL_WORD << np.uint64(first % 64)
+        if last % 64:
+            words[-1] &= FULL_WORD >> np.uint64(64 - last % 64)
+
+    return words, first_word, first, last
+
+
+def count(
+    dataset: str, start: pd.Timestamp, end: pd.Timestamp, coverage_dir: str = COVERAGE_DIR
+) -> int:
+    """
+    Counts the slots present in [start, end), one 64-slot word at a time.
+    """
+    words, _, _, _ = _range_words(load(dataset, coverage_dir), start, end)
+    return int(np.unpackbits(words.view(np.uint8)).sum())
+
+
+def gaps(
+    dataset: str,
+    start: pd.Timestamp,
+    end: pd.Timestamp,
+    coverage_dir: str = COVERAGE_DIR,
+) -> list[tuple[pd.Timestamp, pd.Timestamp]]:
+    """
+    Finds the missing ranges of slots in [start, end).
+
+    Only the words with a missing slot are unpacked, so a fully covered range is
+    answered one 64-slot word at a time.
+
+    Returns:
+        list[tuple[pd.Timestamp, pd.Timestamp]]: The [start, end) of each missing range.
+    """
+    words, first_word, first, last = _range_words(
+        load(dataset, coverage_dir), start, end
+    )
+    if last <= first:
+        return []
+
+    # Mark the slots outside the range as present, so that they are never a gap
+    words[0] |= ~(FULL_WORD << np.uint64(first % 64))
+    if last % 64:
+        words[-1] |= ~(FULL_WORD >> np.uint64(64 - last % 64))
+
+    # Unpack only the words with a missing slot
+    partial = np.flatnonzero(words != FULL_WORD)
+    bits = np.unpackbits(words[partial].view(np.uint8), bitorder="little").reshape(-1, 64)
+    rows, columns = np.nonzero(bits == 0)
+    missing = (first_word + partial[rows]) * 64 + columns
+
+    if len(missing) == 0:
+        return []
+
+    # Group the consecutive missing slots into ranges
+    breaks = np.flatnonzero(np.diff(missing) != 1)
+    starts = np.concatenate([[missing[0]], missing[breaks + 1]])
+    ends = np.concatenate([missing[breaks], [missing[-1]]]) + 1
+
+    return [(slot_timestamp(s), slot_timestamp(e)) for s, e in zip(starts, ends)]
+
+
+def first_slot(dataset: str, coverage_dir: str = COVERAGE_DIR) -> pd.Timestamp | None:
+    """
+    Gets the timestamp of the first slot present in a dataset, if any.
+    """
+    bitmap = load(dataset, coverage_dir)
+    words = np.flatnonzero(bitmap)
+    if len(words) == 0:
+        return None
+
+    bits = np.unpackbits(bitmap[words[0] : words[0] + 1].view(np.uint8), bitorder="little")
+    return slot_timestamp(words[0] * 64 + int(np.argmax(bits)))
+
+
+def rebuild(dataset: str, coverage_dir: str = COVERAGE_DIR) -> None:
+    """
+    Rebuilds the coverage bitmap of a dataset from the timestamps of its CSV files.
+    """
+    timestamps = []
+    for path in DATASETS[dataset]:
+        if os.path.exists(path):
+            df = pd.read_csv(path, usecols=[0])
+            timestamps.append(pd.to_datetime(df.iloc[:, 0], utc=True))
+
+    if len(timestamps) == 0:
+        return
+
+    mark(dataset, pd.concat(timestamps), reset=True, coverage_dir=coverage_dir)
@@ -0,0 +1,382 @@
+from dataclasses import dataclass
+import json
+import os
+import time
+from typing import Callable
+
+import pandas as pd
+
+import cache
+import dashboard
+import energy_meters.shelly as shelly
+import export
+import ledger
+import metrics
+import plot
+import reconcile
+import rollups
+import utils
+from e_redes import consumption_history
+from erse import losses_profiles
+from omie import energy_prices
+from providers import repsol
+
+# File where the daemon reports the last run of each job and stage
+STATUS_PATH = utils.data_path("daemon_status.json")
+
+# Local time of the schedules
+TIMEZONE = "Europe/Lisbon"
+
+# OMIE publishes the day-ahead prices around 13:00 in Madrid
+OMIE_TIMEZONE = "Europe/Madrid"
+OMIE_PUBLICATION = pd.Timedelta(hours=13)
+
+# Delay between checks while the day-ahead prices are not published, and after a failed job
+RETRY = pd.Timedelta(minutes=15)
+
+# Longest sleep between two checks of the schedules, so that clock changes are noticed
+MAX_SLEEP_SECONDS = 300
+
+
+@dataclass
+class Job:
+    """
+    Dataclass to represent a source updated by the daemon on its own cadence.
+
+    The source updated when any of its `paths` changed after a run, and then
+    its downstream `stages` run once all the due jobs ran.
+    """
+
+    name: str
+    run: Callable[[bool], None]
+    next_run: Callable[[pd.Timestamp, pd.Timestamp | None], pd.Timestamp]
+    paths: list[str]
+    stages: list[str]
+
+
+def _local_time(day: pd.Timestamp, time_of_day: pd.Timedelta, timezone: str) -> pd.Timestamp:
+    """
+    The UTC timestamp of a local wall-clock time of the local day of a
+    timestamp, the first one where the clocks go back.
+    """
+    local_day = day.tz_convert(timezone).tz_localize(None).normalize()
+    wall = (local_day + time_of_day).tz_localize(
+        timezone, ambiguous=True, nonexistent="shift_forward"
+    )
+    return wall.tz_convert("UTC")
+
+
+def _omie_next_run(now: pd.Timestamp, last: pd.Timestamp | None) -> pd.Timestamp:
+    """
+    Around the day-ahead publication: every `RETRY` from the publication time
+    until tomorrow's prices are available, then at the publication time of the next day.
+    """
+    if last is None:
+        return now
+
+    publication = _local_time(now, OMIE_PUBLICATION, OMIE_TIMEZONE)
+    if energy_prices.is_available(utils.tomorrow()):
+        return _local_time(
+            now + pd.Timedelta(days=1), OMIE_PUBLICATION, OMIE_TIMEZONE
+        )
+    if now < publication:
+        return publication
+    return last + RETRY
+
+
+def _shelly_next_run(now: pd.Timestamp, last: pd.Timestamp | None) -> pd.Timestamp:
+    """
+    Hourly, five minutes after the hour so that the last quarter-hour is logged.
+    """
+    if last is None:
+        return now
+    return last.floor("1h") + pd.Timedelta(hours=1, minutes=5)
+
+
+def _e_redes_next_run(now: pd.Timestamp, last: pd.Timestamp | None) -> pd.Timestamp:
+    """
+    Daily at 08:00, after E-REDES publishes the readings of the previous day.
+    """
+    if last is None:
+        return now
+    return _local_time(last + pd.Timedelta(days=1), pd.Timedelta(hours=8), TIMEZONE)
+
+
+def _erse_next_run(now: pd.Timestamp, last: pd.Timestamp | None) -> pd.Timestamp:
+    """
+    Yearly, on the first day of the year, when the new losses profiles apply.
+    """
+    if last is None:
+        return now
+    new_year = pd.Timestamp(year=last.tz_convert(TIMEZONE).year + 1, month=1, day=1)
+    return new_year.tz_localize(TIMEZONE).tz_convert("UTC") + pd.Timedelta(hours=9)
+
+
+def _update_prices(debug: bool = False) -> None:
+    # Parse the files again only if a new day was downloaded
+    available_dates = energy_prices.get_available_dates()
+    energy_prices.check_and_download()
+    if energy_prices.get_available_dates() != available_dates:
+        energy_prices.update_prices()
+        repsol.update_prices()
+
+
+def _update_shelly(debug: bool = False) -> None:
+    # Downloads both channels and saves the quarter-hour history
+    shelly.process_energy_history(debug=debug)
+
+
+def _update_consumption_history(debug: bool = False) -> None:
+    # The previous month is complete on the second day of the month
+    consumption_history.download(previous_month=utils.today().day == 2, debug=debug)
+    consumption_history.process_consumption_history()
+    consumption_history.process_current_month_consumption_history()
+
+
+def _update_losses(debug: bool = False) -> None:
+    # The Repsol prices include the losses
+    losses_profiles.update_losses_profiles()
+    repsol.update_prices()
+
+
+JOBS = [
+    Job(
+        name="omie",
+        run=_update_prices,
+        next_run=_omie_next_run,
+        paths=[
+            utils.shared_path("energy_prices.csv"),
+            utils.shared_path("repsol_indexed_prices.csv"),
+        ],
+        stages=[
+            "rollups",
+            "ledger",
+            "prices_plot",
+            "weekly_plot",
+            "dashboard",
+            "export",
+        ],
+    ),
+    Job(
+        name="shelly",
+        run=_update_shelly,
+        next_run=_shelly_next_run,
+        paths=[utils.data_path("shelly_energy_history.csv")],
+        stages=[
+            "rollups",
+            "ledger",
+            "reconcile",
+            "weekly_plot",
+            "dashboard",
+            "export",
+        ],
+    ),
+    Job(
+        name="e_redes",
+        run=_update_consumption_history,
+        next_run=_e_redes_next_run,
+        paths=[
+            utils.data_path("consumption_history.csv"),
+            utils.data_path("current_month_consumption_history.csv"),
+        ],
+        stages=[
+            "rollups",
+            "reconcile",
+            "weekly_plot",
+            "dashboard",
+            "export",
+        ],
+    ),
+    Job(
+        name="erse",
+        run=_update_losses,
+        next_run=_erse_next_run,
+        paths=[
+            utils.shared_path("losses_profiles.csv"),
+            utils.shared_path("repsol_indexed_prices.csv"),
+        ],
+        stages=[
+            "rollups",
+            "ledger",
+            "prices_plot",
+            "weekly_plot",
+            "dashboard",
+            "export",
+        ],
+    ),
+]
+
+# Downstream stages, in the order they run
+STAGES: dict[str, Callable[[bool], None]] = {
+    "rollups": lambda debug: rollups.update_all(debug=debug),
+    "ledger": lambda debug: ledger.update_daily_costs(debug=debug),
+    "reconcile": lambda debug: reconcile.update_daily(debug=debug),
+    "prices_plot": lambda debug: plot.providers_indexed_prices(debug=debug),
+    "weekly_plot": lambda debug: plot.weekly_energy_consumption(debug=debug),
+    "dashboard": lambda debug: dashboard.build(debug=debug),
+    "export": lambda debug: export.export(debug=debug),
+}
+
+
+def _versions(paths: list[str]) -> list[tuple[int, int] | None]:
+    """The modification time and size of each file, None if it does not exist."""
+    return [
+        (os.stat(path).st_mtime_ns, os.stat(path).st_size) if os.path.exists(path) else None
+        for path in paths
+    ]
+
+
+def load_status(path: str = STATUS_PATH) -> dict:
+    """
+    Loads the status saved by the daemon, empty if it never ran.
+    """
+    if not os.path.exists(path):
+        return {"jobs": {}, "stages": {}}
+    with open(path) as file:
+        return json.load(file)
+
+
+def _save_status(status: dict, path: str) -> None:
+    # Write to a temporary file first, so that readers never see a partial file
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(status, file, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def _timed(
+    name: str, function: Callable[[bool], None], entry: dict, debug: bool
+) -> bool:
+    """
+    Runs a job or stage and records its start, duration and result in its
+    status entry. Errors are recorded and not raised, so the daemon keeps going.
+
+    Returns:
+        bool: True if it ran without errors.
+    """
+    started = pd.Timestamp.now(tz="UTC")
+    start = time.perf_counter()
+    try:
+        function(debug)
+        entry["last_result"] = "ok"
+    except Exception as e:
+        entry["last_result"] = f"error: {e}"
+        print(f"\n{name} failed: {e}")
+    entry["last_start"] = started.isoformat()
+    entry["last_duration_seconds"] = round(time.perf_counter() - start, 3)
+
+    return entry["last_result"] == "ok"
+
+
+def _next_run(job: Job, entry: dict, now: pd.Timestamp) -> pd.Timestamp:
+    last = pd.Timestamp(entry["last_start"]) if "last_start" in entry else None
+    next_run = job.next_run(now, last)
+
+    # Retry failed jobs sooner than their cadence
+    if last is not None and entry.get("last_result", "ok") != "ok":
+        next_run = min(next_run, last + RETRY)
+    return next_run
+
+
+def warm(debug: bool = False) -> None:
+    """
+    Loads the datasets into the cache, so that the stages find them in memory.
+    """
+    for name, loader in [
+        ("omie_prices", energy_prices.get_prices),
+        ("repsol_prices", repsol.get_prices),
+        ("losses", losses_profiles.get_losses_profiles),
+        ("shelly", shelly.get_energy_history),
+    ]:
+        try:
+            loader()
+        except FileNotFoundError:
+            continue
+        if debug:
+            print(f"Warmed {name}")
+
+    if debug:
+        print(f"Cache: {cache.stats()}")
+
+
+def run(
+    _export: bool = False,
+    status_path: str = STATUS_PATH,
+    once: bool = False,
+    debug: bool = False,
+) -> None:
+    """
+    Runs the jobs on their cadences until interrupted, keeping the datasets warm
+    in memory between runs.
+
+    When a job updates its source, the union of the downstream stages of the
+    updated sources runs once, in the order of `STAGES`. The last run of each
+    job and stage, its duration and result, and the next run of each job are
+    saved to the status file after every round, so a restart resumes the cadences.
+    A round that fails outside the jobs and stages is checked again after `RETRY`.
+
+    Args:
+        _export (bool): If True, the Arrow export is one of the stages. Defaults to False.
+        status_path (str): The path to the status file.
+        once (bool): If True, runs the due jobs once and returns. Defaults to False.
+        debug (bool): If True, prints debug information. Defaults to False.
+    """
+    warm(debug=debug)
+    status = load_status(status_path)
+    status["pid"] = os.getpid()
+    status["started"] = pd.Timestamp.now(tz="UTC").isoformat()
+
+    try:
+        while True:
+            now = pd.Timestamp.now(tz="UTC")
+
+            # Check again after `RETRY` if the round fails before saving the next runs
+            next_runs = {job.name: now + RETRY for job in JOBS}
+
+            # Write the metrics of every round, failed ones included
+            try:
+                # Run the due jobs, collecting the stages of the updated sources
+                stages = set()
+                for job in JOBS:
+                    entry = status["jobs"].setdefault(job.name, {})
+                    if _next_run(job, entry, now) > now:
+                        continue
+
+                    versions = _versions(job.paths)
+                    _timed(job.name, job.run, entry, debug)
+                    entry["updated"] = _versions(job.paths) != versions
+                    if entry["updated"]:
+                        stages.update(job.stages)
+
+                if not _export:
+                    stages.discard("export")
+                for stage in STAGES:
+                    if stage in stages:
+                        entry = status["stages"].setdefault(stage, {})
+                        _timed(stage, STAGES[stage], entry, debug)
+
+                # Save the status with the next run of each job
+                now = pd.Timestamp.now(tz="UTC")
+                next_runs = {}
+                for job in JOBS:
+                    entry = status["jobs"].setdefault(job.name, {})
+                    next_runs[job.name] = _next_run(job, entry, now)
+                    entry["next_run"] = next_runs[job.name].isoformat()
+                status["updated"] = now.isoformat()
+                _save_status(status, status_path)
+            except Exception as e:
+                if once:
+                    raise
+                print(f"\nRound failed: {e}")
+            finally:
+                metrics.write(debug=debug)
+
+            if once:
+                return
+
+            # Sleep until the next job is due
+            seconds = (min(next_runs.values()) - now).total_seconds()
+            if debug:
+                print(f"Next run at {min(next_runs.values())}")
+            time.sleep(min(max(seconds, 1), MAX_SLEEP_SECONDS))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,471 @@
+import hashlib
+import html
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import metrics
+import plot
+import rollups
+import utils
+
+# Directory of the generated site, with the pages of each period and their data
+SITE_DIR = utils.output_path("site")
+
+# File where the hash of the data of each page is saved, to rebuild only the changed pages
+MANIFEST = "manifest.json"
+
+# Periods of the pages, and the level of the points of their charts
+PERIODS = {"day": "hour", "week": "hour", "month": "day", "year": "day"}
+
+# Pandas frequencies of the starts of the periods
+FREQUENCIES = {"day": "D", "week": "W-MON", "month": "MS", "year": "YS"}
+
+# Series of the pages and the decimals they are rounded to
+SERIES = {
+    "grid_kWh": 3,
+    "solar_kWh": 3,
+    "consumed_kWh": 3,
+    "cost_€": 4,
+    "€/kWh": 6,
+}
+
+# Charts drawn in the browser from the data of the page, so no image is rendered
+SCRIPT = """\
+(function () {
+  var data = JSON.parse(document.getElementById("data").textContent);
+  if (!data.points || data.points.t.length === 0) return;
+  var charts = [
+    {title: "Energy (kWh)", series: [["grid_kWh", "#1f77b4"], ["solar_kWh", "#ff7f0e"], ["consumed_kWh", "#7f7f7f"]]},
+    {title: "Cost (€)", series: [["cost_€", "#d62728"]]},
+    {title: "Price (€/kWh)", series: [["€/kWh", "#2ca02c"]]}
+  ];
+  var width = 960, height = 220, left = 50, bottom = 20;
+  var t = data.points.t;
+  var t0 = t[0], t1 = t[t.length - 1];
+  charts.forEach(function (chart) {
+    var values = [];
+    chart.series.forEach(function (s) {
+      data.points[s[0]].forEach(function (v) { if (v !== null) values.push(v); });
+    });
+    if (values.length === 0) return;
+    var lo = Math.min(0, Math.min.apply(null, values)), hi = Math.max.apply(null, values);
+    if (hi === lo) hi = lo + 1;
+    var x = function (i) { return left + (t1 > t0 ? (t[i] - t0) / (t1 - t0) : 0) * (width - left); };
+    var y = function (v) { return (height - bottom) * (1 - (v - lo) / (hi - lo)); };
+    var svg = '<svg viewBox="0 0 ' + width + ' ' + height + '" class="chart">';
+    svg += '<line x1="' + left + '" x2="' + width + '" y1="' + y(0) + '" y2="' + y(0) + '" class="axis"/>';
+    svg += '<text x="0" y="12">' + hi.toFixed(3) + '</text><text x="0" y="' + (height - bottom) + '">' + lo.toFixed(3) + '</text>';
+    svg += '<text x="' + left + '" y="' + height + '">' + new Date(t0).toISOString().slice(0, 16) + '</text>';
+    svg += '<text x="' + width + '" y="' + height + '" text-anchor="end">' + new Date(t1).toISOString().slice(0, 16) + '</text>';
+    chart.series.forEach(function (s) {
+      var path = "", pen = "M";
+      data.points[s[0]].forEach(function (v, i) {
+        if (v === null) { pen = "M"; return; }
+        path += pen + x(i).toFixed(1) + "," + y(v).toFixed(1);
+        pen = "L";
+      });
+      svg += '<path d="' + path + '" stroke="' + s[1] + '"><title>' + s[0] + '</title></path>';
+    });
+    svg += "</svg>";
+    var section = document.createElement("section");
+    section.innerHTML = "<h2>" + chart.title + "</h2>" + svg;
+    document.getElementById("charts").appendChild(section);
+  });
+})();
+"""
+
+STYLE = """\
+body { font-family: sans-serif; margin: 2em auto; max-width: 1000px; color: #222; }
+nav a { margin-right: 1em; }
+table { border-collapse: collapse; margin: 1em 0; }
+td, th { border: 1px solid #ccc; padding: 0.2em 0.6em; text-align: right; }
+.chart { width: 100%; height: auto; }
+.chart path { fill: none; stroke-width: 1.5; }
+.chart .axis { stroke: #999; }
+.chart text { font-size: 11px; fill: #555; }
+ul.children { columns: 4; }
+"""
+
+PAGE = """\
+<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<link rel="stylesheet" href="{root}dashboard.css">
+</head>
+<body>
+<nav>{nav}</nav>
+<h1>{title}</h1>
+{body}
+<div id="charts"></div>
+<script id="data" type="application/json">{data}</script>
+<script src="{root}dashboard.js"></script>
+</body>
+</html>
+"""
+
+# Version of the templates, so that every page is rebuilt when they change
+TEMPLATES_HASH = hashlib.sha256((SCRIPT + STYLE + PAGE).encode()).hexdigest()
+
+
+def load_history() -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Loads the hourly and daily points of the pages from the rollups: the grid
+    energy, preferring E-REDES over the Shelly, the solar production, the
+    consumption, the cost of the bought energy and the mean Repsol price.
+
+    The cost of each hour is the sum of the costs of its quarter-hours, each
+    clipped at its own price as in the cost ledger, from the grid_€ rollups.
+
+    Returns:
+        tuple[pd.DataFrame, pd.DataFrame]: The hourly and daily points, with the
+        `SERIES` columns and the price sums and counts, indexed by timestamp.
+    """
+    prices_df = rollups.get("repsol_prices", "hour")
+    energy_df = plot.hourly_energy(prices_df=prices_df)
+
+    hourly_df = pd.DataFrame(
+        {
+            "grid_kWh": energy_df["Grid (kWh)"],
+            "solar_kWh": energy_df["Solar (kWh)"],
+            "consumed_kWh": energy_df["Grid (kWh)"] + energy_df["Solar (kWh)"],
+            "cost_€": energy_df["Grid (€)"],
+        }
+    )
+
+    # Keep the hours with prices but no energy yet, such as tomorrow
+    hourly_df = hourly_df.join(
+        prices_df[["€/kWh_sum", "€/kWh_count"]].astype("float64"), how="outer"
+    )
+    hourly_df.index.name = "starting_datetime"
+
+    # The daily sums, missing if none of the hours of the day have a value
+    daily_df = hourly_df.groupby(hourly_df.index.floor("1D")).sum(min_count=1)
+
+    for df in (hourly_df, daily_df):
+        df["€/kWh"] = df["€/kWh_sum"] / df["€/kWh_count"].where(df["€/kWh_count"] > 0)
+
+    return hourly_df, daily_df
+
+
+def period_start(timestamp: pd.Timestamp, period: str) -> pd.Timestamp:
+    """
+    The start of the period of a timestamp, in UTC days: weeks start on Monday.
+    """
+    day = timestamp.normalize()
+    if period == "day":
+        return day
+    if period == "week":
+        return day - pd.Timedelta(days=day.dayofweek)
+    if period == "month":
+        return day.replace(day=1)
+    if period == "year":
+        return day.replace(month=1, day=1)
+    raise ValueError(f"Invalid period: {period}, expected one of {list(PERIODS)}")
+
+
+def period_end(start: pd.Timestamp, period: str) -> pd.Timestamp:
+    """
+    The start of the period after the one starting at `start`.
+    """
+    if period == "day":
+        return start + pd.Timedelta(days=1)
+    if period == "week":
+        return start + pd.Timedelta(weeks=1)
+    if period == "month":
+        return start + pd.DateOffset(months=1)
+    return start + pd.DateOffset(years=1)
+
+
+def period_key(start: pd.Timestamp, period: str) -> str:
+    """
+    The name of the page of a period: 2024-05-17, 2024-W20, 2024-05 or 2024.
+    """
+    if period == "week":
+        year, week, _ = start.isocalendar()
+        return f"{year}-W{week:02d}"
+    return start.strftime({"day": "%Y-%m-%d", "month": "%Y-%m", "year": "%Y"}[period])
+
+
+def _page_path(period: str, start: pd.Timestamp) -> str:
+    return f"{period}/{period_key(start, period)}.html"
+
+
+def _title(period: str, start: pd.Timestamp) -> str:
+    key = period_key(start, period)
+    if period == "week":
+        last_day = period_end(start, period) - pd.Timedelta(days=1)
+        return f"Week {key} ({start.date()} to {last_day.date()})"
+    return f"{period.capitalize()} {key}"
+
+
+def _points(points_df: pd.DataFrame) -> dict[str, np.ndarray]:
+    """
+    Converts the points to arrays once, as the pages slice them thousands of times.
+    """
+    return {
+        # Milliseconds since the epoch, as JavaScript dates
+        "t": points_df.index.asi8 // 10**6,
+        **{
+            column: points_df[column].to_numpy(dtype="float64")
+            for column in [*SERIES, "€/kWh_sum", "€/kWh_count"]
+        },
+    }
+
+
+def _values(values: np.ndarray, decimals: int) -> list[float | None]:
+    return [None if value != value else value for value in values.round(decimals).tolist()]
+
+
+def _total(values: np.ndarray, decimals: int) -> float:
+    return round(float(np.nansum(values)), decimals)
+
+
+def page_data(
+    points: dict[str, np.ndarray],
+    period: str,
+    start: pd.Timestamp,
+    first: pd.Timestamp,
+    last: pd.Timestamp,
+) -> dict:
+    """
+    Builds the data of the page of a period.
+
+    Args:
+        points (dict[str, np.ndarray]): The hourly or daily points of the period, see `_points`.
+        period (str): One of `PERIODS`.
+        start (pd.Timestamp): The start of the period.
+        first (pd.Timestamp): The first timestamp of the history, to link the previous page.
+        last (pd.Timestamp): The end of the history, to link the next page.
+
+    Returns:
+        dict: The points of the charts, the totals of the period and the links to the other pages.
+    """
+    end = period_end(start, period)
+
+    totals = {
+        column: _total(points[column], SERIES[column])
+        for column in ["grid_kWh", "solar_kWh", "consumed_kWh", "cost_€"]
+    }
+    price_count = np.nansum(points["€/kWh_count"])
+    totals["€/kWh"] = (
+        round(float(np.nansum(points["€/kWh_sum"]) / price_count), SERIES["€/kWh"])
+        if price_count > 0
+        else None
+    )
+
+    # Link the neighbouring periods, and the enclosing and enclosed ones
+    previous_start = period_start(start - pd.Timedelta(days=1), period)
+    links = {
+        "previous": _page_path(period, previous_start)
+        if previous_start >= period_start(first, period)
+        else None,
+        "next": _page_path(period, end) if end < last else None,
+        "up": {
+            "day": _page_path("month", period_start(start, "month")),
+            "week": _page_path("year", period_start(start, "year")),
+            "month": _page_path("year", start),
+            "year": None,
+        }[period],
+    }
+    if period in ("week", "month"):
+        days = pd.date_range(
+            max(start, first.normalize()), min(end, last), freq="D", inclusive="left"
+        )
+        links["children"] = [_page_path("day", day) for day in days]
+    elif period == "year":
+        months = pd.date_range(
+            max(start, period_start(first, "month")), min(end, last), freq="MS", inclusive="left"
+        )
+        links["children"] = [_page_path("month", month) for month in months]
+
+    return {
+        "period": period,
+        "key": period_key(start, period),
+        "title": _title(period, start),
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "points": {
+            "t": points["t"].tolist(),
+            **{column: _values(points[column], decimals) for column, decimals in SERIES.items()},
+        },
+        "totals": totals,
+        "links": links,
+    }
+
+
+def _link(root: str, path: str | None, label: str) -> str:
+    if path is None:
+        return ""
+    return f'<a href="{root}{html.escape(path)}">{html.escape(label)}</a>'
+
+
+def render_page(data: dict, text: str) -> str:
+    """
+    Renders the HTML page of a period, with its data embedded for the charts.
+    """
+    root = "../"
+    links = data["links"]
+    nav = " ".join(
+        link
+        for link in [
+            _link(root, "index.html", "Index"),
+            _link(root, links["up"], "Up"),
+            _link(root, links["previous"], "Previous"),
+            _link(root, links["next"], "Next"),
+        ]
+        if link
+    )
+
+    rows = "".join(
+        f"<tr><th>{html.escape(column)}</th><td>{'' if value is None else value}</td></tr>"
+        for column, value in data["totals"].items()
+    )
+    body = f"<table>{rows}</table>"
+    if "children" in links:
+        items = "".join(
+            f"<li>{_link(root, path, os.path.splitext(os.path.basename(path))[0])}</li>"
+            for path in links["children"]
+        )
+        body += f'<ul class="children">{items}</ul>'
+
+    return PAGE.format(
+        title=html.escape(data["title"]),
+        root=root,
+        nav=nav,
+        body=body,
+        # A closing tag in the data would end the script element
+        data=text.replace("</", "<\\/"),
+    )
+
+
+def render_index(pages: dict[str, list[str]]) -> str:
+    """
+    Renders the index of the site, linking every year and month and the latest pages.
+    """
+    latest = " ".join(
+        _link("", paths[-1], f"Latest {period}") for period, paths in pages.items() if paths
+    )
+    years = "".join(
+        f"<li>{_link('', year, os.path.splitext(os.path.basename(year))[0])}: "
+        + " ".join(
+            _link("", month, os.path.splitext(os.path.basename(month))[0][5:])
+            for month in pages["month"]
+            if os.path.basename(month).startswith(os.path.basename(year)[:4])
+        )
+        + "</li>"
+        for year in reversed(pages["year"])
+    )
+    return PAGE.format(
+        title="Energy dashboard",
+        root="",
+        nav=latest,
+        body=f"<ul>{years}</ul>",
+        data="{}",
+    )
+
+
+def _load_manifest(site_dir: str) -> dict:
+    path = os.path.join(site_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {"templates": None, "pages": {}}
+    with open(path) as file:
+        return json.load(file)
+
+
+def _write(site_dir: str, path: str, text: str) -> None:
+    # Write to a temporary file first, so that readers never see a partial page
+    path = os.path.join(site_dir, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+        file.write(text)
+    os.replace(f"{path}.tmp", path)
+
+
+@metrics.timer("plot_renders", plot="dashboard")
+def build(site_dir: str = SITE_DIR, force: bool = False, debug: bool = False) -> list[str]:
+    """
+    Builds the static dashboard site: a page per day, week, month and year with
+    the prices, consumption, solar production and costs, and an index.
+
+    The data of each page is saved as JSON next to it and hashed, and only the
+    pages whose data changed since the last build are written again, so a daily
+    update rewrites a few pages whatever the length of the history. The charts
+    are drawn by the browser from the data embedded in each page, so no image
+    is rendered.
+
+    Args:
+        site_dir (str): The directory of the site.
+        force (bool): If True, rebuilds every page. Defaults to False.
+        debug (bool): If True, prints debug information. Defaults to False.
+
+    Returns:
+        list[str]: The paths of the pages written, relative to the site directory.
+    """
+    manifest = _load_manifest(site_dir)
+    force = force or manifest["templates"] != TEMPLATES_HASH
+    hashes = manifest["pages"]
+
+    hourly_df, daily_df = load_history()
+    if len(hourly_df) == 0:
+        return []
+    first, last = hourly_df.index[0], hourly_df.index[-1] + pd.Timedelta(hours=1)
+
+    written = []
+    if force:
+        _write(site_dir, "dashboard.js", SCRIPT)
+        _write(site_dir, "dashboard.css", STYLE)
+        written += ["dashboard.js", "dashboard.css"]
+
+    pages = {}
+    for period, level in PERIODS.items():
+        points_df = hourly_df if level == "hour" else daily_df
+        index, points = points_df.index, _points(points_df)
+        starts = pd.date_range(
+            period_start(first, period), last, freq=FREQUENCIES[period], inclusive="left"
+        )
+
+        pages[period] = []
+        for start in starts:
+            path = _page_path(period, start)
+            pages[period].append(path)
+
+            # Binary searches on the sorted index, rather than masks over the whole history
+            rows = slice(
+                index.searchsorted(start), index.searchsorted(period_end(start, period))
+            )
+            period_points = {name: values[rows] for name, values in points.items()}
+
+            data = page_data(period_points, period, start, first, last)
+            text = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+            digest = hashlib.sha256(text.encode()).hexdigest()
+            if not force and hashes.get(path) == digest:
+                continue
+
+            _write(site_dir, f"data/{period}/{data['key']}.json", text)
+            _write(site_dir, path, render_page(data, text))
+            hashes[path] = digest
+            written.append(path)
+
+    index_text = render_index(pages)
+    digest = hashlib.sha256(index_text.encode()).hexdigest()
+    if force or hashes.get("index.html") != digest:
+        _write(site_dir, "index.html", index_text)
+        hashes["index.html"] = digest
+        written.append("index.html")
+
+    _write(
+        site_dir,
+        MANIFEST,
+        json.dumps({"templates": TEMPLATES_HASH, "pages": hashes}, indent=2),
+    )
+
+    if debug:
+        total = sum(len(paths) for paths in pages.values()) + 1
+        print(f"Dashboard: {len(written)} files written, {total} pages in {site_dir}")
+
+    return written
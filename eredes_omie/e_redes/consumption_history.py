@@ -1,16 +1,45 @@
+from __future__ import annotations
+
 from glob import glob
+import json
 import os
+import re
+import shutil
 import time
 import pandas as pd
 import pytz
 
+import coverage
+import metrics
+import rollups
+import utils
 from .months import last_month
 from dotenv import load_dotenv
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.remote.webdriver import WebElement
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.wait import WebDriverWait
+
+# Only the downloads drive a browser, the saved exports are processed without it
+try:
+    from selenium import webdriver
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.remote.webdriver import WebElement
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.wait import WebDriverWait
+except ImportError:
+    webdriver = None
+
+# Directory of the current month exports of the account, moved there out of the
+# downloads directory of the browser, which the accounts may share
+EXPORTS_DIR = utils.data_path("exports")
+
+# Format of a meter point (CPE): PT, 16 digits and 2 check letters
+METER_POINT_PATTERN = re.compile(r"PT\d{16}[A-Z]{2}")
+
+
+def _require_selenium() -> None:
+    if webdriver is None:
+        raise ImportError(
+            "The E-REDES downloads need selenium, install the dependencies with "
+            "`poetry install`"
+        )
 
 
 def get_driver(debug: bool = False) -> webdriver.Remote:
@@ -25,6 +54,8 @@ def get_driver(debug: bool = False) -> webdriver.Remote:
     Returns:
         webdriver.Remote: The connected WebDriver instance.
     """
+    _require_selenium()
+
     # Creating a FirefoxOptions object
     options = webdriver.FirefoxOptions()
 
@@ -71,6 +102,30 @@ def get_credentials() -> tuple[str, str]:
     return eredes_username, eredes_password
 
 
+def get_meter_point() -> str:
+    """
+    Retrieves the meter point (CPE) of the account from the "EREDES_METER_POINT"
+    environment variable, empty for the first meter point of the account.
+    """
+    return check_meter_point(os.getenv("EREDES_METER_POINT", ""))
+
+
+def check_meter_point(meter_point: str) -> str:
+    """
+    Checks that a meter point (CPE) is empty or well formed, as it is placed
+    in the XPath of its card.
+
+    Raises:
+        ValueError: If the meter point is not PT, 16 digits and 2 letters.
+    """
+    if meter_point and not METER_POINT_PATTERN.fullmatch(meter_point):
+        raise ValueError(
+            f"Invalid meter point (CPE): {meter_point!r}, "
+            "expected PT, 16 digits and 2 letters"
+        )
+    return meter_point
+
+
 def find_element(
     driver: webdriver.Remote, by: By, value: str, delay: int = 5
 ) -> WebElement:
@@ -121,10 +176,15 @@ def login_to_eredes(
     ).click()
 
 
-def navigate_to_history(driver: webdriver.Remote) -> None:
-    """Navigates to the consumption history page."""
+def navigate_to_history(driver: webdriver.Remote, meter_point: str = "") -> None:
+    """
+    Navigates to the consumption history page of a meter point (CPE), or of the
+    first one of the account if none is given.
+    """
+    meter_point = check_meter_point(meter_point)
+    card = f"//nz-card[contains(., '{meter_point}')]" if meter_point else "//nz-card"
     find_element(
-        driver=driver, by=By.XPATH, value="//nz-card/div/div[2]/div", delay=120
+        driver=driver, by=By.XPATH, value=f"{card}/div/div[2]/div", delay=120
     ).click()
 
 
@@ -221,66 +281,91 @@ def download(previous_month: bool = False, debug: bool = False) -> None:
     # Get the URL for Eredes consumption history
     eredes_consumption_history_url = os.getenv("EREDES_CONSUMPTION_HISTORY_URL") or ""
 
-    # Get the web driver
-    driver = get_driver(debug)
+    # Get the meter point first, so an invalid one fails before logging in
+    meter_point = get_meter_point()
 
-    # If the driver is None, exit the function
-    if driver is None:
-        return None
-
-    try:
-        # Open the Eredes consumption history URL
-        driver.get(eredes_consumption_history_url)
+    # The browser saves every export of the day with the same name, so runs
+    # sharing the downloads directory take turns, and each one moves its
+    # exports to the directory of its account before the next one runs
+    exported_path = os.path.join(
+        utils.DOWNLOADS_DIR, f"Consumos_{pd.Timestamp.today():%Y%m%d}.xlsx"
+    )
+    current_month_path = os.path.join(
+        EXPORTS_DIR, f"Consumos_{pd.Timestamp.today():%Y%m}.xlsx"
+    )
+    os.makedirs(EXPORTS_DIR, exist_ok=True)
+    start = time.perf_counter()
+    with utils.file_lock(os.path.join(utils.DOWNLOADS_DIR, ".lock")):
+        # Remove the export left by a failed run, which may be of another account
+        if os.path.exists(exported_path):
+            os.remove(exported_path)
 
-        if driver.current_url != eredes_consumption_history_url:
-            raise Exception("Invalid URL")
+        # Get the web driver
+        driver = get_driver(debug)
 
-        # Access the E-Redes login page
-        access_eredes_login_page(driver)
+        # If the driver is None, exit the function
+        if driver is None:
+            return None
 
-        # Log into Eredes
-        login_to_eredes(driver, eredes_username, eredes_password)
+        try:
+            # Open the Eredes consumption history URL
+            driver.get(eredes_consumption_history_url)
 
-        # Navigate to the consumption history page
-        navigate_to_history(driver)
+            if driver.current_url != eredes_consumption_history_url:
+                raise Exception("Invalid URL")
 
-        # Export the consumption history to Excel
-        export_to_excel(driver)
+            # Access the E-Redes login page
+            access_eredes_login_page(driver)
 
-        # remove the previous file
-        if os.path.exists(f"./downloads/Consumos_{pd.Timestamp.today():%Y%m}.xlsx"):
-            os.remove(f"./downloads/Consumos_{pd.Timestamp.today():%Y%m}.xlsx")
+            # Log into Eredes
+            login_to_eredes(driver, eredes_username, eredes_password)
 
-        # rename the file
-        os.rename(
-            f"./downloads/Consumos_{pd.Timestamp.today():%Y%m%d}.xlsx",
-            f"./downloads/Consumos_{pd.Timestamp.today():%Y%m}.xlsx",
-        )
-
-        # If a specific month is provided
-        if previous_month:
-            # Select the previous month on the webpage
-            month = last_month()
-            select_month(driver, month["month"], month["year"])
+            # Navigate to the consumption history page of the meter point
+            navigate_to_history(driver, meter_point)
 
             # Export the consumption history to Excel
             export_to_excel(driver)
 
-            # rename the file
-            os.rename(
-                f"./downloads/Consumos_{pd.Timestamp.today():%Y%m%d}.xlsx",
-                f"./data/consumption_history/Consumos_{month['year']:04}{month['month']:02}.xlsx",
-            )
+            # remove the previous file
+            if os.path.exists(current_month_path):
+                os.remove(current_month_path)
 
-    except Exception as e:
-        # Log the error
-        print(f"\nError downloading: {e}")
+            # move the file to the exports of the account
+            shutil.move(exported_path, current_month_path)
+
+            size = os.path.getsize(current_month_path)
+
+            # If a specific month is provided
+            if previous_month:
+                # Select the previous month on the webpage
+                month = last_month()
+                select_month(driver, month["month"], month["year"])
+
+                # Export the consumption history to Excel
+                export_to_excel(driver)
 
-        # Quit the driver
-        driver.quit()
+                # rename the file
+                previous_month_path = utils.data_path(
+                    "consumption_history",
+                    f"Consumos_{month['year']:04}{month['month']:02}.xlsx",
+                )
+                shutil.move(exported_path, previous_month_path)
+                size += os.path.getsize(previous_month_path)
+
+            metrics.record_download("e_redes", time.perf_counter() - start, size)
+
+        except Exception as e:
+            # Log the error
+            print(f"\nError downloading: {e}")
+            metrics.record_download(
+                "e_redes", time.perf_counter() - start, 0, status="error"
+            )
+
+            # Quit the driver
+            driver.quit()
 
-        # Re-raise the exception
-        raise
+            # Re-raise the exception
+            raise
 
     # Add a small delay before quitting driver
     time.sleep(5)
@@ -289,88 +374,223 @@ def download(previous_month: bool = False, debug: bool = False) -> None:
     driver.quit()
 
 
-def process_consumption_history() -> None:
+# Files of the E-REDES readings: the closed months and the current month
+HISTORY_PATH = utils.data_path("consumption_history.csv")
+CURRENT_MONTH_PATH = utils.data_path("current_month_consumption_history.csv")
+
+# Version of each export already upserted into the files, by path
+PROCESSED_PATH = utils.data_path("consumption_history", "processed.json")
+
+
+def _load_processed() -> dict[str, list[int]]:
+    if not os.path.exists(PROCESSED_PATH):
+        return {}
+    with open(PROCESSED_PATH) as file:
+        return json.load(file)
+
+
+def _save_processed(processed: dict[str, list[int]]) -> None:
+    # Write to a temporary file first, so that readers never see a partial file
+    os.makedirs(os.path.dirname(PROCESSED_PATH), exist_ok=True)
+    with open(f"{PROCESSED_PATH}.tmp", "w") as file:
+        json.dump(processed, file, indent=2)
+    os.replace(f"{PROCESSED_PATH}.tmp", PROCESSED_PATH)
+
+
+def _version(path: str) -> list[int]:
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def upsert(path: str, df: pd.DataFrame) -> int:
     """
-    Processes the consumption history monthly data.
-    Loads all the Excel files in data/consumption_history into a Pandas DataFrame and saves it to a CSV file.
+    Upserts readings into a CSV file sorted by starting_datetime: the readings
+    replace the ones of the same quarter-hour slots, and are added otherwise.
+
+    Only the tail of the file from the first slot of the readings is parsed
+    and merged, so the cost depends on the readings and not on the length of
+    the history. The head of the file is copied as is, and the file is replaced
+    by the copy with the merged tail, so a crash never loses readings already
+    marked as processed.
+
+    Args:
+        path (str): The path to the CSV file.
+        df (pd.DataFrame): The readings, with the last one of each slot winning.
+
+    Returns:
+        int: The number of readings upserted.
     """
-    # Get the list of consumption history files
-    files = sorted(glob("/workspace/data/consumption_history/Consumos_*.xlsx"))
-
-    # Initialize a list of dataframes
-    dfs = []
-
-    # Loop through the files
-    for file in files:
-        # print(f"\nProcessing {file}")
-        # Load the file into a dataframe
-        df = pd.read_excel(
-            file,
-            sheet_name="Leituras",
-            skiprows=14,
+    df = df.sort_values("starting_datetime", kind="stable")
+    df = df.drop_duplicates("starting_datetime", keep="last")
+    if len(df) == 0:
+        return 0
+
+    if not os.path.exists(path):
+        df.to_csv(f"{path}.tmp", index=False)
+        os.replace(f"{path}.tmp", path)
+        return len(df)
+
+    # Merge the tail of the file with the readings, the readings winning
+    start = df["starting_datetime"].iloc[0]
+    offset = utils.csv_offset(path, start)
+    old_df = utils.read_csv_range(path, start=start, parse_dates=["starting_datetime"])
+    old_df = old_df[~old_df["starting_datetime"].isin(df["starting_datetime"])]
+    merged_df = pd.concat([old_df, df]) if len(old_df) > 0 else df
+    merged_df = merged_df.sort_values("starting_datetime", kind="stable")
+
+    # Copy the head of the file to a temporary file, append the merged readings,
+    # and replace the file with it
+    with open(path, "rb") as file, open(f"{path}.tmp", "wb") as tmp_file:
+        remaining = offset
+        while remaining > 0:
+            block = file.read(min(remaining, 1 << 20))
+            tmp_file.write(block)
+            remaining -= len(block)
+    merged_df.to_csv(f"{path}.tmp", mode="a", header=False, index=False)
+    os.replace(f"{path}.tmp", path)
+
+    return len(df)
+
+
+def _upsert_readings(df: pd.DataFrame) -> None:
+    """
+    Upserts readings into the file of their month: the current month file, or
+    the history for the closed months. The readings of a month that closed since
+    the last run are moved from the current month file to the history first.
+    """
+    month_start = utils.today().replace(day=1)
+
+    # Move the readings of the closed months out of the current month file
+    if os.path.exists(CURRENT_MONTH_PATH):
+        closed_df = utils.read_csv_range(
+            CURRENT_MONTH_PATH, end=month_start, parse_dates=["starting_datetime"]
         )
+        if len(closed_df) > 0:
+            upsert(HISTORY_PATH, closed_df)
+            current_df = utils.read_csv_range(
+                CURRENT_MONTH_PATH, start=month_start, parse_dates=["starting_datetime"]
+            )
+            current_df.to_csv(f"{CURRENT_MONTH_PATH}.tmp", index=False)
+            os.replace(f"{CURRENT_MONTH_PATH}.tmp", CURRENT_MONTH_PATH)
+
+    upsert(HISTORY_PATH, df[df["starting_datetime"] < month_start])
+    upsert(CURRENT_MONTH_PATH, df[df["starting_datetime"] >= month_start])
 
-        # Append the dataframe to the list
-        dfs.append(df)
 
-    # Concatenate the dataframes
+def process_exports(
+    files: list[str], workers: int = None, rebuild: bool = False
+) -> pd.DataFrame:
+    """
+    Upserts the readings of the E-REDES exports not processed yet, or changed
+    since they were processed, into the files of their months.
+
+    The exports are applied from the oldest to the most recent, so where they
+    overlap the most recent export wins, and each export is parsed only once.
+
+    Args:
+        files (list[str]): The paths to the Excel exports.
+        workers (int, optional): The number of processes parsing the files. Defaults to the number of CPUs.
+        rebuild (bool): If True, processes every export again, the caller rebuilding the rollups. Defaults to False.
+
+    Returns:
+        pd.DataFrame: The readings upserted.
+    """
+    processed = {} if rebuild else _load_processed()
+    files = sorted(
+        (file for file in files if processed.get(file) != _version(file)),
+        key=os.path.getmtime,
+    )
+    if len(files) == 0:
+        return pd.DataFrame(
+            columns=["starting_datetime", "consumption_kwh", "injection_kwh"]
+        )
+
+    # Parse and process the files in parallel, then concatenate them in order
+    dfs = utils.read_excel_files(
+        files,
+        transform=process_dataframe,
+        workers=workers,
+        sheet_name="Leituras",
+        skiprows=14,
+    )
     df = pd.concat(dfs)
+    metrics.inc("rows_parsed_total", len(df), stage="consumption")
 
-    # Process the dataframe and save it to a CSV file
-    df = process_dataframe(df)
+    # The versions before the upserts concatenated the exports as they came, so
+    # sort their files once before the upserts bisect them
+    if not os.path.exists(PROCESSED_PATH):
+        for path in (HISTORY_PATH, CURRENT_MONTH_PATH):
+            if os.path.exists(path):
+                utils.sort_csv(path)
 
-    # Save the dataframe to a CSV file
-    df.to_csv("./data/consumption_history.csv", index=False)
+    _upsert_readings(df)
 
-    grouped_df = df.copy()
-    grouped_df.index = grouped_df["starting_datetime"]
-    grouped_df.drop("starting_datetime", axis=1, inplace=True)
+    processed.update({file: _version(file) for file in files})
+    _save_processed(processed)
 
-    # Print the sum of the consumption and injection columns by year
-    print(f"\nConsumption and Injection per Year:\n{grouped_df.resample("1YE").sum()}")
+    # Aggregate the rollups again from the first reading upserted, as a later
+    # export may revise readings already rolled up, unless they are rebuilt
+    if not rebuild:
+        rollups.revise("consumption", df["starting_datetime"].min())
+
+    # Mark the slots of the readings as present
+    coverage.mark("consumption", df["starting_datetime"])
+
+    return df
 
 
-def process_current_month_consumption_history() -> None:
+def process_consumption_history(workers: int = None, rebuild: bool = False) -> None:
     """
-    Processes thec current month consumption history data.
-    Loads the Excel file in downloads into a Pandas DataFrame and saves it to a CSV file.
+    Processes the consumption history monthly data.
+    Upserts the new Excel files in data/consumption_history into the CSV files.
+
+    Args:
+        workers (int, optional): The number of processes parsing the files. Defaults to the number of CPUs.
+        rebuild (bool): If True, rewrites the CSV files and their rollups from every export. Defaults to False.
     """
     # Get the list of consumption history files
-    files = sorted(glob("/workspace/downloads/*.xlsx"))
-
-    # Initialize a list of dataframes
-    dfs = []
-
-    # Loop through the files
-    for file in files:
-        # print(f"\nProcessing {file}")
-        # Load the file into a dataframe
-        df = pd.read_excel(
-            file,
-            sheet_name="Leituras",
-            skiprows=14,
-        )
+    files = sorted(glob(utils.data_path("consumption_history", "Consumos_*.xlsx")))
 
-        # Append the dataframe to the list
-        dfs.append(df)
+    if rebuild:
+        for path in (HISTORY_PATH, CURRENT_MONTH_PATH):
+            if os.path.exists(path):
+                os.remove(path)
+        files += sorted(glob(os.path.join(EXPORTS_DIR, "*.xlsx")))
 
-    # Concatenate the dataframes
-    df = pd.concat(dfs)
+    process_exports(files, workers=workers, rebuild=rebuild)
 
-    # Process the dataframe and save it to a CSV file
-    df = process_dataframe(df)
+    # Rebuild the rollups from the rewritten files
+    if rebuild:
+        rollups.rebuild("consumption")
 
-    # Save the dataframe to a CSV file
-    df.to_csv("./data/current_month_consumption_history.csv", index=False)
+    # Print the sum of the consumption and injection columns by year
+    yearly_df = rollups.get("consumption", "year")[
+        ["consumption_kwh_sum", "injection_kwh_sum"]
+    ]
+    yearly_df.columns = ["consumption_kwh", "injection_kwh"]
+    print(f"\nConsumption and Injection per Year:\n{yearly_df}")
 
-    month_df = df.copy()
-    month_df.index = month_df["starting_datetime"]
-    month_df.drop("starting_datetime", axis=1, inplace=True)
 
-    # Print the sum of the consumption and injection columns by year
-    print(
-        f"\nCurrent month Consumption and Injection:\n{month_df.resample("1ME").sum()}"
-    )
+def process_current_month_consumption_history(workers: int = None) -> None:
+    """
+    Processes the current month consumption history data.
+    Upserts the new Excel files in the exports of the account into the CSV files.
+
+    Args:
+        workers (int, optional): The number of processes parsing the files. Defaults to the number of CPUs.
+    """
+    # Get the list of consumption history files
+    files = sorted(glob(os.path.join(EXPORTS_DIR, "*.xlsx")))
+
+    process_exports(files, workers=workers)
+
+    # Print the sum of the consumption and injection columns by month
+    month_start = utils.today().replace(day=1)
+    month_df = rollups.get("consumption", "month", start=month_start)[
+        ["consumption_kwh_sum", "injection_kwh_sum"]
+    ]
+    month_df.columns = ["consumption_kwh", "injection_kwh"]
+    print(f"\nCurrent month Consumption and Injection:\n{month_df}")
 
 
 def process_dataframe(df: pd.DataFrame) -> pd.DataFrame | None:
@@ -393,8 +613,9 @@ def process_dataframe(df: pd.DataFrame) -> pd.DataFrame | None:
 
     df = df.copy()
 
-    # Drop all rows with the sum of consumption_kw and injection_kw is equal to 0
-    df = df[df["consumption_kw"] + df["injection_kw"] != 0]
+    # Drop the rows without readings, but keep the zero readings, which may
+    # revise a slot of a previous export
+    df = df.dropna(subset=["consumption_kw", "injection_kw"], how="all")
 
     df.loc[:, "starting_datetime"] = pd.Series(dtype="datetime64[ns, UTC]")
 
@@ -1,12 +1,24 @@
 # Fix, improve, refactor and add comments, as needed, in English
 from dataclasses import dataclass
 from enum import Enum
+import os
 from time import sleep
 
 import pandas as pd
-import requests
 from tqdm import tqdm
 
+import cache
+import compact
+import coverage
+import http_client
+import metrics
+import rollups
+import utils
+
+# Address of the Shelly EM measuring the grid and solar channels of the account
+SHELLY_ORIGIN = os.getenv("EREDES_OMIE_SHELLY_ORIGIN") or "http://10.15.40.2"
+metrics.download_source(SHELLY_ORIGIN, "shelly")
+
 
 @dataclass
 class EnergyLabel:
@@ -31,8 +43,8 @@ class EnergySource(EnergyLabel, Enum):
 
     def download_data(
         self,
-        origin: str = "http://10.15.40.2",
-        save_path: str = "/workspace/data/shelly",
+        origin: str = SHELLY_ORIGIN,
+        save_path: str = utils.data_path("shelly"),
         debug: bool = False,
     ) -> None:
         """
@@ -51,16 +63,17 @@ class EnergySource(EnergyLabel, Enum):
         )
 
     def get_data(
-        self, save_path: str = "/workspace/data/shelly", debug: bool = False
+        self, save_path: str = utils.data_path("shelly"), debug: bool = False
     ) -> pd.DataFrame:
         """
-        Load the energy data from a CSV file into a pandas DataFrame.
+        Load the energy data from a CSV file into a pandas DataFrame, or from the
+        cache if the file did not change since it was last loaded.
 
         Args:
             debug (bool): If True, print debug information. Defaults to False.
 
         Returns:
-            pd.DataFrame: DataFrame containing the energy data.
+            pd.DataFrame: DataFrame containing the energy data, in compact dtypes if enabled (see `compact.apply`).
         """
         # Define the column names and types for the DataFrame
         column_names = [
@@ -77,31 +90,40 @@ class EnergySource(EnergyLabel, Enum):
             f"{self.id_label}_voltage_max_V": "Float64",
         }
 
-        # Load the CSV file into a DataFrame
-        df = pd.read_csv(
-            f"{save_path}/em_data.{self.id_label}.csv",
-            sep=",",
-            names=column_names,
-            dtype=column_types,
-            parse_dates=["timestamp_utc"],
-            header=0,
-            index_col=False,
-        )
+        def read(path: str) -> pd.DataFrame:
+            # Load the CSV file into a DataFrame
+            df = pd.read_csv(
+                path,
+                sep=",",
+                names=column_names,
+                dtype=column_types,
+                parse_dates=["timestamp_utc"],
+                header=0,
+                index_col=False,
+            )
+
+            # Set the DataFrame index to the timestamp column, localized to UTC
+            df.index = pd.to_datetime(df["timestamp_utc"]).dt.tz_localize("UTC")
+            df.drop(columns=["timestamp_utc"], inplace=True)
 
-        # Set the DataFrame index to the timestamp column, localized to UTC
-        df.index = pd.to_datetime(df["timestamp_utc"]).dt.tz_localize("UTC")
-        df.drop(columns=["timestamp_utc"], inplace=True)
+            # Convert to compact dtypes, if enabled, before the dataframe is cached
+            return compact.apply(df)
 
-        return df
+        return cache.load(f"{save_path}/em_data.{self.id_label}.csv", read)
 
     def __download_csv__(
-        self, url, filename, save_path="/workspace/data/shelly", debug: bool = False
+        self, url, filename, save_path=utils.data_path("shelly"), debug: bool = False
     ):
         # Construct the full path with the provided destination filename
         full_path = save_path + "/" + filename
 
-        # Start the download
-        response = requests.get(url, stream=True)
+        # Start the download, conditional if the file was downloaded before
+        response = http_client.get(url, path=full_path, stream=True)
+
+        # Check if the file did not change since it was downloaded
+        if response.status_code == 304:
+            print(f"\n{filename} did not change, skipping download")
+            return
 
         # Check for the specific error message before downloading
         if "Another file transfer is in progress!" in response.text:
@@ -130,9 +152,207 @@ class EnergySource(EnergyLabel, Enum):
                 print("\nERROR, something went wrong")
             else:
                 print(f"\nDownload completed. File saved as {full_path}")
+                http_client.save_validators(url, response, full_path)
         except Exception as e:
             print(f"\nAn error occurred: {e}")
 
+# Rows of each em_data CSV file read at a time when aggregating the energy history
+CHUNK_ROWS = 100_000
+
+# Duration of the slots of the energy history
+SLOT = pd.Timedelta(minutes=15)
+
+
+def _energy_columns(source: EnergySource) -> list[str]:
+    """
+    The names of the energy columns of the em_data CSV file of a source.
+    """
+    return [
+        f"{source.id_label}_{label}_energy_Wh"
+        for label in (source.energy_in_label, source.energy_out_label)
+        if label is not None
+    ]
+
+
+def _read_slot_sums(source: EnergySource, save_path: str, chunk_rows: int):
+    """
+    Reads the em_data CSV file of a source in chunks of rows, and sums the
+    energy of each chunk per quarter-hour slot.
+
+    The last slot of a chunk may continue in the next one, so consecutive sums
+    can share a slot.
+
+    Yields:
+        pd.DataFrame: The energy in Wh of each slot with readings, indexed by slot.
+    """
+    columns = _energy_columns(source)
+    chunks = pd.read_csv(
+        f"{save_path}/em_data.{source.id_label}.csv",
+        sep=",",
+        header=0,
+        names=["timestamp_utc"] + columns,
+        usecols=range(len(columns) + 1),
+        dtype={column: "float64" for column in columns},
+        parse_dates=["timestamp_utc"],
+        chunksize=chunk_rows,
+    )
+    for chunk in chunks:
+        timestamps = pd.DatetimeIndex(chunk["timestamp_utc"]).tz_localize("UTC")
+
+        # Mark the slots with readings as present, before the outages are filled with zeros
+        coverage.mark("shelly", timestamps)
+
+        yield chunk[columns].groupby(timestamps.floor(SLOT)).sum()
+
+
+def _iter_slots(save_path: str, chunk_rows: int):
+    """
+    Merges the grid and solar em_data CSV files into quarter-hour slots, reading
+    them in chunks so that memory use does not grow with the length of the files.
+
+    The source that is behind is always read next, and the slots before the
+    last slot read from every source are complete, so only those are yielded.
+    The rest, the partial slot at the end of each chunk included, is carried
+    over to the next chunks.
+
+    Yields:
+        pd.DataFrame: The grid, solar and consumed energy in kWh of the next
+        complete slots, the slots without readings filled with zeros.
+    """
+    # State of each source, by label, as the sources are not hashable
+    readers = {
+        source.id_label: _read_slot_sums(source, save_path, chunk_rows)
+        for source in EnergySource
+    }
+    empty = {
+        source.id_label: pd.DataFrame(
+            columns=_energy_columns(source),
+            index=pd.DatetimeIndex([], tz="UTC"),
+            dtype="float64",
+        )
+        for source in EnergySource
+    }
+    pending = dict(empty)
+    last_read = {label: None for label in readers}
+    next_slot = None
+
+    while True:
+        if readers:
+            # Read the next chunk of the source that is behind
+            unread = [s for s in readers if last_read[s] is None]
+            label = unread[0] if unread else min(readers, key=last_read.get)
+            sums = next(readers[label], None)
+            if sums is None:
+                del readers[label]
+            elif len(sums) > 0:
+                # Only the first slot of the chunk can already be pending
+                pending[label] = pending[label].add(sums, fill_value=0)
+                last_read[label] = sums.index[-1]
+
+            # Wait until every open source was read at least once
+            if any(last_read[s] is None for s in readers):
+                continue
+
+        # The slots before the last slot read from every open source are complete
+        cutoff = min(last_read[s] for s in readers) if readers else None
+        complete = []
+        for label, df in pending.items():
+            if cutoff is None:
+                complete.append(df)
+                pending[label] = empty[label]
+            else:
+                complete.append(df[df.index < cutoff])
+                pending[label] = df[df.index >= cutoff]
+
+        df = pd.concat(complete, axis=1).sort_index()
+        if len(df) > 0:
+            # Fill the slots without readings since the previous slots, as resampling would
+            start = df.index[0] if next_slot is None else next_slot
+            df = df.reindex(pd.date_range(start, df.index[-1], freq=SLOT)).fillna(0)
+            next_slot = df.index[-1] + SLOT
+            yield _energy_history(df)
+
+        if not readers:
+            return
+
+
+def _energy_history(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Computes the net grid, solar and consumed energy in kWh from the energy of
+    the grid and solar channels in Wh.
+    """
+    # Calculate the net grid energy by subtracting the returned energy from the consumed energy
+    grid = df["grid_consumed_energy_Wh"] - df["grid_returned_energy_Wh"]
+
+    # Calculate the total consumed energy by adding the net grid energy and the solar produced energy
+    consumed = grid + df["solar_produced_energy_Wh"]
+
+    # Convert the energy values from Wh to kWh and round them to 6 decimal places
+    history_df = pd.DataFrame(
+        {
+            "grid_kWh": grid,
+            "solar_kWh": df["solar_produced_energy_Wh"],
+            "consumed_kWh": consumed,
+        }
+    )
+    history_df = (history_df / 1000).round(6)
+    history_df.index.name = "timestamp_utc"
+
+    return history_df
+
+
+def aggregate_energy_history(
+    path: str = utils.data_path("shelly_energy_history.csv"),
+    save_path: str = utils.data_path("shelly"),
+    chunk_rows: int = CHUNK_ROWS,
+    debug: bool = False,
+) -> int:
+    """
+    Aggregates the per-minute em_data CSV files of the grid and solar channels
+    into the quarter-hour energy history, streaming them in chunks.
+
+    Memory use depends on `chunk_rows` only: the complete slots are appended
+    to the history file as they are computed. Once the history is saved, its
+    quarter-hours after the watermark of the rollups are folded into them, read
+    back in chunks too, so a failed run never moves the watermark past the
+    saved history. The last quarter-hour, cut short by the end of the readings,
+    is left for the next run.
+
+    Args:
+        path (str): The path to the energy history CSV file.
+        save_path (str): The directory of the em_data CSV files.
+        chunk_rows (int): The rows of each em_data CSV file read at a time.
+        debug (bool): If True, prints debug information. Defaults to False.
+
+    Returns:
+        int: The number of quarter-hours saved.
+    """
+    slots = 0
+    last_slot = None
+
+    # Write to a temporary file first, so that readers never see a partial history
+    with open(f"{path}.tmp", "w") as file:
+        for history_df in _iter_slots(save_path, chunk_rows):
+            history_df.to_csv(file, header=slots == 0)
+            slots += len(history_df)
+            last_slot = history_df.index[-1]
+
+            if debug:
+                print(f"Aggregated {slots} quarter-hours up to {history_df.index[-1]}")
+
+    os.replace(f"{path}.tmp", path)
+    metrics.inc("rows_parsed_total", slots, stage="shelly")
+
+    # Fold the new quarter-hours into the rollups, but the last one, which may
+    # still be receiving readings and is saved again by the next run
+    for history_df in utils.read_csv_chunks(
+        path, start=rollups.get_watermark("shelly"), chunk_rows=chunk_rows
+    ):
+        rollups.ingest("shelly", history_df, end=last_slot, debug=debug)
+
+    return slots
+
+
 def process_energy_history(debug: bool = False) -> pd.DataFrame:
     """
     This function downloads and processes energy history data from Shelly devices.
@@ -153,61 +373,54 @@ def process_energy_history(debug: bool = False) -> pd.DataFrame:
     EnergySource.GRID.download_data(debug=debug)
     EnergySource.SOLAR.download_data(debug=debug)
 
-    # Get the energy data for both grid and solar energy sources
+    # Aggregate the energy data of both sources every 15 minutes, in chunks
     if debug:
-        print("Getting energy data...")
-    grid_df = EnergySource.GRID.get_data(debug=debug)
-    solar_df = EnergySource.SOLAR.get_data(debug=debug)
+        print("Aggregating energy data...")
+    aggregate_energy_history(debug=debug)
 
-    # Concatenate the grid and solar DataFrames along the columns (axis=1)
-    df = pd.concat([grid_df, solar_df], axis=1)
+    # Load the quarter-hour history, much smaller than the per-minute data
+    return get_energy_history()
 
-    # Resample the data every 15 minutes and sum the values
-    if debug:
-        print("Resampling data...")
-    df = df.resample("15min").sum()
-
-    # Calculate the net grid energy by subtracting the returned energy from the consumed energy
-    df.loc[:, "grid_Wh"] = df["grid_consumed_energy_Wh"] - df["grid_returned_energy_Wh"]
 
-    # Calculate the total consumed energy by adding the net grid energy and the solar produced energy
-    df.loc[:, "consumed_Wh"] = df["grid_Wh"] + df["solar_produced_energy_Wh"]
-
-    # Select the columns of interest
-    if debug:
-        print("Selecting columns...")
-    df = df[["grid_Wh", "solar_produced_energy_Wh", "consumed_Wh"]]
-
-    # Convert the energy values from Wh to kWh (divide by 1000)
-    if debug:
-        print("Converting units...")
-    df = df / 1000
-
-    # Rename the columns to reflect the new units
-    if debug:
-        print("Renaming columns...")
-    df.rename(
-        columns={
-            "grid_Wh": "grid_kWh",
-            "solar_produced_energy_Wh": "solar_kWh",
-            "consumed_Wh": "consumed_kWh",
-        },
-        inplace=True,
-    )
+def get_energy_history(
+    start: pd.Timestamp = None,
+    end: pd.Timestamp = None,
+    path: str = utils.data_path("shelly_energy_history.csv"),
+) -> pd.DataFrame:
+    """
+    Loads the processed quarter-hour energy history saved by `process_energy_history`,
+    from the cache if the file did not change since it was last loaded.
 
-    # Round the energy values to 6 decimal places
-    if debug:
-        print("Rounding values...")
-    df["grid_kWh"] = df["grid_kWh"].round(6)
-    df["solar_kWh"] = df["solar_kWh"].round(6)
-    df["consumed_kWh"] = df["consumed_kWh"].round(6)
+    Args:
+        start (pd.Timestamp, optional): The first timestamp to load. Defaults to the start of the history.
+        end (pd.Timestamp, optional): The first timestamp not to load. Defaults to the end of the history.
+        path (str): The path to the energy history CSV file.
 
-    # Export the processed data to a CSV file
-    if debug:
-        print("Exporting data...")
-    df.to_csv("/workspace/data/shelly_energy_history.csv")
+    Returns:
+        pd.DataFrame: The grid, solar and consumed energy in kWh, indexed by timestamp,
+        in compact dtypes if enabled (see `compact.apply`).
+    """
+    def read_range(
+        path: str, start: pd.Timestamp = None, end: pd.Timestamp = None
+    ) -> pd.DataFrame:
+        df = utils.read_csv_range(
+            path,
+            start=start,
+            end=end,
+            sep=",",
+            header=0,
+            index_col=0,
+            names=["timestamp_utc", "grid_kWh", "solar_kWh", "consumed_kWh"],
+            dtype={
+                "grid_kWh": "float64",
+                "solar_kWh": "float64",
+                "consumed_kWh": "float64",
+            },
+            parse_dates=["timestamp_utc"],
+        )
+        return compact.apply(df)
 
-    return df
+    return cache.load(path, read_range, start=start, end=end, range_loader=read_range)
 
 
 # Fix, improve, refactor and add comments to the code bellow, as needed, in English
@@ -268,7 +481,7 @@ def save_yesterday_solar_production(debug: bool = False) -> pd.DataFrame:
     if debug:
         print("Reading the full solar data from the CSV file...")
     full_solar_df = pd.read_csv(
-        "/workspace/data/shelly_solar.csv",
+        utils.data_path("shelly_solar.csv"),
         sep=",",
         names=["timestamp_utc", "solar_Wh"],
         dtype={"timestamp_utc": "str", "solar_Wh": "Float64"},
@@ -299,7 +512,7 @@ def save_yesterday_solar_production(debug: bool = False) -> pd.DataFrame:
     # Save the dataframe to the CSV file
     if debug:
         print("Saving the dataframe to the CSV file...")
-    full_solar_df.to_csv("/workspace/data/shelly_solar.csv", index=False)
+    full_solar_df.to_csv(utils.data_path("shelly_solar.csv"), index=False)
 
     # Reset the index of the dataframe
     if debug:
@@ -0,0 +1,200 @@
+from functools import lru_cache
+
+from dateutil.easter import easter
+import numpy as np
+import pandas as pd
+
+# Local time of the cycles, the summer schedules apply while it is on summer time
+TIMEZONE = "Europe/Lisbon"
+
+# Tariff periods, in the order of the period codes of `period_codes`
+PERIODS = ["simples", "vazio", "fora_vazio", "cheias", "ponta"]
+
+# Seasons and day types of the schedules, in the order of the lookup table
+SEASONS = ["winter", "summer"]
+DAY_TYPES = ["weekday", "saturday", "sunday"]
+
+# ERSE time-of-use cycles of the low voltage (BTN) supplies: for each season and
+# day type, the [start, end) local times of each period, the rest of the day
+# being in the default period. The daily cycles only define the weekdays, as
+# every day of the week is the same.
+_BI_DAILY = {"weekday": [("08:00", "22:00", "fora_vazio")]}
+_TRI_DAILY = {
+    "winter": {
+        "weekday": [
+            ("08:00", "09:00", "cheias"),
+            ("09:00", "10:30", "ponta"),
+            ("10:30", "18:00", "cheias"),
+            ("18:00", "20:30", "ponta"),
+            ("20:30", "22:00", "cheias"),
+        ]
+    },
+    "summer": {
+        "weekday": [
+            ("08:00", "10:30", "cheias"),
+            ("10:30", "13:00", "ponta"),
+            ("13:00", "19:30", "cheias"),
+            ("19:30", "21:00", "ponta"),
+            ("21:00", "22:00", "cheias"),
+        ]
+    },
+}
+CYCLES: dict[str, dict] = {
+    "simple": {"default": "simples", "winter": {}, "summer": {}},
+    "bi_daily": {"default": "vazio", "winter": _BI_DAILY, "summer": _BI_DAILY},
+    "bi_weekly": {
+        "default": "vazio",
+        "winter": {
+            "weekday": [("07:00", "24:00", "fora_vazio")],
+            "saturday": [
+                ("09:30", "13:00", "fora_vazio"),
+                ("18:30", "22:00", "fora_vazio"),
+            ],
+        },
+        "summer": {
+            "weekday": [("07:00", "24:00", "fora_vazio")],
+            "saturday": [
+                ("09:00", "14:00", "fora_vazio"),
+                ("20:00", "22:00", "fora_vazio"),
+            ],
+        },
+    },
+    "tri_daily": {"default": "vazio", **_TRI_DAILY},
+    "tri_weekly": {
+        "default": "vazio",
+        "winter": {
+            "weekday": [
+                ("07:00", "09:30", "cheias"),
+                ("09:30", "12:00", "ponta"),
+                ("12:00", "18:30", "cheias"),
+                ("18:30", "21:00", "ponta"),
+                ("21:00", "24:00", "cheias"),
+            ],
+            "saturday": [("09:30", "13:00", "cheias"), ("18:30", "22:00", "cheias")],
+        },
+        "summer": {
+            "weekday": [
+                ("07:00", "09:15", "cheias"),
+                ("09:15", "12:15", "ponta"),
+                ("12:15", "24:00", "cheias"),
+            ],
+            "saturday": [("09:00", "14:00", "cheias"), ("20:00", "22:00", "cheias")],
+        },
+    },
+}
+
+# Cycles whose schedule depends on the day of the week, where holidays follow Sundays
+WEEKLY_CYCLES = {"bi_weekly", "tri_weekly"}
+
+# Quarter-hours of a day
+SLOTS_PER_DAY = 96
+
+
+def holidays(year: int) -> list[pd.Timestamp]:
+    """
+    The national holidays of Portugal in a year, including the movable Good
+    Friday, Easter and Corpus Christi.
+    """
+    easter_sunday = pd.Timestamp(easter(year))
+    fixed = ["01-01", "04-25", "05-01", "06-10", "08-15", "10-05", "11-01", "12-01"]
+    fixed += ["12-08", "12-25"]
+    movable = [
+        easter_sunday - pd.Timedelta(days=2),
+        easter_sunday,
+        easter_sunday + pd.Timedelta(days=60),
+    ]
+    return sorted([pd.Timestamp(f"{year}-{day}") for day in fixed] + movable)
+
+
+def _slot(time: str) -> int:
+    """The quarter-hour of the day starting at a HH:MM time."""
+    hours, minutes = time.split(":")
+    return (int(hours) * 60 + int(minutes)) // 15
+
+
+def _lookup(cycle: str) -> np.ndarray:
+    """
+    The period code of each quarter-hour of the day, for each season and day type
+    of a cycle, as an array of shape (seasons, day types, quarter-hours).
+    """
+    table = np.full(
+        (len(SEASONS), len(DAY_TYPES), SLOTS_PER_DAY),
+        PERIODS.index(CYCLES[cycle]["default"]),
+        dtype="int8",
+    )
+    for season_code, season in enumerate(SEASONS):
+        for day_code, day_type in enumerate(DAY_TYPES):
+            for start, end, period in CYCLES[cycle][season].get(day_type, []):
+                table[season_code, day_code, _slot(start) : _slot(end)] = (
+                    PERIODS.index(period)
+                )
+    return table
+
+
+@lru_cache(maxsize=None)
+def _calendar(year: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    The season, day type and quarter-hour of the local day of each UTC
+    quarter-hour of a year, shared by all the cycles.
+    """
+    slots = pd.date_range(
+        pd.Timestamp(year=year, month=1, day=1, tz="UTC"),
+        pd.Timestamp(year=year + 1, month=1, day=1, tz="UTC"),
+        freq="15min",
+        inclusive="left",
+    )
+    local = slots.tz_convert(TIMEZONE)
+    wall = local.tz_localize(None)
+
+    # Lisbon is one hour ahead of UTC on summer time
+    summer = (wall - slots.tz_localize(None)) == pd.Timedelta(hours=1)
+
+    day_types = np.select(
+        [wall.dayofweek == 6, wall.dayofweek == 5], [2, 1], default=0
+    ).astype("int8")
+    days = wall.normalize()
+    day_types[days.isin(holidays(year - 1) + holidays(year) + holidays(year + 1))] = 2
+
+    slot_of_day = (wall.hour * 4 + wall.minute // 15).to_numpy()
+    return summer.astype("int8"), day_types, slot_of_day
+
+
+@lru_cache(maxsize=None)
+def period_codes(year: int, cycle: str) -> np.ndarray:
+    """
+    The period of each UTC quarter-hour of a year in a cycle, as its index in
+    `PERIODS`. Computed once per year and cycle, and kept in memory.
+
+    Args:
+        year (int): The year, from 00:00 UTC of January 1st.
+        cycle (str): The cycle, one of `CYCLES`.
+
+    Returns:
+        np.ndarray: The read-only period codes, one per quarter-hour of the year.
+    """
+    if cycle not in CYCLES:
+        raise ValueError(f"Invalid cycle: {cycle}, expected one of {list(CYCLES)}")
+
+    seasons, day_types, slot_of_day = _calendar(year)
+
+    # Every day of the daily cycles follows the weekday schedule
+    if cycle not in WEEKLY_CYCLES:
+        day_types = np.zeros_like(day_types)
+    codes = _lookup(cycle)[seasons, day_types, slot_of_day]
+    codes.setflags(write=False)
+    return codes
+
+
+def masks(year: int, cycle: str) -> dict[str, np.ndarray]:
+    """
+    The mask of the UTC quarter-hours of a year in each period of a cycle.
+
+    Returns:
+        dict[str, np.ndarray]: A boolean mask per period used by the cycle.
+    """
+    codes = period_codes(year, cycle)
+    return {
+        period: codes == code
+        for code, period in enumerate(PERIODS)
+        if (codes == code).any()
+    }
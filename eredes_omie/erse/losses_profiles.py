@@ -1,37 +1,20 @@
 from glob import glob
 import pandas as pd
 
+import cache
+import coverage
+import metrics
+import rollups
+import utils
 
-def update_losses_profiles() -> pd.DataFrame:
-    """
-    Updates and saves the losses profiles data from Excel files in the "/workspace/data/losses_profiles/" directory.
 
-    Returns:
-        pd.DataFrame: The updated losses profiles data.
+def process_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Processes a losses profiles workbook into the starting_datetime and
+    losses_profile of each quarter-hour.
     """
-    # Get the list of losses profiles files
-    files = sorted(glob("/workspace/data/losses_profiles/*.xlsx"))
-
-    # Initialize a list of dataframes
-    dfs = []
-
-    # Loop through the files
-    for file in files:
-        print(f"\nProcessing {file}")
-        # Load the file into a dataframe
-        df = pd.read_excel(
-            file,
-            skiprows=2,
-        )
-
-        # Append the dataframe to the list
-        dfs.append(df)
-
-    # Concatenate the dataframes
-    df = pd.concat(dfs)
-
     # Use only columns 1, 3 and 4, index 0
-    df = df.iloc[:, [1, 3, 4]]
+    df = df.iloc[:, [1, 3, 4]].copy()
 
     # Set column names to date, time, losses_profile
     df.columns = ["date", "time", "losses_profile"]
@@ -52,24 +35,55 @@ def update_losses_profiles() -> pd.DataFrame:
     df["starting_datetime"] = df["starting_datetime"].dt.tz_localize("UTC")
 
     # Set only the final columns
-    df = df[["starting_datetime", "losses_profile"]]
+    return df[["starting_datetime", "losses_profile"]]
+
+
+def update_losses_profiles(workers: int = None) -> pd.DataFrame:
+    """
+    Updates and saves the losses profiles data from Excel files in the losses_profiles directory of the shared data.
+
+    Args:
+        workers (int, optional): The number of processes parsing the files. Defaults to the number of CPUs.
+
+    Returns:
+        pd.DataFrame: The updated losses profiles data.
+    """
+    # Get the list of losses profiles files
+    files = sorted(glob(utils.shared_path("losses_profiles", "*.xlsx")))
+    for file in files:
+        print(f"\nProcessing {file}")
+
+    # Parse and process the files in parallel, then concatenate them
+    dfs = utils.read_excel_files(
+        files, transform=process_dataframe, workers=workers, skiprows=2
+    )
+    df = pd.concat(dfs).sort_values("starting_datetime", kind="stable")
+    metrics.inc("rows_parsed_total", len(df), stage="losses")
 
     # Save the dataframe to a CSV file
-    df.to_csv("/workspace/data/losses_profiles.csv", index=False)
+    df.to_csv(utils.shared_path("losses_profiles.csv"), index=False)
+
+    # Cache the dataframe, so that the next stages do not parse the file again
+    df = df.reset_index(drop=True)
+    cache.put(utils.shared_path("losses_profiles.csv"), df)
+
+    # Fold the new profiles into the rollups and mark their slots as present
+    rollups.ingest("losses", df)
+    coverage.mark("losses", df["starting_datetime"])
 
     # Return the dataframe
     return df
 
 
+def _read_losses_profiles(path: str) -> pd.DataFrame:
+    return pd.read_csv(path, parse_dates=["starting_datetime"])
+
+
 def get_losses_profiles() -> pd.DataFrame:
     """
-    Loads the losses profiles data from a CSV file.
+    Loads the losses profiles data from a CSV file, or from the cache if it did not change.
 
     Returns:
         pd.DataFrame: A DataFrame containing the losses profiles data.
     """
-    # Load the dataframe from a CSV file
-    df = pd.read_csv("/workspace/data/losses_profiles.csv")
-
-    # Return the dataframe
-    return df
+    return cache.load(utils.shared_path("losses_profiles.csv"), _read_losses_profiles)
@@ -0,0 +1,186 @@
+import os
+
+import pandas as pd
+
+import energy_meters.shelly as shelly
+from erse import losses_profiles
+import ledger
+from omie import energy_prices
+import providers.repsol as repsol
+import utils
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+
+# Directory where the Arrow IPC (Feather v2) files are saved
+EXPORT_DIR = utils.data_path("arrow")
+
+
+def _read_consumption_history() -> pd.DataFrame:
+    """
+    Loads the E-REDES history and the current month, the latest export winning.
+    """
+    dfs = [
+        pd.read_csv(path, parse_dates=["starting_datetime"])
+        for path in DATASETS["consumption"]["paths"]
+        if os.path.exists(path)
+    ]
+    df = pd.concat(dfs).sort_values("starting_datetime", kind="stable")
+    return df.drop_duplicates("starting_datetime", keep="last").reset_index(drop=True)
+
+
+# Datasets exported: the files they are consolidated from and their loader
+DATASETS: dict[str, dict] = {
+    "omie_prices": {
+        "paths": [utils.shared_path("energy_prices.csv")],
+        "loader": energy_prices.get_prices,
+    },
+    "repsol_prices": {
+        "paths": [utils.shared_path("repsol_indexed_prices.csv")],
+        "loader": repsol.get_prices,
+    },
+    "losses": {
+        "paths": [utils.shared_path("losses_profiles.csv")],
+        "loader": losses_profiles.get_losses_profiles,
+    },
+    "consumption": {
+        "paths": [
+            utils.data_path("consumption_history.csv"),
+            utils.data_path("current_month_consumption_history.csv"),
+        ],
+        "loader": _read_consumption_history,
+    },
+    "shelly": {
+        "paths": [utils.data_path("shelly_energy_history.csv")],
+        "loader": shelly.get_energy_history,
+    },
+    "cost_ledger": {
+        "paths": [utils.data_path("cost_ledger_daily.csv")],
+        "loader": ledger.get_daily_costs,
+    },
+}
+
+
+def _require_pyarrow() -> None:
+    if pa is None:
+        raise ImportError(
+            "The Arrow export needs pyarrow, install it with the arrow extra, "
+            "`poetry install --extras arrow` or `pip install eredes-omie[arrow]`"
+        )
+
+
+def _export_path(name: str, export_dir: str) -> str:
+    return f"{export_dir}/{name}.arrow"
+
+
+def is_stale(name: str, export_dir: str = EXPORT_DIR) -> bool:
+    """
+    Checks if the exported file of a dataset is missing or older than any of its sources.
+    """
+    path = _export_path(name, export_dir)
+    if not os.path.exists(path):
+        return True
+
+    exported = os.path.getmtime(path)
+    return any(
+        os.path.getmtime(source) > exported
+        for source in DATASETS[name]["paths"]
+        if os.path.exists(source)
+    )
+
+
+def export(
+    names: list[str] = None,
+    export_dir: str = EXPORT_DIR,
+    force: bool = False,
+    debug: bool = False,
+) -> list[str]:
+    """
+    Exports the consolidated datasets as uncompressed Arrow IPC files, which can
+    be memory-mapped by `open_table` and `load` without parsing or copying.
+
+    Only the datasets whose sources changed since their last export are written.
+    Each file is written to a temporary file and renamed, so that readers that
+    have the previous file mapped keep a consistent view of it.
+
+    Args:
+        names (list[str], optional): The datasets to export. Defaults to all of `DATASETS`.
+        export_dir (str): The directory where the files are saved.
+        force (bool): If True, exports the datasets even if their sources did not change.
+        debug (bool): If True, prints debug information. Defaults to False.
+
+    Returns:
+        list[str]: The names of the exported datasets.
+    """
+    _require_pyarrow()
+    os.makedirs(export_dir, exist_ok=True)
+
+    exported = []
+    for name in names or list(DATASETS):
+        if not any(os.path.exists(path) for path in DATASETS[name]["paths"]):
+            if debug:
+                print(f"Skipping {name}, no data saved yet")
+            continue
+        if not force and not is_stale(name, export_dir):
+            continue
+
+        df = DATASETS[name]["loader"]()
+
+        # Compression would force readers to decompress into new buffers
+        path = _export_path(name, export_dir)
+        feather.write_feather(df, f"{path}.tmp", compression="uncompressed")
+        os.replace(f"{path}.tmp", path)
+        exported.append(name)
+
+        if debug:
+            print(f"Exported {len(df)} rows of {name} to {path}")
+
+    return exported
+
+
+def open_table(
+    name: str, columns: list[str] = None, export_dir: str = EXPORT_DIR
+) -> "pa.Table":
+    """
+    Opens an exported dataset as an Arrow table backed by a memory map of its
+    file, so only the pages actually read are loaded from disk.
+    """
+    _require_pyarrow()
+    source = pa.memory_map(_export_path(name, export_dir), "r")
+    table = pa.ipc.open_file(source).read_all()
+    if columns is None:
+        return table
+
+    # Keep the columns the pandas index is restored from
+    index_columns = [
+        column
+        for column in (table.schema.pandas_metadata or {}).get("index_columns", [])
+        if isinstance(column, str) and column not in columns
+    ]
+    return table.select(index_columns + columns)
+
+
+def load(
+    name: str, columns: list[str] = None, export_dir: str = EXPORT_DIR
+) -> pd.DataFrame:
+    """
+    Loads an exported dataset as a DataFrame with the same columns and index as
+    its loader in `DATASETS`.
+
+    The columns are converted one block each, so the numeric columns without
+    missing values keep pointing to the memory-mapped file instead of being copied.
+
+    Args:
+        name (str): The name of the dataset, one of `DATASETS`.
+        columns (list[str], optional): The columns to load. Defaults to all of them.
+        export_dir (str): The directory where the files are saved.
+
+    Returns:
+        pd.DataFrame: The dataset.
+    """
+    return open_table(name, columns=columns, export_dir=export_dir).to_pandas(
+        split_blocks=True
+    )
@@ -0,0 +1,272 @@
+import numpy as np
+import pandas as pd
+
+import energy_meters.shelly as shelly
+import omie.energy_prices
+import providers.repsol as repsol
+import reconcile
+import utils
+
+# Forecast models: the mean of the recent days per quarter-hour of the day, or
+# a ridge regression on calendar and lagged features
+MODELS = ["profile", "regression"]
+
+# Series forecast, from the Shelly energy history
+TARGETS = ["consumed_kWh", "solar_kWh"]
+
+# Days are forecast in local time, as the consumption follows the local clock
+TIMEZONE = "Europe/Lisbon"
+
+# Quarter-hours per day, on the regular UTC grid the lags are taken from
+SLOTS_PER_DAY = 96
+
+# Days of the lagged features: the forecast is made during the previous day,
+# so the most recent complete day is two days before the forecast day
+FIRST_LAG_DAYS = 2
+LAG_DAYS = 7
+
+# Days of history used to fit the regression
+TRAINING_DAYS = 2 * 365
+
+# Regularization of the regression, relative to the number of rows
+RIDGE = 1e-3
+
+
+def load_history(end: pd.Timestamp = None, days: int = TRAINING_DAYS) -> pd.DataFrame:
+    """
+    Loads the quarter-hour Shelly history before `end` on a regular grid, the
+    missing quarter-hours left as NaN.
+    """
+    if end is None:
+        end = utils.tomorrow()
+    start = end - pd.Timedelta(days=days + FIRST_LAG_DAYS + LAG_DAYS)
+
+    df = shelly.get_energy_history(start=start, end=end)[TARGETS].astype("float64")
+    index = pd.date_range(start, end, freq="15min", inclusive="left", name=df.index.name)
+    return df.reindex(index)
+
+
+def _lag_means(values: np.ndarray) -> np.ndarray:
+    """
+    The mean of each quarter-hour over the `LAG_DAYS` days from `FIRST_LAG_DAYS`
+    days before, and the value one week before, on the regular grid, where a
+    day is always `SLOTS_PER_DAY` rows back.
+
+    Returns:
+        np.ndarray: One row per quarter-hour and the two lag columns, NaN where
+        some lagged quarter-hour is missing.
+    """
+    n = len(values)
+    lagged = np.full((LAG_DAYS, n), np.nan)
+    for k in range(LAG_DAYS):
+        shift = (FIRST_LAG_DAYS + k) * SLOTS_PER_DAY
+        if shift < n:
+            lagged[k, shift:] = values[: n - shift]
+
+    week = np.full(n, np.nan)
+    shift = 7 * SLOTS_PER_DAY
+    if shift < n:
+        week[shift:] = values[: n - shift]
+
+    return np.column_stack([lagged.mean(axis=0), week])
+
+
+def features(index: pd.DatetimeIndex, lags: np.ndarray) -> np.ndarray:
+    """
+    Builds the feature matrix of the regression: an intercept, the quarter-hour
+    of the local day and the day of the week one-hot encoded, two yearly
+    harmonics and the lagged means, see `_lag_means`.
+    """
+    local = index.tz_convert(TIMEZONE)
+    slot = (local.hour * 4 + local.minute // 15).to_numpy()
+    weekday = local.dayofweek.to_numpy()
+    year_angle = 2 * np.pi * local.dayofyear.to_numpy() / 365.25
+
+    n = len(index)
+    matrix = np.zeros((n, 1 + SLOTS_PER_DAY + 6 + 4 + lags.shape[1]))
+    matrix[:, 0] = 1
+    matrix[np.arange(n), 1 + slot] = 1
+
+    # Monday is the baseline of the days of the week
+    column = 1 + SLOTS_PER_DAY
+    workdays = weekday > 0
+    matrix[np.flatnonzero(workdays), column + weekday[workdays] - 1] = 1
+    column += 6
+
+    matrix[:, column : column + 4] = np.column_stack(
+        [
+            np.sin(year_angle),
+            np.cos(year_angle),
+            np.sin(2 * year_angle),
+            np.cos(2 * year_angle),
+        ]
+    )
+    matrix[:, column + 4 :] = lags
+
+    return matrix
+
+
+def fit(history_df: pd.DataFrame, target: str, ridge: float = RIDGE) -> np.ndarray:
+    """
+    Fits the regression of a target on the quarter-hours of the history with
+    every feature, with the normal equations.
+
+    Returns:
+        np.ndarray: The coefficients of the features, see `features`.
+    """
+    values = history_df[target].to_numpy(dtype="float64")
+    matrix = features(history_df.index, _lag_means(values))
+
+    rows = ~np.isnan(values) & ~np.isnan(matrix).any(axis=1)
+    x, y = matrix[rows], values[rows]
+
+    gram = x.T @ x + ridge * len(y) * np.eye(x.shape[1])
+    return np.linalg.solve(gram, x.T @ y)
+
+
+def _day_index(day: pd.Timestamp) -> pd.DatetimeIndex:
+    """
+    The quarter-hours of a local day, in UTC, 92 or 100 of them on the days the
+    clock changes.
+    """
+    start = pd.Timestamp(day.date()).tz_localize(TIMEZONE)
+    end = start + pd.DateOffset(days=1)
+    return pd.date_range(
+        start.tz_convert("UTC"), end.tz_convert("UTC"), freq="15min", inclusive="left"
+    )
+
+
+def predict(
+    history_df: pd.DataFrame,
+    day: pd.Timestamp,
+    model: str = "regression",
+    coefficients: dict[str, np.ndarray] = None,
+) -> pd.DataFrame:
+    """
+    Forecasts the targets for the quarter-hours of a local day.
+
+    Args:
+        history_df (pd.DataFrame): The history on the regular grid, see `load_history`.
+        day (pd.Timestamp): The day to forecast.
+        model (str): One of `MODELS`. Defaults to "regression".
+        coefficients (dict[str, np.ndarray], optional): The regression coefficients
+            of each target. Defaults to fitting them on the history.
+
+    Returns:
+        pd.DataFrame: The forecast of each target, indexed by quarter-hour.
+    """
+    if model not in MODELS:
+        raise ValueError(f"Invalid model: {model}, expected one of {MODELS}")
+
+    index = _day_index(day)
+
+    # Extend the regular grid over the forecast day, with unknown values
+    grid_index = pd.date_range(history_df.index[0], index[-1], freq="15min")
+    positions = grid_index.get_indexer(index)
+
+    forecast_df = pd.DataFrame(index=index)
+    for target in TARGETS:
+        values = history_df[target].reindex(grid_index).to_numpy(dtype="float64")
+        lags = _lag_means(values)[positions]
+
+        if model == "profile":
+            # Mean of the same quarter-hour over the recent days, or the week before
+            forecast = np.where(np.isnan(lags[:, 0]), lags[:, 1], lags[:, 0])
+        else:
+            if coefficients is None or target not in coefficients:
+                target_coefficients = fit(history_df, target)
+            else:
+                target_coefficients = coefficients[target]
+            forecast = features(index, lags) @ target_coefficients
+
+        forecast_df[target] = np.clip(np.nan_to_num(forecast), 0, None)
+
+    forecast_df["grid_kWh"] = forecast_df["consumed_kWh"] - forecast_df["solar_kWh"]
+    return forecast_df
+
+
+def forecast(
+    day: pd.Timestamp = None,
+    model: str = "regression",
+    history_df: pd.DataFrame = None,
+    prices_df: pd.DataFrame = None,
+) -> pd.DataFrame:
+    """
+    Forecasts the consumption, solar production and grid energy of a local day,
+    what E-REDES will report for it and its expected cost.
+
+    Args:
+        day (pd.Timestamp, optional): The day to forecast. Defaults to tomorrow if
+            its prices are available, or today otherwise.
+        model (str): One of `MODELS`. Defaults to "regression".
+        history_df (pd.DataFrame, optional): The history, see `load_history`. Defaults to the saved history.
+        prices_df (pd.DataFrame, optional): The Repsol prices. Defaults to the saved prices of the day.
+
+    Returns:
+        pd.DataFrame: The forecast energy in kWh of each quarter-hour, the grid
+        energy calibrated to E-REDES, the price and the expected cost of the bought energy.
+    """
+    if day is None:
+        day = utils.tomorrow()
+        if not omie.energy_prices.is_available(day):
+            day = utils.today()
+
+    if history_df is None:
+        history_df = load_history(end=day - pd.Timedelta(days=1))
+
+    df = predict(history_df, day, model=model)
+
+    # Scale the grid energy to what the E-REDES meter would measure
+    df["e_redes_grid_kWh"] = reconcile.calibrate(
+        df["grid_kWh"], reconcile.calibration_factors()
+    )
+
+    # Cost of the bought energy, exported energy is not paid
+    if prices_df is None:
+        prices_df = repsol.get_prices(
+            start=df.index[0], end=df.index[-1] + pd.Timedelta(minutes=15)
+        )
+    prices = prices_df.set_index("starting_datetime")["€/kWh"]
+    df["€/kWh"] = prices.reindex(df.index)
+    df["cost_€"] = df["€/kWh"] * df["e_redes_grid_kWh"].clip(lower=0)
+
+    return df
+
+
+def backtest(
+    days: int = 28,
+    model: str = "regression",
+    end: pd.Timestamp = None,
+) -> pd.DataFrame:
+    """
+    Forecasts each of the last `days` days from the history before it, fitting
+    the regression once, and compares the daily totals with the history.
+
+    Returns:
+        pd.DataFrame: The forecast and actual daily totals of each target, indexed by day.
+    """
+    if end is None:
+        end = utils.today()
+    history_df = load_history(end=end)
+
+    # Fit once on the history before the backtest
+    start = end - pd.Timedelta(days=days)
+    coefficients = None
+    if model == "regression":
+        training_df = history_df[history_df.index < start]
+        coefficients = {target: fit(training_df, target) for target in TARGETS}
+
+    rows = []
+    for day in pd.date_range(start, end, freq="D", inclusive="left"):
+        # Hide the day before the forecast day, as during the previous day
+        known_df = history_df[history_df.index < day - pd.Timedelta(days=1)]
+        forecast_df = predict(known_df, day, model=model, coefficients=coefficients)
+        actual_df = history_df.reindex(forecast_df.index)
+
+        row = {"day": day}
+        for target in TARGETS:
+            row[f"forecast_{target}"] = forecast_df[target].sum()
+            row[f"actual_{target}"] = actual_df[target].sum()
+        rows.append(row)
+
+    return pd.DataFrame(rows).set_index("day")
@@ -0,0 +1,252 @@
+from collections import deque
+from dataclasses import dataclass
+import json
+import os
+import threading
+import time
+from typing import Callable
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+import utils
+
+# Seconds to wait for a connection and for each read from the server
+CONNECT_TIMEOUT = float(os.getenv("EREDES_OMIE_CONNECT_TIMEOUT") or 5)
+READ_TIMEOUT = float(os.getenv("EREDES_OMIE_READ_TIMEOUT") or 30)
+
+# Attempts after the first one, and the delay before the first retry, doubled on each retry
+RETRIES = 3
+BACKOFF_SECONDS = 0.5
+MAX_BACKOFF_SECONDS = 30
+
+# Responses worth retrying, as the server may answer the same request later
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Connections kept open per host, for the downloads running in parallel
+POOL_SIZE = 8
+
+# File where the validators of the downloaded files are saved, by URL
+VALIDATORS_PATH = utils.data_path("http_validators.json")
+
+# Number of request timings kept in memory
+MAX_TIMINGS = 1000
+
+
+@dataclass
+class RequestTiming:
+    """
+    Dataclass to represent the timing of a request, retries included.
+    """
+
+    method: str
+    url: str
+    status: int | None
+    attempts: int
+    seconds: float
+    bytes: int
+    started: pd.Timestamp
+
+
+# One pooled session per thread, as sessions are not thread-safe
+_local = threading.local()
+
+_lock = threading.Lock()
+_validators: dict[str, dict[str, str]] | None = None
+_timings: deque[RequestTiming] = deque(maxlen=MAX_TIMINGS)
+_listeners: list[Callable[[RequestTiming], None]] = []
+
+
+def get_session() -> requests.Session:
+    """
+    Gets the session of the current thread, which keeps its connections alive
+    between requests to the same host.
+    """
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _local.session = session
+    return session
+
+
+def on_request(listener: Callable[[RequestTiming], None]) -> None:
+    """
+    Registers a function called with the timing of every finished request.
+    """
+    with _lock:
+        _listeners.append(listener)
+
+
+def get_timings() -> list[RequestTiming]:
+    """
+    Gets the timings of the latest requests, oldest first.
+    """
+    with _lock:
+        return list(_timings)
+
+
+def _record(timing: RequestTiming) -> None:
+    with _lock:
+        _timings.append(timing)
+        listeners = list(_listeners)
+    for listener in listeners:
+        listener(timing)
+
+
+def _retry_delay(attempt: int, response: requests.Response | None) -> float:
+    """
+    The delay before a retry: the Retry-After of the response if it has one,
+    or an exponential backoff otherwise.
+    """
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after is not None and retry_after.isdigit():
+        return min(float(retry_after), MAX_BACKOFF_SECONDS)
+    return min(BACKOFF_SECONDS * 2**attempt, MAX_BACKOFF_SECONDS)
+
+
+def request(
+    method: str,
+    url: str,
+    timeout: float | tuple[float, float] = None,
+    retries: int = RETRIES,
+    **kwargs,
+) -> requests.Response:
+    """
+    Sends a request with the session of the current thread, retrying with an
+    exponential backoff on connection errors, timeouts and retryable statuses.
+
+    Args:
+        method (str): The HTTP method.
+        url (str): The URL to request.
+        timeout (float | tuple[float, float], optional): The connect and read timeouts,
+            in seconds. Defaults to `CONNECT_TIMEOUT` and `READ_TIMEOUT`.
+        retries (int): The number of retries after the first attempt. Defaults to `RETRIES`.
+        **kwargs: Passed to `requests.Session.request`.
+
+    Returns:
+        requests.Response: The last response, which may still have a retryable status.
+
+    Raises:
+        requests.exceptions.RequestException: If the last attempt failed without a response.
+    """
+    if timeout is None:
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+    session = get_session()
+    started = pd.Timestamp.now(tz="UTC")
+    start = time.perf_counter()
+    response = None
+
+    try:
+        for attempt in range(retries + 1):
+            try:
+                response = session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == retries:
+                    raise
+                time.sleep(_retry_delay(attempt, None))
+                continue
+
+            if response.status_code not in RETRY_STATUSES or attempt == retries:
+                return response
+
+            response.close()
+            time.sleep(_retry_delay(attempt, response))
+    finally:
+        # Streamed bodies are not read yet, count their announced length
+        if response is None:
+            size = 0
+        elif kwargs.get("stream"):
+            size = int(response.headers.get("Content-Length", 0))
+        else:
+            size = len(response.content)
+
+        _record(
+            RequestTiming(
+                method=method,
+                url=url,
+                status=None if response is None else response.status_code,
+                attempts=attempt + 1,
+                seconds=time.perf_counter() - start,
+                bytes=size,
+                started=started,
+            )
+        )
+
+
+def _load_validators() -> dict[str, dict[str, str]]:
+    global _validators
+    if _validators is None:
+        if os.path.exists(VALIDATORS_PATH):
+            with open(VALIDATORS_PATH) as file:
+                _validators = json.load(file)
+        else:
+            _validators = {}
+    return _validators
+
+
+def save_validators(url: str, response: requests.Response, path: str) -> None:
+    """
+    Saves the ETag and Last-Modified of a response once its body is saved to a
+    file, so that the next `get` of the URL is conditional.
+    """
+    validators = {
+        key: response.headers[header]
+        for key, header in (("etag", "ETag"), ("last_modified", "Last-Modified"))
+        if header in response.headers
+    }
+
+    with _lock:
+        saved = _load_validators()
+        if validators:
+            saved[url] = {**validators, "path": path}
+        elif url in saved:
+            del saved[url]
+        else:
+            return
+
+        # Write to a temporary file first, so that a crash never leaves a partial file
+        os.makedirs(os.path.dirname(VALIDATORS_PATH), exist_ok=True)
+        with open(f"{VALIDATORS_PATH}.tmp", "w") as file:
+            json.dump(saved, file, indent=2)
+        os.replace(f"{VALIDATORS_PATH}.tmp", VALIDATORS_PATH)
+
+
+def get(
+    url: str,
+    path: str = None,
+    timeout: float | tuple[float, float] = None,
+    retries: int = RETRIES,
+    **kwargs,
+) -> requests.Response:
+    """
+    Sends a GET request, made conditional if the URL was saved to `path` before
+    with validators, so that an unchanged resource is answered with a 304 and
+    no body.
+
+    Args:
+        url (str): The URL to request.
+        path (str, optional): The file the response body is saved to, see `save_validators`.
+        timeout (float | tuple[float, float], optional): See `request`.
+        retries (int): See `request`.
+        **kwargs: Passed to `requests.Session.request`.
+
+    Returns:
+        requests.Response: The response, with status 304 if the saved file is still current.
+    """
+    headers = dict(kwargs.pop("headers", None) or {})
+
+    if path is not None and os.path.exists(path):
+        with _lock:
+            validators = _load_validators().get(url)
+        if validators is not None and validators["path"] == path:
+            if "etag" in validators:
+                headers["If-None-Match"] = validators["etag"]
+            if "last_modified" in validators:
+                headers["If-Modified-Since"] = validators["last_modified"]
+
+    return request("GET", url, timeout=timeout, retries=retries, headers=headers, **kwargs)
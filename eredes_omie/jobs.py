@@ -0,0 +1,416 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+from dataclasses import dataclass
+import os
+import socket
+import sqlite3
+import time
+from typing import Callable
+
+import pandas as pd
+
+import energy_meters.shelly as shelly
+from e_redes import consumption_history
+from erse import losses_profiles
+from omie import energy_prices
+import providers.repsol as repsol
+import rollups
+import utils
+
+# Database of the backfill queue, shared by the workers
+QUEUE_PATH = utils.data_path("jobs.sqlite")
+
+# Days of OMIE prices per job, so a failure only retries a few days
+OMIE_UNIT_DAYS = 7
+
+# Attempts of a job before it is marked as failed, and the delay before the
+# first retry, doubled on each retry
+MAX_ATTEMPTS = 5
+RETRY_SECONDS = 60
+
+# Seconds a worker owns a job without a checkpoint, after which the job is
+# considered abandoned by a crashed worker and can be claimed again
+LEASE_SECONDS = 15 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    dataset TEXT NOT NULL,
+    start TEXT NOT NULL,
+    end TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    checkpoint TEXT,
+    worker TEXT,
+    lease_until REAL,
+    not_before REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL NOT NULL,
+    UNIQUE (dataset, start, end)
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (state, not_before);
+"""
+
+
+class PermanentError(Exception):
+    """
+    A job error that retrying cannot fix, such as an E-REDES month that is no
+    longer exported, so the job fails at once.
+    """
+
+
+@dataclass
+class Job:
+    """
+    Dataclass to represent a unit of backfill work: the [start, end) range of a dataset.
+
+    The checkpoint is the end of the part of the range already done, so a
+    retried job resumes after it.
+    """
+
+    id: int
+    dataset: str
+    start: pd.Timestamp
+    end: pd.Timestamp
+    attempts: int
+    checkpoint: pd.Timestamp | None
+
+
+def connect(path: str = QUEUE_PATH) -> sqlite3.Connection:
+    """
+    Opens the queue database, creating it if needed, in WAL mode so that the
+    workers can read while another one writes.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def split(dataset: str, start: pd.Timestamp, end: pd.Timestamp) -> list[tuple]:
+    """
+    Splits the [start, end) range of a dataset into the units of work of its source:
+    weeks of OMIE days, E-REDES months, and the whole range for the Shelly and
+    the ERSE workbooks, which are fetched at once.
+
+    Returns:
+        list[tuple]: The [start, end) range of each unit.
+    """
+    if dataset == "omie":
+        starts = pd.date_range(
+            start.normalize(), end, freq=f"{OMIE_UNIT_DAYS}D", inclusive="left"
+        )
+        return [(s, min(s + pd.Timedelta(days=OMIE_UNIT_DAYS), end)) for s in starts]
+    if dataset == "consumption":
+        months = pd.date_range(
+            start.normalize().replace(day=1), end, freq="MS", inclusive="left"
+        )
+        return [(m, m + pd.DateOffset(months=1)) for m in months]
+    if dataset in ("shelly", "losses"):
+        return [(start, end)]
+    raise ValueError(f"Invalid dataset: {dataset}, expected one of {list(HANDLERS)}")
+
+
+def enqueue(
+    dataset: str,
+    start: pd.Timestamp,
+    end: pd.Timestamp,
+    path: str = QUEUE_PATH,
+) -> int:
+    """
+    Adds the units of the [start, end) range of a dataset to the queue. Units
+    pending, running or failed are left as they are, so a backfill can be
+    enqueued again, while done units are queued again from their start, as
+    their range is missing again, such as the rest of the current month.
+
+    Returns:
+        int: The number of units added or queued again.
+    """
+    # The Repsol prices are derived from the OMIE prices
+    if dataset == "repsol":
+        dataset = "omie"
+
+    now = time.time()
+    with closing(connect(path)) as connection:
+        added = 0
+        connection.execute("BEGIN IMMEDIATE")
+        for unit_start, unit_end in split(dataset, start, end):
+            cursor = connection.execute(
+                """
+                INSERT INTO jobs (dataset, start, end, updated)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (dataset, start, end) DO UPDATE SET
+                    state = 'pending', attempts = 0, checkpoint = NULL,
+                    not_before = 0, error = NULL, updated = excluded.updated
+                WHERE state = 'done'
+                """,
+                (dataset, unit_start.isoformat(), unit_end.isoformat(), now),
+            )
+            added += cursor.rowcount
+        connection.execute("COMMIT")
+    return added
+
+
+def claim(connection: sqlite3.Connection, worker: str) -> Job | None:
+    """
+    Claims the next job due, pending or abandoned by a crashed worker, and
+    leases it to the worker.
+
+    The claim runs in an immediate transaction, so no two workers claim the same job.
+    """
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        row = connection.execute(
+            """
+            SELECT id, dataset, start, end, attempts, checkpoint FROM jobs
+            WHERE (state = 'pending' AND not_before <= ?)
+               OR (state = 'running' AND lease_until < ?)
+            ORDER BY id LIMIT 1
+            """,
+            (now, now),
+        ).fetchone()
+        if row is None:
+            connection.execute("COMMIT")
+            return None
+
+        connection.execute(
+            """
+            UPDATE jobs SET state = 'running', worker = ?, lease_until = ?, updated = ?
+            WHERE id = ?
+            """,
+            (worker, now + LEASE_SECONDS, now, row[0]),
+        )
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+
+    job_id, dataset, start, end, attempts, checkpoint = row
+    return Job(
+        id=job_id,
+        dataset=dataset,
+        start=pd.Timestamp(start),
+        end=pd.Timestamp(end),
+        attempts=attempts,
+        checkpoint=pd.Timestamp(checkpoint) if checkpoint else None,
+    )
+
+
+def _checkpoint(
+    connection: sqlite3.Connection, job: Job, done_until: pd.Timestamp
+) -> None:
+    """Saves the progress of a job and renews its lease."""
+    now = time.time()
+    connection.execute(
+        "UPDATE jobs SET checkpoint = ?, lease_until = ?, updated = ? WHERE id = ?",
+        (done_until.isoformat(), now + LEASE_SECONDS, now, job.id),
+    )
+    job.checkpoint = done_until
+
+
+def _finish(connection: sqlite3.Connection, job: Job, error: Exception | None) -> str:
+    """
+    Marks a job as done, or schedules its retry with an exponential backoff, or
+    marks it as failed once it ran out of attempts.
+
+    Returns:
+        str: The new state of the job.
+    """
+    now = time.time()
+    attempts = job.attempts + 1
+    if error is None:
+        state, not_before = "done", 0
+    elif isinstance(error, PermanentError) or attempts >= MAX_ATTEMPTS:
+        state, not_before = "failed", 0
+    else:
+        state, not_before = "pending", now + RETRY_SECONDS * 2 ** (attempts - 1)
+
+    connection.execute(
+        """
+        UPDATE jobs SET state = ?, attempts = ?, not_before = ?, error = ?,
+            worker = NULL, lease_until = NULL, updated = ?
+        WHERE id = ?
+        """,
+        (
+            state,
+            attempts,
+            not_before,
+            None if error is None else str(error),
+            now,
+            job.id,
+        ),
+    )
+    return state
+
+
+def _backfill_omie(job: Job, checkpoint: Callable[[pd.Timestamp], None]) -> None:
+    # Resume after the last day downloaded
+    start = job.checkpoint or job.start
+    for day in pd.date_range(start, job.end, freq="D", inclusive="left"):
+        if not energy_prices.is_available(day):
+            energy_prices.download_prices(day)
+            if not energy_prices.is_available(day):
+                raise RuntimeError(f"OMIE prices of {day.date()} not downloaded")
+        checkpoint(day + pd.Timedelta(days=1))
+
+
+def _backfill_consumption(job: Job, checkpoint: Callable[[pd.Timestamp], None]) -> None:
+    # E-REDES only exports the current and the previous month
+    current_month = utils.today().replace(day=1)
+    previous_month = (current_month - pd.Timedelta(days=1)).replace(day=1)
+    if job.start < previous_month:
+        raise PermanentError(
+            f"The consumption of {job.start:%Y-%m} can only be exported manually "
+            "from the E-REDES website"
+        )
+    consumption_history.download(previous_month=job.start < current_month)
+    checkpoint(job.end)
+
+
+def _backfill_shelly(job: Job, checkpoint: Callable[[pd.Timestamp], None]) -> None:
+    # The device keeps its recent history, download it again
+    shelly.process_energy_history()
+    checkpoint(job.end)
+
+
+def _backfill_losses(job: Job, checkpoint: Callable[[pd.Timestamp], None]) -> None:
+    # The profiles come from the ERSE workbooks, process them again
+    losses_profiles.update_losses_profiles()
+    checkpoint(job.end)
+
+
+# Runs a job of each dataset, calling the checkpoint with the end of each part done
+HANDLERS: dict[str, Callable[[Job, Callable[[pd.Timestamp], None]], None]] = {
+    "omie": _backfill_omie,
+    "consumption": _backfill_consumption,
+    "shelly": _backfill_shelly,
+    "losses": _backfill_losses,
+}
+
+
+def _finalize_omie(debug: bool) -> None:
+    energy_prices.update_prices(download=False)
+    repsol.update_prices()
+
+
+def _finalize_consumption(debug: bool) -> None:
+    consumption_history.process_consumption_history()
+    consumption_history.process_current_month_consumption_history()
+
+
+# Parses the downloaded files of each dataset once its jobs ran, and the rollup
+# series rebuilt then, as the backfilled data is older than their watermarks
+FINALIZERS: dict[str, tuple[Callable[[bool], None], list[str]]] = {
+    "omie": (_finalize_omie, ["omie_prices", "repsol_prices"]),
+    "consumption": (_finalize_consumption, ["consumption"]),
+    "shelly": (lambda debug: None, ["shelly"]),
+    "losses": (lambda debug: None, ["losses"]),
+}
+
+
+def work(path: str = QUEUE_PATH, debug: bool = False) -> dict[str, int]:
+    """
+    Claims and runs jobs until none is due, checkpointing their progress.
+
+    Returns:
+        dict[str, int]: The number of jobs done of each dataset.
+    """
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    done = {}
+    with closing(connect(path)) as connection:
+        while (job := claim(connection, worker)) is not None:
+            if debug:
+                print(f"{worker}: {job.dataset} from {job.start} to {job.end}")
+
+            try:
+                HANDLERS[job.dataset](
+                    job, lambda done_until: _checkpoint(connection, job, done_until)
+                )
+                error = None
+            except Exception as e:
+                error = e
+
+            state = _finish(connection, job, error)
+            if state == "done":
+                done[job.dataset] = done.get(job.dataset, 0) + 1
+            else:
+                print(
+                    f"\n{job.dataset} from {job.start.date()} to {job.end.date()}: "
+                    f"{state}, {error}"
+                )
+
+    return done
+
+
+def run(workers: int = 1, path: str = QUEUE_PATH, debug: bool = False) -> dict[str, int]:
+    """
+    Runs the due jobs of the queue in parallel worker processes, then parses
+    the downloaded files of the datasets with jobs done and rebuilds their rollups.
+
+    Progress is saved in the queue after every part of a job, so an interrupted
+    backfill resumes where it stopped, and failed jobs are retried on later
+    runs with an exponential backoff.
+
+    Args:
+        workers (int): The number of worker processes. Defaults to 1.
+        path (str): The path to the queue database.
+        debug (bool): If True, prints debug information. Defaults to False.
+
+    Returns:
+        dict[str, int]: The number of jobs done of each dataset.
+    """
+    if workers <= 1:
+        results = [work(path, debug)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(work, [path] * workers, [debug] * workers))
+
+    done = {}
+    for result in results:
+        for dataset, count in result.items():
+            done[dataset] = done.get(dataset, 0) + count
+
+    for dataset in done:
+        finalize, series = FINALIZERS[dataset]
+        finalize(debug)
+        for name in series:
+            rollups.rebuild(name, debug=debug)
+
+    return done
+
+
+def status(path: str = QUEUE_PATH) -> pd.DataFrame:
+    """
+    Counts the jobs of each dataset in each state.
+
+    Returns:
+        pd.DataFrame: One row per dataset and one column per state.
+    """
+    with closing(connect(path)) as connection:
+        df = pd.read_sql_query(
+            "SELECT dataset, state, COUNT(*) AS jobs FROM jobs GROUP BY dataset, state",
+            connection,
+        )
+    if len(df) == 0:
+        return pd.DataFrame()
+    return df.pivot(index="dataset", columns="state", values="jobs").fillna(0).astype(int)
+
+
+def retry_failed(path: str = QUEUE_PATH) -> int:
+    """
+    Moves the failed jobs back to pending, with their attempts reset.
+
+    Returns:
+        int: The number of jobs moved.
+    """
+    with closing(connect(path)) as connection:
+        cursor = connection.execute(
+            """
+            UPDATE jobs SET state = 'pending', attempts = 0, not_before = 0, updated = ?
+            WHERE state = 'failed'
+            """,
+            (time.time(),),
+        )
+        return cursor.rowcount
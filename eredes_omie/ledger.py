@@ -0,0 +1,187 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import energy_meters.shelly as shelly
+import providers.repsol as repsol
+import utils
+
+# Energy columns of the ledger, in kWh
+ENERGY_COLUMNS = ["bought_kWh", "exported_kWh", "solar_kWh", "consumed_kWh"]
+
+# Cost columns of the ledger, in €
+COST_COLUMNS = [
+    "bought_€",
+    "exported_€",
+    "solar_production_€",
+    "solar_consumption_€",
+    "consumed_€",
+]
+
+# Pandas frequencies of the periods supported by `get_totals`
+PERIODS = {"day": "1D", "week": "1W", "month": "1ME", "year": "1YE"}
+
+
+def compute_costs(energy_df: pd.DataFrame, prices_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Computes the energy cost breakdown for each quarter-hour.
+
+    Args:
+        energy_df (pd.DataFrame): The Shelly energy history, with grid_kWh, solar_kWh and consumed_kWh columns.
+        prices_df (pd.DataFrame): The Repsol prices, with a €/kWh column, indexed by timestamp.
+
+    Returns:
+        pd.DataFrame: The energy (kWh) and cost (€) of each quarter-hour with a known price.
+    """
+    # Keep only the quarter-hours with both energy and price data
+    df = energy_df.join(prices_df[["€/kWh"]], how="inner")
+
+    # Work on plain arrays, all the columns are computed at once
+    price = df["€/kWh"].to_numpy(dtype="float64")
+    grid = df["grid_kWh"].to_numpy(dtype="float64")
+    solar = df["solar_kWh"].to_numpy(dtype="float64")
+    consumed = df["consumed_kWh"].to_numpy(dtype="float64")
+
+    # Positive grid energy is bought, negative grid energy is exported (and lost)
+    bought = np.clip(grid, 0, None)
+    exported = np.clip(-grid, 0, None)
+
+    # The cost of each quarter-hour is clipped, as in the notebook: a positive
+    # cost is bought, a negative one is lost, as is the cost of the exported
+    # energy or of the energy bought at a negative price
+    cost = price * grid
+    bought_cost = np.clip(cost, 0, None)
+    lost_cost = np.clip(-cost, 0, None)
+
+    costs_df = pd.DataFrame(
+        {
+            "bought_kWh": bought,
+            "exported_kWh": exported,
+            "solar_kWh": solar,
+            "consumed_kWh": consumed,
+            "bought_€": bought_cost,
+            "exported_€": lost_cost,
+            "solar_production_€": price * solar,
+            "solar_consumption_€": price * solar - lost_cost,
+            "consumed_€": price * consumed,
+        },
+        index=df.index,
+    )
+
+    return costs_df
+
+
+def rollup_daily(costs_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Sums the quarter-hour costs per day, counting the quarter-hours of each day.
+    """
+    daily_df = costs_df.resample("1D").sum()
+    daily_df.insert(0, "slots", costs_df["consumed_€"].resample("1D").count())
+
+    # Drop the days without any quarter-hour
+    return daily_df[daily_df["slots"] > 0]
+
+
+def get_daily_costs(
+    path: str = utils.data_path("cost_ledger_daily.csv"),
+) -> pd.DataFrame:
+    """
+    Loads the daily cost rollups.
+
+    Args:
+        path (str): The path to the daily rollups CSV file.
+
+    Returns:
+        pd.DataFrame: The daily energy and costs, indexed by day. Empty if no rollups were saved yet.
+    """
+    if not os.path.exists(path):
+        return pd.DataFrame(
+            columns=["slots"] + ENERGY_COLUMNS + COST_COLUMNS,
+            index=pd.DatetimeIndex([], tz="UTC", name="starting_datetime"),
+        )
+
+    return pd.read_csv(path, index_col=0, parse_dates=["starting_datetime"])
+
+
+def update_daily_costs(
+    path: str = utils.data_path("cost_ledger_daily.csv"), debug: bool = False
+) -> pd.DataFrame:
+    """
+    Updates the daily cost rollups with the days not rolled up yet.
+
+    Only the quarter-hours since the last saved day are read and computed, that day
+    included, as it may have been incomplete when it was last rolled up.
+
+    Args:
+        path (str): The path to the daily rollups CSV file.
+        debug (bool): If True, prints debug information. Defaults to False.
+
+    Returns:
+        pd.DataFrame: The updated daily energy and costs, indexed by day.
+    """
+    # Load the saved rollups
+    daily_df = get_daily_costs(path)
+
+    # The costs are computed from the Shelly energy history, saved by its stage
+    if not os.path.exists(utils.data_path("shelly_energy_history.csv")):
+        print("\nSkipping the cost ledger, no Shelly energy history saved yet.")
+        return daily_df
+
+    # Recompute from the last saved day, or from the start of the history
+    start = daily_df.index.max() if len(daily_df) > 0 else None
+    if debug:
+        print(f"Updating the cost ledger from {start}...")
+
+    # Load only the new energy and prices data
+    energy_df = shelly.get_energy_history(start=start)
+    prices_df = repsol.get_prices(start=start).set_index("starting_datetime")
+
+    # Compute the new quarter-hours and roll them up per day
+    new_daily_df = rollup_daily(compute_costs(energy_df, prices_df))
+
+    # Replace the recomputed days
+    if start is not None:
+        daily_df = daily_df[daily_df.index < start]
+    daily_df = pd.concat([daily_df, new_daily_df]) if len(daily_df) > 0 else new_daily_df
+    daily_df.index.name = "starting_datetime"
+
+    # Save the rollups to a CSV file
+    daily_df.to_csv(path)
+
+    if debug:
+        print(f"Cost ledger updated with {len(new_daily_df)} days.")
+
+    return daily_df
+
+
+def get_totals(
+    period: str = "day",
+    start: pd.Timestamp = None,
+    end: pd.Timestamp = None,
+    path: str = utils.data_path("cost_ledger_daily.csv"),
+) -> pd.DataFrame:
+    """
+    Gets the energy and cost totals per day, week, month or year from the daily rollups.
+
+    Args:
+        period (str): One of "day", "week", "month" or "year". Defaults to "day".
+        start (pd.Timestamp, optional): The first day to include. Defaults to the start of the ledger.
+        end (pd.Timestamp, optional): The first day not to include. Defaults to the end of the ledger.
+        path (str): The path to the daily rollups CSV file.
+
+    Returns:
+        pd.DataFrame: The totals of each period, indexed by the end of the period.
+    """
+    if period not in PERIODS:
+        raise ValueError(f"Invalid period: {period}, expected one of {list(PERIODS)}")
+
+    daily_df = get_daily_costs(path)
+
+    # Filter the requested days
+    if start is not None:
+        daily_df = daily_df[daily_df.index >= start]
+    if end is not None:
+        daily_df = daily_df[daily_df.index < end]
+
+    return daily_df.resample(PERIODS[period]).sum()
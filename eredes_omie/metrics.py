@@ -0,0 +1,189 @@
+from contextlib import contextmanager
+import os
+import threading
+import time
+from typing import Iterator
+
+import pandas as pd
+
+import cache
+import http_client
+import rollups
+import utils
+
+# File read by the textfile collector of the Prometheus node exporter
+METRICS_PATH = os.getenv("EREDES_OMIE_METRICS_PATH") or utils.data_path(
+    "eredes_omie.prom"
+)
+
+# Prefix of the names of the metrics
+PREFIX = "eredes_omie"
+
+# Metrics written, with their type and help. The counters count since the
+# process started, a run of the pipeline or the whole life of the daemon.
+METRICS = {
+    "downloads_total": ("counter", "Downloads, by source and status, ok or error."),
+    "downloads_seconds_total": ("counter", "Seconds spent downloading, with retries."),
+    "downloads_bytes_total": ("counter", "Bytes downloaded."),
+    "rows_parsed_total": ("counter", "Rows parsed, by stage."),
+    "cache_hits_total": ("counter", "Datasets loaded from the in-memory cache."),
+    "cache_misses_total": ("counter", "Datasets loaded from their files."),
+    "cache_evictions_total": ("counter", "Datasets evicted from the in-memory cache."),
+    "plot_renders_total": ("counter", "Charts rendered, by plot."),
+    "plot_renders_seconds_total": ("counter", "Seconds spent rendering charts, by plot."),
+    "latest_slot_timestamp_seconds": (
+        "gauge",
+        "Start of the latest quarter-hour of each dataset, in Unix time.",
+    ),
+    "data_age_seconds": (
+        "gauge",
+        "Seconds from the start of the latest quarter-hour of each dataset to the write.",
+    ),
+    "last_write_timestamp_seconds": ("gauge", "Time of the last write, in Unix time."),
+}
+
+_lock = threading.Lock()
+_values: dict[tuple[str, tuple[tuple[str, str], ...]], float] = {}
+_sources: dict[str, str] = {}
+
+
+def inc(name: str, value: float = 1, **labels: str) -> None:
+    """
+    Adds a value to a counter. A dictionary update under a lock, cheap enough
+    to call once per stage or download, but not once per row.
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _values[key] = _values.get(key, 0) + value
+
+
+def set_gauge(name: str, value: float, **labels: str) -> None:
+    """Sets the value of a gauge."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _values[key] = value
+
+
+@contextmanager
+def timer(name: str, **labels: str) -> Iterator[None]:
+    """
+    Counts a run of the block in the `{name}_total` counter and its duration in
+    the `{name}_seconds_total` counter.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        inc(f"{name}_total", **labels)
+        inc(f"{name}_seconds_total", time.perf_counter() - start, **labels)
+
+
+def download_source(prefix: str, source: str) -> None:
+    """
+    Names the source of the downloads whose URL starts with a prefix, as the
+    source label of their metrics.
+    """
+    with _lock:
+        _sources[prefix] = source
+
+
+def record_download(source: str, seconds: float, size: int, status: str = "ok") -> None:
+    """Counts a download, its duration and its size."""
+    inc("downloads_total", source=source, status=status)
+    inc("downloads_seconds_total", seconds, source=source)
+    inc("downloads_bytes_total", size, source=source)
+
+
+def _record_request(timing: http_client.RequestTiming) -> None:
+    with _lock:
+        source = next(
+            (name for prefix, name in _sources.items() if timing.url.startswith(prefix)),
+            "other",
+        )
+    # Not modified responses are successful conditional downloads
+    ok = timing.status is not None and timing.status < 400
+    record_download(source, timing.seconds, timing.bytes, "ok" if ok else "error")
+
+
+# Every request of the HTTP client is a download
+http_client.on_request(_record_request)
+
+
+def _collect(now: pd.Timestamp) -> None:
+    """
+    Sets the metrics read when writing: the cache counters, kept by the cache
+    itself, and the freshness of the datasets, from the rollup watermarks.
+    """
+    stats = cache.stats()
+    for stat in ("hits", "misses", "evictions"):
+        set_gauge(f"cache_{stat}_total", stats[stat])
+
+    for series, watermark in rollups.get_watermarks().items():
+        set_gauge("latest_slot_timestamp_seconds", watermark.timestamp(), dataset=series)
+        set_gauge(
+            "data_age_seconds", (now - watermark).total_seconds(), dataset=series
+        )
+
+    set_gauge("last_write_timestamp_seconds", now.timestamp())
+
+
+def _escape(value: str) -> str:
+    """Escapes a label value, as the exposition format requires."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render() -> str:
+    """
+    Formats the metrics in the Prometheus text exposition format.
+    """
+    with _lock:
+        values = dict(_values)
+
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        samples = sorted(
+            (labels, value) for (key, labels), value in values.items() if key == name
+        )
+        if not samples:
+            continue
+        lines.append(f"# HELP {PREFIX}_{name} {description}")
+        lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{_escape(text)}"' for key, text in labels)
+            label_text = f"{{{label_text}}}" if label_text else ""
+            lines.append(f"{PREFIX}_{name}{label_text} {_format_value(value)}")
+
+    return "\n".join(lines) + "\n"
+
+
+def write(path: str = METRICS_PATH, debug: bool = False) -> str:
+    """
+    Writes the metrics to a textfile of the node exporter, after each run of the
+    pipeline and each round of the daemon.
+
+    The file is written to a temporary file and renamed, so the collector never
+    reads a partial file. The temporary name does not end in .prom, so the
+    collector ignores it.
+
+    Args:
+        path (str): The path to the textfile.
+        debug (bool): If True, prints debug information. Defaults to False.
+
+    Returns:
+        str: The path to the textfile.
+    """
+    _collect(pd.Timestamp.now(tz="UTC"))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w") as file:
+        file.write(render())
+    os.replace(f"{path}.tmp", path)
+
+    if debug:
+        print(f"Metrics written to {path}")
+
+    return path
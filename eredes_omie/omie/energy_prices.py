@@ -1,12 +1,31 @@
-import glob
+import io
 import os
+import re
+import zipfile
 
 import pandas as pd
-import requests
+import cache
+import coverage
+import http_client
+import metrics
+import rollups
 import utils
 from typing import Optional
 from requests.exceptions import SSLError, RequestException
 
+# Directory where the daily prices files are saved
+PRICES_DIR = utils.shared_path("energy_prices")
+
+# Downloads from OMIE are counted as its source in the metrics
+metrics.download_source("https://www.omie.es/", "omie")
+
+# Names of the daily prices files and of the monthly archives packing them
+DAILY_FILE_PATTERN = re.compile(r"marginalpdbcpt_(\d{8})\.1")
+ARCHIVE_PATTERN = re.compile(r"marginalpdbcpt_(\d{6})\.zip")
+
+# Names of the files inside each archive, by archive path: (modification time, names)
+_archive_names: dict[str, tuple[int, set[str]]] = {}
+
 
 def download_prices(requested_date: Optional[pd.Timestamp] = None) -> None:
     """
@@ -25,24 +44,29 @@ def download_prices(requested_date: Optional[pd.Timestamp] = None) -> None:
     # Define the URL for the OMIE's website
     url = f"https://www.omie.es/pt/file-download?parents%5B0%5D=marginalpdbcpt&filename=marginalpdbcpt_{requested_date_str}.1"
 
+    # Define the path where the file is saved
+    dir_path = utils.shared_path("energy_prices")
+    file_path = os.path.join(dir_path, f"marginalpdbcpt_{requested_date_str}.1")
+
     try:
-        # Send a GET request to the URL
-        response = requests.get(url, verify=True)
+        # Send a GET request to the URL, conditional if the file was downloaded before
+        response = http_client.get(url, path=file_path, verify=True)
+
+        # Check if the file did not change since it was downloaded
+        if response.status_code == 304:
+            print(f"\nEnergy prices for date {requested_date_str} did not change")
 
         # Check if the request was successful
-        if response.status_code == 200 and response.content != b"":
+        elif response.status_code == 200 and response.content != b"":
             print(f"\nDownloaded energy prices for date: {requested_date_str}")
 
-            # Define the directory for saving the file
-            dir_path = "/workspace/data/energy_prices/"
             # Create the directory if it does not exist
             os.makedirs(dir_path, exist_ok=True)
 
-            # Save the content to a file
-            with open(
-                os.path.join(dir_path, f"marginalpdbcpt_{requested_date_str}.1"), "wb"
-            ) as file:
+            # Save the content to a file, and its validators for the next download
+            with open(file_path, "wb") as file:
                 file.write(response.content)
+            http_client.save_validators(url, response, file_path)
         else:
             print(f"\nFailed to download energy prices for date: {requested_date_str}")
     except SSLError as e:
@@ -55,31 +79,167 @@ def download_prices(requested_date: Optional[pd.Timestamp] = None) -> None:
         )
 
 
+def _archive_path(month_str: str, dir_path: str = PRICES_DIR) -> str:
+    return os.path.join(dir_path, f"marginalpdbcpt_{month_str}.zip")
+
+
+def get_archive_names(archive_path: str) -> set[str]:
+    """
+    Gets the names of the daily files packed in a monthly archive, read from the
+    archive index only once for each version of the archive.
+    """
+    if not os.path.exists(archive_path):
+        return set()
+
+    mtime = os.stat(archive_path).st_mtime_ns
+    cached = _archive_names.get(archive_path)
+    if cached is None or cached[0] != mtime:
+        with zipfile.ZipFile(archive_path) as archive:
+            cached = (mtime, set(archive.namelist()))
+        _archive_names[archive_path] = cached
+
+    return cached[1]
+
+
+def get_available_dates(dir_path: str = PRICES_DIR) -> set[str]:
+    """
+    Gets the dates, in the format YYYYMMDD, of all the prices files available,
+    either loose or packed in a monthly archive, with a single directory listing.
+    """
+    if not os.path.isdir(dir_path):
+        return set()
+
+    dates = set()
+    for name in os.listdir(dir_path):
+        daily_match = DAILY_FILE_PATTERN.fullmatch(name)
+        archive_match = ARCHIVE_PATTERN.fullmatch(name)
+        if daily_match:
+            dates.add(daily_match.group(1))
+        elif archive_match:
+            for packed_name in get_archive_names(os.path.join(dir_path, name)):
+                packed_match = DAILY_FILE_PATTERN.fullmatch(packed_name)
+                if packed_match:
+                    dates.add(packed_match.group(1))
+
+    return dates
+
+
+def iter_prices_files(dir_path: str = PRICES_DIR):
+    """
+    Yields the name and content of every daily prices file, loose or packed, sorted by date.
+    A loose file takes precedence over a packed file of the same day.
+    """
+    if not os.path.isdir(dir_path):
+        return
+
+    names = sorted(os.listdir(dir_path))
+    loose = {name for name in names if DAILY_FILE_PATTERN.fullmatch(name)}
+
+    # Locate every file, loose or inside its archive
+    locations = {name: None for name in loose}
+    for name in names:
+        if ARCHIVE_PATTERN.fullmatch(name):
+            archive_path = os.path.join(dir_path, name)
+            for packed_name in get_archive_names(archive_path):
+                if packed_name not in loose:
+                    locations[packed_name] = archive_path
+
+    # Read the files in date order, opening each archive only once
+    open_archives = {}
+    try:
+        for name in sorted(locations):
+            archive_path = locations[name]
+            if archive_path is None:
+                with open(os.path.join(dir_path, name), "rb") as file:
+                    yield name, file.read()
+            else:
+                if archive_path not in open_archives:
+                    open_archives[archive_path] = zipfile.ZipFile(archive_path)
+                yield name, open_archives[archive_path].read(name)
+    finally:
+        for archive in open_archives.values():
+            archive.close()
+
+
+def pack_prices(dir_path: str = PRICES_DIR, debug: bool = False) -> int:
+    """
+    Packs the daily prices files of every closed month into one compressed archive
+    per month, and removes the packed loose files. Files of the current month stay loose.
+
+    Args:
+        dir_path (str): The directory of the daily prices files.
+        debug (bool): If True, prints debug information. Defaults to False.
+
+    Returns:
+        int: The number of files packed.
+    """
+    current_month_str = utils.today().strftime("%Y%m")
+
+    # Group the loose files of the closed months by month
+    months: dict[str, list[str]] = {}
+    for name in sorted(os.listdir(dir_path)):
+        match = DAILY_FILE_PATTERN.fullmatch(name)
+        if match and match.group(1)[:6] < current_month_str:
+            months.setdefault(match.group(1)[:6], []).append(name)
+
+    packed = 0
+    for month_str, names in months.items():
+        archive_path = _archive_path(month_str, dir_path)
+        temp_path = f"{archive_path}.tmp"
+
+        # Rewrite the archive with its current and new files, then replace it at once
+        with zipfile.ZipFile(temp_path, "w", compression=zipfile.ZIP_DEFLATED) as temp:
+            if os.path.exists(archive_path):
+                with zipfile.ZipFile(archive_path) as archive:
+                    for packed_name in archive.namelist():
+                        if packed_name not in names:
+                            temp.writestr(packed_name, archive.read(packed_name))
+            for name in names:
+                temp.write(os.path.join(dir_path, name), arcname=name)
+        os.replace(temp_path, archive_path)
+
+        # Remove the loose files only once they are safely packed
+        for name in names:
+            os.remove(os.path.join(dir_path, name))
+        packed += len(names)
+
+        if debug:
+            print(f"Packed {len(names)} prices files into {archive_path}")
+
+    return packed
+
+
 def check_and_download(
-    start_date: pd.Timestamp = utils.check_start(),
-    end_date: pd.Timestamp = utils.tomorrow(),
+    start_date: pd.Timestamp = None,
+    end_date: pd.Timestamp = None,
 ) -> None:
     """
     Checks if the price data files for the given date range exist, and downloads the missing files.
 
     Args:
-        start_date (pd.Timestamp): The start date of the date range to check. Defaults to `__check_start__`.
-        end_date (pd.Timestamp): The end date of the date range to check. Defaults to `__tomorrow__`.
+        start_date (pd.Timestamp): The start date of the date range to check. Defaults to `utils.check_start()`.
+        end_date (pd.Timestamp): The end date of the date range to check. Defaults to tomorrow, when called.
 
     Raises:
         None
     """
+    # Resolve the defaults on each call, a long-running process crosses days
+    if start_date is None:
+        start_date = utils.check_start()
+    if end_date is None:
+        end_date = utils.tomorrow()
+
+    # Get all the available dates at once, loose or packed
+    available_dates = get_available_dates()
+
     # Iterate over the dates from start_date to end_date
     current_date = start_date
     while current_date <= end_date:
         # Convert date to the format YYYYMMDD
         date_str = current_date.strftime("%Y%m%d")
 
-        # Define the file path
-        file_path = f"/workspace/data/energy_prices/marginalpdbcpt_{date_str}.1"
-
         # Check if the file exists
-        if not os.path.exists(file_path):
+        if date_str not in available_dates:
             # If the file doesn't exist, download the data for this date
             download_prices(current_date)
 
@@ -113,31 +273,33 @@ def add_missing_timeslots(temp_df: pd.DataFrame) -> pd.DataFrame:
     return temp_df
 
 
-def update_prices() -> pd.DataFrame:
+def update_prices(download: bool = True) -> pd.DataFrame:
     """
     Updates the energy prices data by reading in all the CSV files in
-    the "/workspace/data/energy_prices/" directory, concatenating the data
+    the energy_prices directory of the shared data, loose or packed in the
+    monthly archives, concatenating the data
     into a single DataFrame, and writing the result to a CSV file
-    at "/workspace/data/energy_prices.csv". The function also calculates
+    at energy_prices.csv in the shared data. The function also calculates
     the maximum and minimum price for each year and prints the results.
 
+    Args:
+        download (bool): If True, downloads the missing days first. Defaults to True.
+
     Returns:
         pd.DataFrame: The updated energy prices data.
     """
     # Assure all available prices are downloaded
-    check_and_download()
-
-    # Get a list of all the files in the data folder
-    files = sorted(glob.glob(os.path.join("/workspace/data/energy_prices", "*.1")))
+    if download:
+        check_and_download()
 
     # Initialize a list to store the dataframes
     dfs = []
 
-    # Iterate over each file
-    for file in files:
+    # Iterate over each file in the data folder, loose or packed
+    for _, content in iter_prices_files():
         # Read the file into a dataframe, ignoring the last line
         temp_df = pd.read_csv(
-            file,
+            io.BytesIO(content),
             sep=";",
             skiprows=1,
             skipfooter=1,
@@ -176,24 +338,31 @@ def update_prices() -> pd.DataFrame:
         # Append the dataframe to the list
         dfs.append(temp_df[["portugal€/MWh"]])
 
-    # Concatenate all dataframes in the list
-    df = pd.concat(dfs)
+    # Concatenate all dataframes in the list, sorted by slot for `read_csv_range`
+    df = pd.concat(dfs).sort_index(kind="stable")
 
     # Reset the index
     df.reset_index(inplace=True)
 
     df.columns = ["starting_datetime", "€/MWh"]
+    metrics.inc("rows_parsed_total", len(df), stage="omie_prices")
 
     # Set the 'starting_datetime' column as UTC
     df["starting_datetime"] = df["starting_datetime"].dt.tz_localize("UTC")
 
     # Write the dataframe to a single csv file
-    df.to_csv("/workspace/data/energy_prices.csv", index=False)
+    df.to_csv(utils.shared_path("energy_prices.csv"), index=False)
+
+    # Cache the dataframe, so that the next stages do not parse the file again
+    cache.put(utils.shared_path("energy_prices.csv"), df)
+
+    # Fold the new prices into the rollups and mark their slots as present
+    rollups.ingest("omie_prices", df)
+    coverage.mark("omie", df["starting_datetime"])
 
-    # Group by year and calculate the maximum and minimum price
-    max_min_prices = df.groupby(df["starting_datetime"].dt.year)["€/MWh"].agg(
-        ["max", "min", "mean"]
-    )
+    # Get the maximum, minimum and mean price for each year from the rollups
+    max_min_prices = rollups.stats("omie_prices", "€/MWh", "year", ["max", "min", "mean"])
+    max_min_prices.index = max_min_prices.index.year
 
     # Print the maximum and minimum price for each year
     print(f"\nEnergy prices per year (€/MWh):\n{max_min_prices}")
@@ -202,32 +371,34 @@ def update_prices() -> pd.DataFrame:
     return df
 
 
+def _read_prices(path: str) -> pd.DataFrame:
+    return pd.read_csv(path, parse_dates=["starting_datetime"])
+
+
 def get_prices() -> pd.DataFrame:
     """
-    Loads the losses profiles data from a CSV file.
+    Loads the energy prices data from a CSV file, or from the cache if it did not change.
 
     Returns:
-        pd.DataFrame: A DataFrame containing the losses profiles data.
+        pd.DataFrame: A DataFrame containing the energy prices data.
     """
-    # Load the dataframe from a CSV file
-    df = pd.read_csv("/workspace/data/energy_prices.csv")
-
-    # Return the dataframe
-    return df
+    return cache.load(utils.shared_path("energy_prices.csv"), _read_prices)
 
 
 def is_available(date: pd.Timestamp) -> bool:
     """
-    Checks if the energy prices data is available for the given date.
+    Checks if the energy prices data is available for the given date,
+    either as a loose file or packed in its monthly archive.
     """
     # Convert date to the format YYYYMMDD
     date_str = date.strftime("%Y%m%d")
 
-    # Define the file path
-    file_path = f"/workspace/data/energy_prices/marginalpdbcpt_{date_str}.1"
+    # Define the file name and path
+    file_name = f"marginalpdbcpt_{date_str}.1"
+    file_path = os.path.join(PRICES_DIR, file_name)
 
-    # Check if the file exists
+    # Check if the file exists, or if it is packed in its monthly archive
     if os.path.exists(file_path):
         return True
     else:
-        return False
+        return file_name in get_archive_names(_archive_path(date_str[:6]))
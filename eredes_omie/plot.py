@@ -1,4 +1,3 @@
-from datetime import datetime, timedelta
 import shutil
 
 from matplotlib.figure import Figure
@@ -7,85 +6,210 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 
+import metrics
 import providers.repsol as repsol
+import reconcile
+import rollups
+import utils
 
-def weekly_energy_consumption(debug: bool = False) -> None:
+
+def downsample(series: pd.Series, buckets: int) -> pd.Series:
     """
-    Plots the weekly energy consumption for the current month.
+    Reduces a time series to its min/max envelope: the time range is split into
+    buckets of equal duration, usually one per pixel of the chart, and only the
+    lowest and highest points of each bucket are kept, in time order.
+
+    The line drawn through the envelope has the same peaks as the full series,
+    while the points drawn, and so the render time and the image size, are
+    bounded by the width of the chart and not by the length of the series.
+
+    Args:
+        series (pd.Series): The series, indexed by timestamp in ascending order.
+        buckets (int): The number of buckets, at most two points are kept from each.
+
+    Returns:
+        pd.Series: The points of the envelope, the series itself if it is short enough.
     """
+    if len(series) <= 2 * buckets:
+        return series
 
+    # Assign each point to the bucket of its time
+    times = series.index.asi8
+    edges = np.linspace(times[0], times[-1], buckets + 1)[1:-1]
+    bucket = np.searchsorted(edges, times, side="right")
 
-    current_month_consumption_history_df = pd.read_csv(
-        "/workspace/data/current_month_consumption_history.csv",
-        sep=",",
-        header=0,
-        index_col=0,
-        names=["timestamp_utc", "Consumption (kWh)", "Injection (kWh)"],
-        dtype={"Consumption (kWh)": "Float64", "Injection (kWh)": "Float64"},
-        parse_dates=["timestamp_utc"],
-    )
-    shelly_consumption_history_df = pd.read_csv(
-        "/workspace/data/shelly_consumption_history.csv",
-        sep=",",
-        header=0,
-        index_col=0,
-        names=["timestamp_utc", "Grid (kWh)", "Solar (kWh)", "Consumed (kWh)"],
-        dtype={
-            "Grid (kWh)": "Float64",
-            "Solar (kWh)": "Float64",
-            "Consumed (kWh)": "Float64",
-        },
-        parse_dates=["timestamp_utc"],
-    )
+    # Missing values are kept only in buckets without any value, to keep the gaps
+    values = series.to_numpy(dtype="float64")
+    missing = np.isnan(values)
+    lowest = np.lexsort((np.where(missing, np.inf, values), bucket))
+    highest = np.lexsort((np.where(missing, -np.inf, values), bucket))
+
+    # The sorted points of each bucket are contiguous: take the first and the last
+    starts = np.flatnonzero(np.diff(bucket[lowest], prepend=-1))
+    ends = np.append(starts[1:], len(values)) - 1
+    keep = np.union1d(lowest[starts], highest[ends])
+    return series.iloc[keep]
+
+
+def _plot(ax: plt.Axes, series: pd.Series, **kwargs) -> None:
+    """
+    Plots a series on an axis, downsampled to one bucket per pixel of its width.
+    """
+    series = downsample(series, max(int(ax.get_window_extent().width), 1))
+    ax.plot(series.index, series.to_numpy(), **kwargs)
+
+
+def energy_consumption_window(
+    days: int = 7, start_date: str = None, end_date: str = None
+) -> tuple[pd.Timestamp, pd.Timestamp]:
+    """
+    Computes the [start, end) window of the energy consumption chart.
+
+    Args:
+        days (int): Number of days before today shown when no start date is given. Defaults to 7.
+        start_date (str, optional): The first day of the window, in YYYY-MM-DD format.
+        end_date (str, optional): The last day of the window (inclusive), in YYYY-MM-DD format. Defaults to today.
+
+    Returns:
+        tuple[pd.Timestamp, pd.Timestamp]: The start and the (exclusive) end of the window, in UTC.
+    """
+    # The window ends at the end of the last day, which defaults to today
+    if end_date is None or end_date == "":
+        end = utils.tomorrow()
+    else:
+        end = utils.parse_date(end_date) + pd.Timedelta(days=1)
+
+    # The window starts at the given day, or the given number of days before the last day
+    if start_date is None or start_date == "":
+        start = end - pd.Timedelta(days=days + 1)
+    else:
+        start = utils.parse_date(start_date)
+
+    return start, end
+
+
+def hourly_energy(
+    start: pd.Timestamp = None,
+    end: pd.Timestamp = None,
+    prices_df: pd.DataFrame = None,
+) -> pd.DataFrame:
+    """
+    Combines the hourly rollups of the energy series in [start, end): the grid
+    energy measured by E-REDES, or by the Shelly where E-REDES did not report
+    yet, the solar production and the cost of the bought energy.
+
+    Args:
+        start (pd.Timestamp, optional): The first hour. Defaults to the first hour of the rollups.
+        end (pd.Timestamp, optional): The first hour not combined. Defaults to the last hour of the rollups.
+        prices_df (pd.DataFrame, optional): The hourly Repsol price rollups. Defaults to loading them.
+
+    Returns:
+        pd.DataFrame: The Grid (kWh), Solar (kWh), €/kWh_mean and Grid (€) of each hour, indexed by hour.
+    """
+    # Load the hourly rollups of the range from each series
+    consumption_df = rollups.get("consumption", "hour", start=start, end=end)
+    shelly_df = rollups.get("shelly", "hour", start=start, end=end)
+    if prices_df is None:
+        prices_df = rollups.get("repsol_prices", "hour", start=start, end=end)
+
+    # Prefer the E-REDES readings over the Shelly grid readings, the cost of
+    # each hour being the sum of the costs of its quarter-hours
     e_redes_df = pd.DataFrame()
     e_redes_df.loc[:, "Grid (kWh)"] = (
-        +current_month_consumption_history_df.loc[:, "Consumption (kWh)"]
-        - current_month_consumption_history_df.loc[:, "Injection (kWh)"]
+        +consumption_df.loc[:, "consumption_kwh_sum"]
+        - consumption_df.loc[:, "injection_kwh_sum"]
+    )
+    e_redes_df.loc[:, "Grid (€)"] = consumption_df.loc[:, f"{rollups.GRID_COST}_sum"]
+    shelly_hourly_df = pd.DataFrame(
+        {
+            "Grid (kWh)": shelly_df["grid_kWh_sum"],
+            "Solar (kWh)": shelly_df["solar_kWh_sum"],
+            "Grid (€)": shelly_df[f"{rollups.GRID_COST}_sum"],
+        }
     )
-    combine_df = e_redes_df.combine_first(shelly_consumption_history_df)[["Grid (kWh)"]]
-    energy_consumtion_history_df = combine_df.join(
-        shelly_consumption_history_df[["Solar (kWh)"]], how="left"
+
+    # Calibrate the Shelly grid readings to what E-REDES would report, as they
+    # only fill the hours E-REDES did not report yet, the cost being of bought energy
+    factors = reconcile.calibration_factors()
+    shelly_hourly_df["Grid (kWh)"] = reconcile.calibrate(
+        shelly_hourly_df["Grid (kWh)"], factors
     )
-    # Get the current date and time
-    today = datetime.now().date()
+    shelly_hourly_df["Grid (€)"] *= factors["consumption_factor"]
+    combine_df = e_redes_df.combine_first(shelly_hourly_df)[["Grid (kWh)", "Grid (€)"]]
+    df = combine_df.join(shelly_hourly_df[["Solar (kWh)"]], how="left")
+
+    # Join the mean price of each hour
+    df = df.join(prices_df[["€/kWh_mean"]], how="left")
+    df = df[["Grid (kWh)", "Solar (kWh)", "€/kWh_mean", "Grid (€)"]].fillna(0)
 
-    # Calculate the date and time for days ago
-    days_ago = today - timedelta(days=7)
-    days_ago = pd.Timestamp(days_ago).normalize().tz_localize("UTC")
+    return df
 
-    # Calculate the end of today
-    end_of_today = (
-        pd.Timestamp(today).normalize().tz_localize("UTC")
-        + pd.Timedelta(days=1)
-        - pd.Timedelta(seconds=1)
+
+@metrics.timer("plot_renders", plot="weekly_energy")
+def weekly_energy_consumption(
+    days: int = 7,
+    start_date: str = None,
+    end_date: str = None,
+    show: bool = False,
+    debug: bool = False,
+) -> None:
+    """
+    Plots the energy consumption and prices for a window of days, by default the last week.
+
+    The chart is drawn from the hourly rollups of the window, so the time spent
+    depends on the length of the window and not on the length of the history.
+    Each series is downsampled to the width of the chart before drawing, which
+    keeps the hourly points of a week as they are and bounds the points of the
+    windows longer than about three months.
+
+    Args:
+        days (int): Number of days before today shown when no start date is given. Defaults to 7.
+        start_date (str, optional): The first day of the window, in YYYY-MM-DD format.
+        end_date (str, optional): The last day of the window (inclusive), in YYYY-MM-DD format. Defaults to today.
+        show (bool): If True, also shows the chart, which blocks until its window is closed. Defaults to False.
+        debug (bool): If True, prints debug information. Defaults to False.
+    """
+    # Calculate the window of the chart
+    days_ago, end_of_window = energy_consumption_window(
+        days=days, start_date=start_date, end_date=end_date
     )
+    last_day = (end_of_window - pd.Timedelta(days=1)).date()
 
-    # Filter the DataFrame to only include data since two days ago
-    energy_consumtion_history_df_last_days = energy_consumtion_history_df[
-        energy_consumtion_history_df.index >= days_ago
-    ]
+    # Calculate the end of the last day
+    end_of_today = end_of_window - pd.Timedelta(seconds=1)
 
-    repsol_prices_df = repsol.get_prices()
-    repsol_prices_df.index = repsol_prices_df["starting_datetime"]
-    repsol_prices_df.drop(columns=["starting_datetime"], inplace=True)
+    if debug:
+        print(f"Loading energy rollups from {days_ago} to {end_of_window}...")
 
-    energy_consumtion_history_df_last_days = energy_consumtion_history_df_last_days.join(
-        repsol_prices_df, how="left"
+    # Load the hourly price rollups of the window
+    repsol_prices_df = rollups.get(
+        "repsol_prices", "hour", start=days_ago, end=end_of_window
     )
 
-    energy_consumtion_history_df_last_days.loc[:, "Grid (€)"] = (
-        energy_consumtion_history_df_last_days["€/kWh"]
-        * energy_consumtion_history_df_last_days["Grid (kWh)"]
-    ).clip(lower=0)
+    # Combine the grid and solar energy and the cost of each hour
+    df = hourly_energy(days_ago, end_of_window, prices_df=repsol_prices_df)
 
-    # Assuming that energy_consumtion_history_df_last_days is your DataFrame
-    df = energy_consumtion_history_df_last_days.resample("1h").sum()
+    # Calculate the sum of the 'Grid (€)' column for each day
+    daily_grid_euro = df.groupby(df.index.date)["Grid (€)"].sum()
 
     # Calculate the cumulative sum of the 'Grid (€)' column for each day
-    df["Grid (€)"] = df.groupby(df.index.day)["Grid (€)"].cumsum()
-
-    # Calculate the date and time for two days ago
-    latest_real_timestamp = current_month_consumption_history_df.index.max()
+    df["Grid (€)"] = df.groupby(df.index.date)["Grid (€)"].cumsum()
+
+    # Get the latest timestamp measured by E-REDES, or the start of the window if none
+    latest_real_timestamp = rollups.get_watermark("consumption")
+    if latest_real_timestamp is None:
+        latest_real_timestamp = days_ago
+
+    # Tell how far apart both sources are over the window
+    window_summary = reconcile.summary(start=days_ago, end=end_of_window)
+    if window_summary["slots"] > 0:
+        print(
+            f"\nShelly vs E-REDES from {days_ago.date()} to {last_day}: "
+            f"bias {window_summary['bias_kWh'] * 1000:.2f} Wh, "
+            f"mean absolute deviation {window_summary['mae_kWh'] * 1000:.2f} Wh and "
+            f"maximum deviation {window_summary['max_abs_delta_kWh'] * 1000:.2f} Wh "
+            f"per quarter-hour."
+        )
 
     # Set the style of seaborn
     sns.set_style("whitegrid")
@@ -95,25 +219,25 @@ def weekly_energy_consumption(debug: bool = False) -> None:
     )
     fig, (ax1, ax3) = res
     fig.suptitle(
-        f"Energy consumption and prices - {days_ago.date()} to {today}", fontsize=16
+        f"Energy consumption and prices - {days_ago.date()} to {last_day}", fontsize=16
     )
 
     ax1.set_xlabel("Time")
     ax1.set_ylabel("Energy (kWh)", color="tab:blue")
-    ax1.plot(
-        df[df.index <= latest_real_timestamp].index,
+    _plot(
+        ax1,
         df[df.index <= latest_real_timestamp]["Grid (kWh)"],
         color="tab:blue",
         label="Grid (kWh)",
     )
-    ax1.plot(
-        df.index,
+    _plot(
+        ax1,
         df["Solar (kWh)"],
         color="tab:orange",
         label="Solar (kWh)",
     )
-    ax1.plot(
-        df[df.index > latest_real_timestamp].index,
+    _plot(
+        ax1,
         df[df.index > latest_real_timestamp]["Grid (kWh)"],
         color="tab:blue",
         linestyle="dashed",
@@ -150,14 +274,14 @@ def weekly_energy_consumption(debug: bool = False) -> None:
     color = "tab:red"
     ax2.set_ylabel("Cost (€)", color=color)
     # Plot with different styles based on the date
-    ax2.plot(
-        df[df.index <= latest_real_timestamp].index,
+    _plot(
+        ax2,
         df[df.index <= latest_real_timestamp]["Grid (€)"],
         color=color,
         label="Grid (€)",
     )
-    ax2.plot(
-        df[df.index > latest_real_timestamp].index,
+    _plot(
+        ax2,
         df[df.index > latest_real_timestamp]["Grid (€)"],
         color=color,
         linestyle="dashed",
@@ -166,12 +290,8 @@ def weekly_energy_consumption(debug: bool = False) -> None:
     ax2.set_ylim(0, 0.6)  # Set limits for the second y-axis
 
     # Calculate the max, mean, and min for Grid (€)
-    max_grid_euro = np.max(
-        energy_consumtion_history_df_last_days["Grid (€)"].resample("1D").sum()
-    )
-    mean_grid_euro = np.mean(
-        energy_consumtion_history_df_last_days["Grid (€)"].resample("1D").sum()
-    )
+    max_grid_euro = np.max(daily_grid_euro)
+    mean_grid_euro = np.mean(daily_grid_euro)
 
     # Add legend
     ax2.legend(
@@ -184,9 +304,9 @@ def weekly_energy_consumption(debug: bool = False) -> None:
     # ax3.spines["right"].set_position(("outward", 60))
 
     # Plot the €/kWh on the third y-axis
-    ax3.plot(
-        repsol_prices_df.index,
-        repsol_prices_df["€/kWh"],
+    _plot(
+        ax3,
+        repsol_prices_df["€/kWh_mean"],
         color="tab:green",
         linewidth=1,
         label="€/kWh",
@@ -197,13 +317,12 @@ def weekly_energy_consumption(debug: bool = False) -> None:
     ax3.yaxis.set_label_position("right")
     ax3.tick_params(axis="y", labelcolor="tab:green")
 
-    # filter repsol_prices_df to the last 7 days
-    repsol_prices_df = repsol_prices_df[repsol_prices_df.index >= days_ago]
-
     # Calculate the max, mean, and min for €/kWh
-    max_euro_per_kwh = np.max(repsol_prices_df["€/kWh"])
-    mean_euro_per_kwh = np.mean(repsol_prices_df["€/kWh"])
-    min_euro_per_kwh = np.min(repsol_prices_df["€/kWh"])
+    max_euro_per_kwh = np.max(repsol_prices_df["€/kWh_max"])
+    mean_euro_per_kwh = (
+        repsol_prices_df["€/kWh_sum"].sum() / repsol_prices_df["€/kWh_count"].sum()
+    )
+    min_euro_per_kwh = np.min(repsol_prices_df["€/kWh_min"])
 
     # Set limits to the third y-axis
     ax3.set_ylim(0.01, max_euro_per_kwh + 0.005)
@@ -219,8 +338,12 @@ def weekly_energy_consumption(debug: bool = False) -> None:
 
     fig.tight_layout()
     # Save the current plot as a PNG image at the specified path
-    plt.savefig("/workspace/weekly_energy.png")
-    plt.show()
+    plt.savefig(utils.output_path("weekly_energy.png"))
+
+    # Showing the chart blocks until its window is closed, so only on request
+    if show:
+        plt.show()
+    plt.close(fig)
 
 
 def providers_indexed_prices(
@@ -231,4 +354,4 @@ def providers_indexed_prices(
     """
     location = repsol.plot_prices(start_date=start_date, override=override, debug=debug)
     if location != "":
-        shutil.copy(location, "/workspace/repsol_latest_prices.png")
\ No newline at end of file
+        shutil.copy(location, utils.output_path("repsol_latest_prices.png"))
\ No newline at end of file
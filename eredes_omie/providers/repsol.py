@@ -8,6 +8,10 @@ import matplotlib.dates as mdates
 import matplotlib.pyplot as plt
 import omie.energy_prices
 import pandas as pd
+import cache
+import coverage
+import metrics
+import rollups
 import utils
 
 
@@ -48,14 +52,21 @@ def update_prices(
 
     # Set the exporting columns
     df = df[["starting_datetime", "€/kWh"]]
+    metrics.inc("rows_parsed_total", len(df), stage="repsol_prices")
 
     # Write the dataframe to a single csv file
-    df.to_csv("/workspace/data/repsol_indexed_prices.csv", index=False)
+    df.to_csv(utils.shared_path("repsol_indexed_prices.csv"), index=False)
 
-    # Group by year and calculate the maximum and minimum price
-    max_min_prices = df.groupby(df["starting_datetime"].dt.year)["€/kWh"].agg(
-        ["max", "min", "mean"]
-    )
+    # Cache the dataframe, so that the plots do not parse the file again
+    cache.put(utils.shared_path("repsol_indexed_prices.csv"), df)
+
+    # Fold the new prices into the rollups and mark their slots as present
+    rollups.ingest("repsol_prices", df)
+    coverage.mark("repsol", df["starting_datetime"])
+
+    # Get the maximum, minimum and mean price for each year from the rollups
+    max_min_prices = rollups.stats("repsol_prices", "€/kWh", "year", ["max", "min", "mean"])
+    max_min_prices.index = max_min_prices.index.year
 
     # Print the maximum and minimum price for each year
     print(f"\nRepsol indexed prices per year (€/kWh):\n{max_min_prices}")
@@ -63,19 +74,37 @@ def update_prices(
     return df
 
 
-def get_prices() -> pd.DataFrame:
+def _read_prices(path: str) -> pd.DataFrame:
+    return pd.read_csv(path, parse_dates=["starting_datetime"])
+
+
+def _read_prices_range(path: str, start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+    return utils.read_csv_range(path, start=start, end=end, parse_dates=["starting_datetime"])
+
+
+def get_prices(start: pd.Timestamp = None, end: pd.Timestamp = None) -> pd.DataFrame:
     """
     Loads the Repsol indexed prices data from a CSV file.
+
+    Args:
+        start (pd.Timestamp, optional): The first timestamp to load. Defaults to the start of the history.
+        end (pd.Timestamp, optional): The first timestamp not to load. Defaults to the end of the history.
     """
-    # Load the dataframe from a CSV file
-    df = pd.read_csv(
-        "/workspace/data/repsol_indexed_prices.csv", parse_dates=["starting_datetime"]
+    # Load the dataframe from the cache, or only the requested range from the CSV file
+    df = cache.load(
+        utils.shared_path("repsol_indexed_prices.csv"),
+        _read_prices,
+        start=start,
+        end=end,
+        column="starting_datetime",
+        range_loader=_read_prices_range,
     )
 
     # Return the dataframe
     return df
 
 
+@metrics.timer("plot_renders", plot="repsol_day_prices")
 def plot_day_prices(
     day_df: pd.DataFrame, current_date: pd.Timestamp, save_dir: str
 ) -> str:
@@ -185,17 +214,17 @@ def plot_prices(
     ):
         start_date = utils.today()
 
-    # Retrieve the prices data
-    df = get_prices()
+    # Retrieve the prices data from the start_date onwards
+    df = get_prices(start=start_date)
 
     # Specify the directory where the plot images will be saved
-    save_dir = "/workspace/data/images"
+    save_dir = utils.shared_path("images")
 
     # Filter the dataframe to include only data from the start_date onwards
     df = df[df["starting_datetime"] >= start_date]
 
     # Ensure the directory for saving the plot images exists, create it if it doesn't
-    os.makedirs(save_dir, exist_ok=True)
+    os.makedirs(f"{save_dir}/repsol", exist_ok=True)
 
     # Initialize the variable to hold the path of the most recently generated image
     latest_image = ""
@@ -203,7 +232,7 @@ def plot_prices(
     # Iterate over each unique day in the dataframe
     for current_date, day_df in df.groupby(df["starting_datetime"].dt.date):
         # Check if an image for the current day already exists
-        if not override and os.path.exists(f"{save_dir}/{current_date}.png"):
+        if not override and os.path.exists(f"{save_dir}/repsol/{current_date}.png"):
             # If so, skip this iteration and move to the next day
             continue
 
@@ -223,8 +252,11 @@ def get_latest_prices() -> pd.DataFrame:
     Returns:
         latest_prices (pd.DataFrame): A DataFrame containing the latest prices.
     """
-    # Retrieve the prices data
-    prices_df = get_prices()
+    # Retrieve the prices data since one day ago
+    # Note: 'date.today() - timedelta(days=1)' gets the date for one day ago
+    # 'pd.Timestamp(..., tz="UTC")' converts the date to a UTC timestamp
+    one_day_ago = pd.Timestamp(date.today() - timedelta(days=1), tz="UTC")
+    prices_df = get_prices(start=one_day_ago)
 
     # Convert the 'starting_datetime' column to datetime and set it as the index
     prices_df.index = pd.to_datetime(prices_df["starting_datetime"])
@@ -236,11 +268,7 @@ def get_latest_prices() -> pd.DataFrame:
     latest_prices = pd.DataFrame()
 
     # Filter the prices data to only include entries from the last day
-    # Note: 'date.today() - timedelta(days=1)' gets the date for one day ago
-    # 'pd.Timestamp(..., tz="UTC")' converts the date to a UTC timestamp
-    filter_condition = prices_df.index > pd.Timestamp(
-        date.today() - timedelta(days=1), tz="UTC"
-    )
+    filter_condition = prices_df.index > one_day_ago
 
     # Apply the filter and select the '€/kWh' column
     latest_prices["€/kWh"] = prices_df.loc[filter_condition, "€/kWh"]
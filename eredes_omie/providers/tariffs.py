@@ -0,0 +1,171 @@
+from dataclasses import dataclass
+import json
+
+import numpy as np
+import pandas as pd
+
+from erse import cycles
+import providers.repsol as repsol
+import reconcile
+
+# File with the fixed-price tariffs to compare, a JSON list with one object per tariff
+TARIFFS_PATH = "/workspace/tariffs.json"
+
+# Name of the Repsol indexed tariff in the comparison
+REPSOL = "Repsol indexed"
+
+
+@dataclass
+class Tariff:
+    """
+    Dataclass to represent a fixed-price tariff: the ERSE cycle of its periods,
+    the €/kWh of each period, and its daily fixed charge in €, such as the power term.
+    """
+
+    name: str
+    cycle: str
+    prices: dict[str, float]
+    daily_charge: float = 0.0
+
+    def __post_init__(self):
+        if self.cycle not in cycles.CYCLES:
+            raise ValueError(
+                f"Invalid cycle of {self.name}: {self.cycle}, "
+                f"expected one of {list(cycles.CYCLES)}"
+            )
+
+    def price_vector(self) -> np.ndarray:
+        """The €/kWh of each period of `cycles.PERIODS`, 0 where the tariff has none."""
+        return np.array([self.prices.get(period, 0.0) for period in cycles.PERIODS])
+
+
+def load_tariffs(path: str = TARIFFS_PATH) -> list[Tariff]:
+    """
+    Loads the tariffs from a JSON file with one object per tariff, e.g.
+    {"name": "Bi-hourly", "cycle": "bi_daily", "prices": {"vazio": 0.10, "fora_vazio": 0.20}}.
+
+    Raises:
+        ValueError: If a tariff has no price for a period of its cycle.
+    """
+    with open(path) as file:
+        tariffs = [Tariff(**tariff) for tariff in json.load(file)]
+
+    for tariff in tariffs:
+        used = {cycles.CYCLES[tariff.cycle]["default"]} | {
+            period
+            for season in cycles.SEASONS
+            for schedule in cycles.CYCLES[tariff.cycle][season].values()
+            for _, _, period in schedule
+        }
+        missing = used - set(tariff.prices)
+        if missing:
+            raise ValueError(f"Missing prices of {tariff.name}: {sorted(missing)}")
+
+    return tariffs
+
+
+def period_energy(
+    consumption: pd.Series, cycle_names: list[str]
+) -> dict[str, pd.DataFrame]:
+    """
+    Sums the consumption of each year in each period of each cycle.
+
+    The quarter-hours are placed in the slots of their year, so the period masks
+    of `cycles.period_codes` apply to them as a whole, one weighted count per
+    year and cycle.
+
+    Args:
+        consumption (pd.Series): The kWh of each quarter-hour, indexed by UTC timestamp.
+        cycle_names (list[str]): The cycles to sum the consumption for.
+
+    Returns:
+        dict[str, pd.DataFrame]: By cycle, the kWh of each year (rows) in each period (columns).
+    """
+    timestamps = pd.DatetimeIndex(consumption.index).tz_convert("UTC")
+    kwh = consumption.to_numpy(dtype="float64")
+    years = timestamps.year.to_numpy()
+
+    energy = {cycle: {} for cycle in cycle_names}
+    for year in np.unique(years):
+        in_year = years == year
+        year_start = pd.Timestamp(year=int(year), month=1, day=1, tz="UTC")
+        slots = (timestamps[in_year] - year_start) // pd.Timedelta(minutes=15)
+        for cycle in cycle_names:
+            codes = cycles.period_codes(int(year), cycle)[slots.to_numpy()]
+            energy[cycle][int(year)] = np.bincount(
+                codes, weights=kwh[in_year], minlength=len(cycles.PERIODS)
+            )
+
+    return {
+        cycle: pd.DataFrame.from_dict(by_year, orient="index", columns=cycles.PERIODS)
+        for cycle, by_year in energy.items()
+    }
+
+
+def compare(
+    tariffs: list[Tariff],
+    start: pd.Timestamp = None,
+    end: pd.Timestamp = None,
+    consumption_df: pd.DataFrame = None,
+    prices_df: pd.DataFrame = None,
+    repsol_daily_charge: float = 0.0,
+) -> pd.DataFrame:
+    """
+    Compares the cost of the E-REDES consumption in [start, end) with each
+    fixed-price tariff and with the Repsol indexed prices, per year.
+
+    Only the quarter-hours with a Repsol price are compared, so every tariff is
+    billed the same energy. The energy of each period is summed once per cycle,
+    then each tariff only multiplies it by its prices, so dozens of tariffs cost
+    little more than one.
+
+    Args:
+        tariffs (list[Tariff]): The fixed-price tariffs.
+        start (pd.Timestamp, optional): The first timestamp to compare. Defaults to the start of the history.
+        end (pd.Timestamp, optional): The first timestamp not to compare. Defaults to the end of the history.
+        consumption_df (pd.DataFrame, optional): The E-REDES history. Defaults to the saved history.
+        prices_df (pd.DataFrame, optional): The Repsol prices. Defaults to the saved prices.
+        repsol_daily_charge (float): The daily fixed charge of the Repsol tariff in €. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: The kWh, energy €, fixed €, total € and mean €/kWh of each
+        tariff and year, cheapest first within each year.
+    """
+    if consumption_df is None:
+        consumption_df = reconcile.get_e_redes_history(start=start, end=end)
+    if prices_df is None:
+        prices_df = repsol.get_prices(start=start, end=end).set_index("starting_datetime")
+
+    df = consumption_df[["consumption_kwh"]].join(prices_df[["€/kWh"]], how="inner")
+    df = df.dropna()
+    if start is not None:
+        df = df[df.index >= start]
+    if end is not None:
+        df = df[df.index < end]
+
+    years = df.index.year
+    days = pd.Series(df.index.normalize(), index=years).groupby(level=0).nunique()
+
+    # The Repsol indexed cost of each quarter-hour
+    repsol_cost = (df["consumption_kwh"] * df["€/kWh"]).groupby(years).sum()
+
+    energy = period_energy(df["consumption_kwh"], sorted({t.cycle for t in tariffs}))
+
+    rows = []
+    for year in sorted(days.index):
+        kwh = df["consumption_kwh"][years == year].sum()
+        rows.append(
+            (REPSOL, year, kwh, repsol_cost[year], repsol_daily_charge * days[year])
+        )
+        for tariff in tariffs:
+            energy_cost = energy[tariff.cycle].loc[year].to_numpy() @ tariff.price_vector()
+            rows.append(
+                (tariff.name, year, kwh, energy_cost, tariff.daily_charge * days[year])
+            )
+
+    result = pd.DataFrame(
+        rows, columns=["tariff", "year", "kWh", "energy_€", "fixed_€"]
+    )
+    result["total_€"] = result["energy_€"] + result["fixed_€"]
+    result["€/kWh"] = result["total_€"] / result["kWh"]
+    return result.sort_values(["year", "total_€"], ignore_index=True)
@@ -0,0 +1,321 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import energy_meters.shelly as shelly
+import rollups
+import utils
+
+# E-REDES history files, the current month last so that its readings win
+E_REDES_PATHS = [
+    utils.data_path("consumption_history.csv"),
+    utils.data_path("current_month_consumption_history.csv"),
+]
+
+# Columns of the daily reconciliation, sums over the quarter-hours with both readings
+DAILY_COLUMNS = [
+    "slots",
+    "e_redes_consumption_kWh",
+    "e_redes_injection_kWh",
+    "shelly_bought_kWh",
+    "shelly_exported_kWh",
+    "delta_kWh",
+    "abs_delta_kWh",
+    "squared_delta_kWh2",
+    "max_abs_delta_kWh",
+]
+
+
+def get_e_redes_history(
+    start: pd.Timestamp = None, end: pd.Timestamp = None
+) -> pd.DataFrame:
+    """
+    Loads the E-REDES quarter-hour readings in [start, end), the current month
+    export winning over the history where both have a reading.
+
+    Returns:
+        pd.DataFrame: The consumption_kwh and injection_kwh of each quarter-hour, indexed by timestamp.
+    """
+    dfs = [
+        utils.read_csv_range(
+            path, start=start, end=end, index_col=0, parse_dates=["starting_datetime"]
+        )
+        for path in E_REDES_PATHS
+        if os.path.exists(path)
+    ]
+    if len(dfs) == 0:
+        return pd.DataFrame(
+            columns=["consumption_kwh", "injection_kwh"],
+            index=pd.DatetimeIndex([], tz="UTC", name="starting_datetime"),
+            dtype="float64",
+        )
+
+    df = pd.concat(dfs)
+    return df[~df.index.duplicated(keep="last")].sort_index().astype("float64")
+
+
+def align(start: pd.Timestamp = None, end: pd.Timestamp = None) -> pd.DataFrame:
+    """
+    Aligns the E-REDES and Shelly readings per quarter-hour over [start, end).
+
+    The Shelly net grid energy is split into bought and exported energy, to be
+    compared with the E-REDES consumption and injection. The delta is the
+    Shelly net grid energy minus the E-REDES one, so a positive delta means
+    that the Shelly measures more than the E-REDES meter.
+
+    Returns:
+        pd.DataFrame: The readings of both sources and the delta of each
+        quarter-hour with both readings, in kWh, indexed by timestamp.
+    """
+    e_redes_df = get_e_redes_history(start=start, end=end)
+    shelly_df = shelly.get_energy_history(start=start, end=end)
+
+    df = e_redes_df.join(shelly_df[["grid_kWh"]], how="inner").dropna()
+
+    grid = df["grid_kWh"].to_numpy(dtype="float64")
+    consumption = df["consumption_kwh"].to_numpy(dtype="float64")
+    injection = df["injection_kwh"].to_numpy(dtype="float64")
+
+    return pd.DataFrame(
+        {
+            "e_redes_consumption_kWh": consumption,
+            "e_redes_injection_kWh": injection,
+            "shelly_bought_kWh": np.clip(grid, 0, None),
+            "shelly_exported_kWh": np.clip(-grid, 0, None),
+            "delta_kWh": grid - (consumption - injection),
+        },
+        index=df.index,
+    )
+
+
+def rollup_daily(aligned_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Sums the aligned quarter-hours per day, keeping what is needed to compute
+    the bias, the errors and the calibration factors of any range of days.
+    """
+    delta = aligned_df["delta_kWh"]
+    days = aligned_df.index.floor("1D")
+
+    daily_df = aligned_df.groupby(days).sum()
+    daily_df["abs_delta_kWh"] = delta.abs().groupby(days).sum()
+    daily_df["squared_delta_kWh2"] = (delta**2).groupby(days).sum()
+    daily_df["max_abs_delta_kWh"] = delta.abs().groupby(days).max()
+    daily_df.insert(0, "slots", delta.groupby(days).count())
+    daily_df.index.name = "starting_datetime"
+
+    return daily_df[DAILY_COLUMNS]
+
+
+def get_daily(
+    path: str = utils.data_path("reconciliation_daily.csv"),
+) -> pd.DataFrame:
+    """
+    Loads the daily reconciliation sums.
+
+    Args:
+        path (str): The path to the daily reconciliation CSV file.
+
+    Returns:
+        pd.DataFrame: The sums of each day, indexed by day. Empty if nothing was saved yet.
+    """
+    if not os.path.exists(path):
+        return pd.DataFrame(
+            columns=DAILY_COLUMNS,
+            index=pd.DatetimeIndex([], tz="UTC", name="starting_datetime"),
+        )
+
+    return pd.read_csv(path, index_col=0, parse_dates=["starting_datetime"])
+
+
+def update_daily(
+    path: str = utils.data_path("reconciliation_daily.csv"), debug: bool = False
+) -> pd.DataFrame:
+    """
+    Updates the daily reconciliation sums with the days not reconciled yet.
+
+    Only the quarter-hours since the last saved day are aligned, that day included,
+    as either source may have been incomplete when it was last reconciled.
+
+    Args:
+        path (str): The path to the daily reconciliation CSV file.
+        debug (bool): If True, prints debug information. Defaults to False.
+
+    Returns:
+        pd.DataFrame: The updated daily sums, indexed by day.
+    """
+    daily_df = get_daily(path)
+
+    # The E-REDES readings are compared with the Shelly energy history, saved by its stage
+    if not os.path.exists(utils.data_path("shelly_energy_history.csv")):
+        print("\nSkipping the reconciliation, no Shelly energy history saved yet.")
+        return daily_df
+
+    # Recompute from the last saved day, or from the start of the history
+    start = daily_df.index.max() if len(daily_df) > 0 else None
+    if debug:
+        print(f"Updating the E-REDES and Shelly reconciliation from {start}...")
+
+    new_daily_df = rollup_daily(align(start=start))
+
+    # Replace the recomputed days
+    if start is not None:
+        daily_df = daily_df[daily_df.index < start]
+    daily_df = pd.concat([daily_df, new_daily_df]) if len(daily_df) > 0 else new_daily_df
+    daily_df.index.name = "starting_datetime"
+
+    daily_df.to_csv(path)
+
+    if debug:
+        print(f"Reconciliation updated with {len(new_daily_df)} days.")
+
+    return daily_df
+
+
+def _select(
+    daily_df: pd.DataFrame, start: pd.Timestamp, end: pd.Timestamp
+) -> pd.DataFrame:
+    if start is not None:
+        daily_df = daily_df[daily_df.index >= start]
+    if end is not None:
+        daily_df = daily_df[daily_df.index < end]
+    return daily_df
+
+
+def _ratio(numerator: float, denominator: float) -> float:
+    return float(numerator / denominator) if denominator > 0 else np.nan
+
+
+def summary(
+    start: pd.Timestamp = None,
+    end: pd.Timestamp = None,
+    path: str = utils.data_path("reconciliation_daily.csv"),
+) -> dict[str, float]:
+    """
+    Summarizes how far apart the Shelly and the E-REDES readings are over the
+    days in [start, end), from the daily sums only.
+
+    Returns:
+        dict[str, float]: The number of quarter-hours compared, the bias (mean delta),
+        the mean absolute and root mean squared deltas and the largest delta, in kWh
+        per quarter-hour, the drift of the daily bias, in kWh per quarter-hour per
+        year, and the calibration factors, see `calibration_factors`.
+    """
+    daily_df = _select(get_daily(path), start, end)
+    totals = daily_df.sum()
+    slots = totals["slots"]
+
+    return {
+        "slots": int(slots),
+        "bias_kWh": _ratio(totals["delta_kWh"], slots),
+        "mae_kWh": _ratio(totals["abs_delta_kWh"], slots),
+        "rmse_kWh": float(np.sqrt(_ratio(totals["squared_delta_kWh2"], slots))),
+        "max_abs_delta_kWh": float(daily_df["max_abs_delta_kWh"].max())
+        if len(daily_df) > 0
+        else np.nan,
+        "drift_kWh_per_year": _drift(daily_df),
+        **_factors(totals),
+    }
+
+
+def rolling_bias(
+    days: int = 7,
+    start: pd.Timestamp = None,
+    end: pd.Timestamp = None,
+    path: str = utils.data_path("reconciliation_daily.csv"),
+) -> pd.Series:
+    """
+    Computes the bias of each day over the `days` days ending on it, weighted
+    by the quarter-hours compared on each day, in kWh per quarter-hour.
+    """
+    daily_df = _select(get_daily(path), start, end).asfreq("1D", fill_value=0)
+    window = daily_df[["delta_kWh", "slots"]].rolling(days, min_periods=1).sum()
+    return (window["delta_kWh"] / window["slots"].where(window["slots"] > 0)).rename(
+        "bias_kWh"
+    )
+
+
+def _drift(daily_df: pd.DataFrame) -> float:
+    """
+    The slope of the daily bias over time, fitted by least squares weighted by
+    the quarter-hours compared on each day, in kWh per quarter-hour per year.
+    """
+    daily_df = daily_df[daily_df["slots"] > 0]
+    if len(daily_df) < 2:
+        return np.nan
+
+    years = (daily_df.index - daily_df.index[0]).days.to_numpy() / 365.25
+    bias = (daily_df["delta_kWh"] / daily_df["slots"]).to_numpy(dtype="float64")
+    slope, _ = np.polyfit(years, bias, 1, w=np.sqrt(daily_df["slots"].to_numpy()))
+    return float(slope)
+
+
+def _factors(totals: pd.Series) -> dict[str, float]:
+    return {
+        "consumption_factor": _ratio(
+            totals["e_redes_consumption_kWh"], totals["shelly_bought_kWh"]
+        ),
+        "injection_factor": _ratio(
+            totals["e_redes_injection_kWh"], totals["shelly_exported_kWh"]
+        ),
+    }
+
+
+def calibration_factors(
+    days: int = 30,
+    end: pd.Timestamp = None,
+    path: str = utils.data_path("reconciliation_daily.csv"),
+) -> dict[str, float]:
+    """
+    Derives the factors that scale the Shelly bought and exported energy to
+    what E-REDES would measure, from the last `days` reconciled days before `end`.
+
+    Returns:
+        dict[str, float]: The consumption and injection factors, 1.0 where there
+        is no energy to compare.
+    """
+    daily_df = get_daily(path)
+    if end is not None:
+        daily_df = daily_df[daily_df.index < end]
+    if len(daily_df) > 0:
+        daily_df = daily_df[daily_df.index > daily_df.index[-1] - pd.Timedelta(days=days)]
+
+    factors = _factors(daily_df.sum())
+    return {key: 1.0 if np.isnan(value) else value for key, value in factors.items()}
+
+
+def calibrate(grid: pd.Series, factors: dict[str, float]) -> pd.Series:
+    """
+    Scales Shelly net grid energy with calibration factors: the bought energy
+    by the consumption factor and the exported energy by the injection factor.
+
+    Net energy summed over more than a quarter-hour, such as the hourly rollups,
+    mixes bought and exported energy, so the result is then an approximation.
+    """
+    return grid.clip(lower=0) * factors["consumption_factor"] + grid.clip(
+        upper=0
+    ) * factors["injection_factor"]
+
+
+def calibrated_energy_history(
+    start: pd.Timestamp = None,
+    end: pd.Timestamp = None,
+    days: int = 30,
+) -> pd.DataFrame:
+    """
+    Loads the Shelly energy history with the grid energy calibrated to E-REDES
+    after the last E-REDES reading, where only the Shelly readings exist.
+
+    Returns:
+        pd.DataFrame: The Shelly energy history, with a calibrated flag column.
+    """
+    df = shelly.get_energy_history(start=start, end=end)
+    watermark = rollups.get_watermark("consumption")
+
+    calibrated = np.ones(len(df), dtype=bool) if watermark is None else df.index > watermark
+    factors = calibration_factors(days=days)
+    df.loc[calibrated, "grid_kWh"] = calibrate(df.loc[calibrated, "grid_kWh"], factors)
+    df["consumed_kWh"] = df["grid_kWh"] + df["solar_kWh"]
+    df["calibrated"] = calibrated
+
+    return df
@@ -0,0 +1,445 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import utils
+
+# Directory where the rollups are saved
+ROLLUPS_DIR = utils.data_path("rollups")
+
+# Aggregation levels and the pandas frequency of their buckets, labelled by their start
+LEVELS = {"hour": "1h", "day": "1D", "month": "1MS", "year": "1YS"}
+
+# Statistics kept for each column
+STATS = ["sum", "min", "max", "mean", "count"]
+
+# Column of the cost in € of the energy bought in each quarter-hour, derived
+# from the net grid energy of the series with a "grid" function when ingested
+GRID_COST = "grid_€"
+
+# Series kept in the rollups: the CSV files they are loaded from and their columns
+SERIES = {
+    "omie_prices": {
+        "paths": [utils.shared_path("energy_prices.csv")],
+        "columns": ["€/MWh"],
+    },
+    "repsol_prices": {
+        "paths": [utils.shared_path("repsol_indexed_prices.csv")],
+        "columns": ["€/kWh"],
+    },
+    "losses": {
+        "paths": [utils.shared_path("losses_profiles.csv")],
+        "columns": ["losses_profile"],
+    },
+    "consumption": {
+        "paths": [
+            utils.data_path("consumption_history.csv"),
+            utils.data_path("current_month_consumption_history.csv"),
+        ],
+        "columns": ["consumption_kwh", "injection_kwh", GRID_COST],
+        "grid": lambda df: df["consumption_kwh"] - df["injection_kwh"],
+    },
+    "shelly": {
+        "paths": [utils.data_path("shelly_energy_history.csv")],
+        "columns": ["grid_kWh", "solar_kWh", "consumed_kWh", GRID_COST],
+        "grid": lambda df: df["grid_kWh"],
+    },
+}
+
+
+def _watermarks_path(rollups_dir: str) -> str:
+    return f"{rollups_dir}/watermarks.json"
+
+
+def _rollup_path(series: str, level: str, rollups_dir: str) -> str:
+    return f"{rollups_dir}/{series}/{level}.csv"
+
+
+def get_watermarks(rollups_dir: str = ROLLUPS_DIR) -> dict[str, pd.Timestamp]:
+    """
+    Loads the timestamp of the latest quarter-hour ingested for each series.
+    """
+    if not os.path.exists(_watermarks_path(rollups_dir)):
+        return {}
+
+    with open(_watermarks_path(rollups_dir)) as file:
+        return {
+            series: pd.Timestamp(timestamp)
+            for series, timestamp in json.load(file).items()
+        }
+
+
+def get_watermark(series: str, rollups_dir: str = ROLLUPS_DIR) -> pd.Timestamp | None:
+    """
+    Gets the timestamp of the latest quarter-hour ingested for a series, if any.
+    """
+    return get_watermarks(rollups_dir).get(series)
+
+
+def _save_watermarks(watermarks: dict[str, pd.Timestamp], rollups_dir: str) -> None:
+    # Write to a temporary file first, so that a crash never leaves a partial file
+    path = _watermarks_path(rollups_dir)
+    with open(f"{path}.tmp", "w") as file:
+        json.dump({key: str(value) for key, value in watermarks.items()}, file)
+    os.replace(f"{path}.tmp", path)
+
+
+def _grid_cost(grid: pd.Series) -> pd.Series:
+    """
+    Computes the cost of the energy bought in each quarter-hour at the Repsol
+    prices, missing where the price of the quarter-hour is not known.
+
+    The cost of each quarter-hour is clipped before it is summed, as prices
+    change every quarter-hour: exported energy, and energy bought at negative
+    prices, cost nothing, as in the notebook the costs were first computed in.
+    """
+    path = SERIES["repsol_prices"]["paths"][0]
+    if len(grid) == 0 or not os.path.exists(path):
+        return pd.Series(np.nan, index=grid.index)
+
+    prices_df = utils.read_csv_range(
+        path,
+        start=grid.index.min(),
+        end=grid.index.max() + pd.Timedelta(minutes=15),
+        index_col=0,
+        parse_dates=["starting_datetime"],
+    )
+    price = prices_df["€/kWh"].reindex(grid.index)
+    return (grid.astype("float64") * price).clip(lower=0)
+
+
+def _is_current(series: str, rollups_dir: str) -> bool:
+    """
+    Checks that the rollups of a series have all its columns, false for
+    rollups saved before a column was added to the series.
+    """
+    path = _rollup_path(series, "hour", rollups_dir)
+    if not os.path.exists(path):
+        return True
+
+    with open(path) as file:
+        header = file.readline().rstrip("\n").split(",")
+    columns = SERIES[series]["columns"]
+    return header[1:] == [f"{column}_{stat}" for column in columns for stat in STATS]
+
+
+def _prepare(series: str, df: pd.DataFrame, after: pd.Timestamp = None) -> pd.DataFrame:
+    """
+    Indexes the data of a series by timestamp, keeps the last row of each
+    quarter-hour after a timestamp, if given, and derives the cost of the
+    bought energy of each quarter-hour.
+    """
+    if not isinstance(df.index, pd.DatetimeIndex):
+        df = df.set_index(df.columns[0])
+        df.index = pd.to_datetime(df.index, utc=True)
+    df = df.sort_index(kind="stable")
+
+    if after is not None:
+        df = df[df.index > after]
+    df = df[~df.index.duplicated(keep="last")]
+
+    if "grid" in SERIES[series]:
+        df = df.assign(**{GRID_COST: _grid_cost(SERIES[series]["grid"](df))})
+    return df[SERIES[series]["columns"]].astype("float64")
+
+
+def _bucket(timestamp: pd.Timestamp, freq: str) -> pd.Timestamp:
+    """The start of the bucket of the given frequency holding a timestamp."""
+    buckets = pd.Series(0, index=pd.DatetimeIndex([timestamp])).resample(freq).sum()
+    return buckets.index[0]
+
+
+def _aggregate(df: pd.DataFrame, freq: str) -> pd.DataFrame:
+    """
+    Aggregates the values of a DataFrame into buckets of the given frequency.
+    """
+    agg_df = df.resample(freq).agg(["sum", "min", "max", "count"])
+    agg_df.columns = [f"{column}_{stat}" for column, stat in agg_df.columns]
+
+    # Drop the buckets without any value, created by gaps in the data
+    counts = agg_df[[f"{column}_count" for column in df.columns]]
+    return agg_df[counts.sum(axis=1) > 0]
+
+
+def _merge(old_df: pd.DataFrame, new_df: pd.DataFrame, columns: list[str]) -> pd.DataFrame:
+    """
+    Merges the aggregates of two DataFrames, combining the buckets present in both.
+    """
+    operations = {}
+    for column in columns:
+        operations[f"{column}_sum"] = "sum"
+        operations[f"{column}_min"] = "min"
+        operations[f"{column}_max"] = "max"
+        operations[f"{column}_count"] = "sum"
+
+    merged_df = pd.concat([old_df, new_df]).groupby(level=0).agg(operations)
+
+    return _with_mean(merged_df, columns)
+
+
+def _with_mean(df: pd.DataFrame, columns: list[str]) -> pd.DataFrame:
+    """
+    Derives the mean of each column from its sum and count, and orders the columns.
+    """
+    for column in columns:
+        df[f"{column}_mean"] = df[f"{column}_sum"] / df[f"{column}_count"]
+
+    return df[[f"{column}_{stat}" for column in columns for stat in STATS]]
+
+
+def ingest(
+    series: str,
+    df: pd.DataFrame,
+    rollups_dir: str = ROLLUPS_DIR,
+    end: pd.Timestamp = None,
+    debug: bool = False,
+) -> int:
+    """
+    Folds the quarter-hours of a series newer than its watermark into all the rollup levels.
+
+    Only the last bucket of each level can be shared with the new data, so each
+    level file is truncated at that bucket and the merged buckets are appended.
+
+    A quarter-hour is never ingested twice, so the quarter-hours that may still
+    be incomplete, such as the current one of the Shelly history, are left out
+    with `end` until a later update.
+
+    Args:
+        series (str): The name of the series, one of `SERIES`.
+        df (pd.DataFrame): The series data, indexed by timestamp or with the timestamp in its first column.
+        rollups_dir (str): The directory where the rollups are saved.
+        end (pd.Timestamp, optional): The first quarter-hour not to ingest. Defaults to none.
+        debug (bool): If True, prints debug information. Defaults to False.
+
+    Returns:
+        int: The number of quarter-hours ingested.
+    """
+    columns = SERIES[series]["columns"]
+
+    # Rollups saved before a column was added are rebuilt with it first
+    if not _is_current(series, rollups_dir):
+        rebuild(series, rollups_dir=rollups_dir, debug=debug)
+
+    # Keep only the quarter-hours newer than the watermark
+    df = _prepare(series, df, after=get_watermark(series, rollups_dir))
+    if end is not None:
+        df = df[df.index < end]
+    if len(df) == 0:
+        return 0
+
+    os.makedirs(f"{rollups_dir}/{series}", exist_ok=True)
+
+    for level, freq in LEVELS.items():
+        new_df = _with_mean(_aggregate(df, freq), columns)
+        path = _rollup_path(series, level, rollups_dir)
+
+        if not os.path.exists(path):
+            new_df.to_csv(path, index_label="starting_datetime")
+            continue
+
+        # Merge the last saved bucket with the new buckets
+        first_bucket = new_df.index[0]
+        offset = utils.csv_offset(path, first_bucket)
+        old_df = utils.read_csv_range(
+            path, start=first_bucket, index_col=0, parse_dates=["starting_datetime"]
+        )
+        merged_df = _merge(old_df, new_df, columns) if len(old_df) > 0 else new_df
+
+        # Replace the file tail with the merged buckets
+        with open(path, "r+b") as file:
+            file.truncate(offset)
+        merged_df.to_csv(path, mode="a", header=False)
+
+    watermarks = get_watermarks(rollups_dir)
+    watermarks[series] = df.index.max()
+    _save_watermarks(watermarks, rollups_dir)
+
+    if debug:
+        print(f"Ingested {len(df)} rows into the {series} rollups.")
+
+    return len(df)
+
+
+def update_series(
+    series: str, rollups_dir: str = ROLLUPS_DIR, debug: bool = False
+) -> int:
+    """
+    Ingests the quarter-hours of a series saved in its CSV files after its watermark.
+
+    Args:
+        series (str): The name of the series, one of `SERIES`.
+        rollups_dir (str): The directory where the rollups are saved.
+        debug (bool): If True, prints debug information. Defaults to False.
+
+    Returns:
+        int: The number of quarter-hours ingested.
+    """
+    # Read only the rows after the watermark from each source file
+    df = _read_sources(series, start=get_watermark(series, rollups_dir))
+    if df is None:
+        return 0
+
+    return ingest(series, df, rollups_dir=rollups_dir, debug=debug)
+
+
+def _read_sources(series: str, start: pd.Timestamp = None) -> pd.DataFrame | None:
+    """
+    Reads the rows of the CSV files of a series from a timestamp, None if none
+    of its files exists yet.
+    """
+    dfs = []
+    for path in SERIES[series]["paths"]:
+        if os.path.exists(path):
+            df = utils.read_csv_range(path, start=start, index_col=0)
+            df.index = pd.to_datetime(df.index, utc=True)
+            dfs.append(df)
+
+    return pd.concat(dfs) if len(dfs) > 0 else None
+
+
+def revise(
+    series: str,
+    start: pd.Timestamp,
+    rollups_dir: str = ROLLUPS_DIR,
+    debug: bool = False,
+) -> int:
+    """
+    Aggregates the rollups of a series again from a quarter-hour, for the
+    quarter-hours saved again in its CSV files at or before its watermark, such
+    as the E-REDES readings revised by a later export.
+
+    Each level file is truncated at the bucket holding `start`, and the buckets
+    from there are aggregated again from the CSV files, so at most the year of
+    `start` is read again, and not the whole history.
+
+    Args:
+        series (str): The name of the series, one of `SERIES`.
+        start (pd.Timestamp): The first quarter-hour saved again.
+        rollups_dir (str): The directory where the rollups are saved.
+        debug (bool): If True, prints debug information. Defaults to False.
+
+    Returns:
+        int: The number of quarter-hours from `start` aggregated again.
+    """
+    # Quarter-hours after the watermark are only new, not revised
+    watermark = get_watermark(series, rollups_dir)
+    if watermark is None or start > watermark or not _is_current(series, rollups_dir):
+        return update_series(series, rollups_dir=rollups_dir, debug=debug)
+
+    # Read the quarter-hours of the longest bucket holding the start onwards
+    df = _read_sources(series, start=_bucket(start, LEVELS["year"]))
+    if df is None:
+        return 0
+    df = _prepare(series, df)
+    if len(df) == 0:
+        return 0
+
+    columns = SERIES[series]["columns"]
+    for level, freq in LEVELS.items():
+        bucket = _bucket(start, freq)
+        new_df = _with_mean(_aggregate(df[df.index >= bucket], freq), columns)
+        path = _rollup_path(series, level, rollups_dir)
+
+        if not os.path.exists(path):
+            new_df.to_csv(path, index_label="starting_datetime")
+            continue
+
+        # Replace the file tail from the bucket with the aggregated buckets
+        offset = utils.csv_offset(path, bucket)
+        with open(path, "r+b") as file:
+            file.truncate(offset)
+        new_df.to_csv(path, mode="a", header=False)
+
+    watermarks = get_watermarks(rollups_dir)
+    watermarks[series] = df.index.max()
+    _save_watermarks(watermarks, rollups_dir)
+
+    if debug:
+        print(f"Revised the {series} rollups from {start}.")
+
+    return int((df.index >= start).sum())
+
+
+def rebuild(series: str, rollups_dir: str = ROLLUPS_DIR, debug: bool = False) -> int:
+    """
+    Rebuilds the rollups of a series from its CSV files, for data added before its watermark.
+    """
+    for level in LEVELS:
+        path = _rollup_path(series, level, rollups_dir)
+        if os.path.exists(path):
+            os.remove(path)
+
+    # Forget the watermark, so that all the rows are ingested again
+    watermarks = get_watermarks(rollups_dir)
+    if series in watermarks:
+        del watermarks[series]
+        _save_watermarks(watermarks, rollups_dir)
+
+    return update_series(series, rollups_dir=rollups_dir, debug=debug)
+
+
+def update_all(rollups_dir: str = ROLLUPS_DIR, debug: bool = False) -> None:
+    """
+    Ingests the new quarter-hours of all the series.
+    """
+    for series in SERIES:
+        update_series(series, rollups_dir=rollups_dir, debug=debug)
+
+
+def get(
+    series: str,
+    level: str,
+    start: pd.Timestamp = None,
+    end: pd.Timestamp = None,
+    rollups_dir: str = ROLLUPS_DIR,
+) -> pd.DataFrame:
+    """
+    Loads the rollups of a series at the given level.
+
+    Args:
+        series (str): The name of the series, one of `SERIES`.
+        level (str): One of "hour", "day", "month" or "year".
+        start (pd.Timestamp, optional): The first bucket to load. Defaults to the first bucket.
+        end (pd.Timestamp, optional): The first bucket not to load. Defaults to the last bucket.
+        rollups_dir (str): The directory where the rollups are saved.
+
+    Returns:
+        pd.DataFrame: One `{column}_{stat}` column for each column and statistic, indexed by bucket start.
+    """
+    if level not in LEVELS:
+        raise ValueError(f"Invalid level: {level}, expected one of {list(LEVELS)}")
+
+    path = _rollup_path(series, level, rollups_dir)
+    if not os.path.exists(path):
+        columns = SERIES[series]["columns"]
+        return pd.DataFrame(
+            columns=[f"{column}_{stat}" for column in columns for stat in STATS],
+            index=pd.DatetimeIndex([], tz="UTC", name="starting_datetime"),
+        )
+
+    return utils.read_csv_range(
+        path, start=start, end=end, index_col=0, parse_dates=["starting_datetime"]
+    )
+
+
+def stats(
+    series: str,
+    column: str,
+    level: str,
+    statistics: list[str] = STATS,
+    start: pd.Timestamp = None,
+    end: pd.Timestamp = None,
+    rollups_dir: str = ROLLUPS_DIR,
+) -> pd.DataFrame:
+    """
+    Loads some statistics of one column of a series at the given level.
+
+    Returns:
+        pd.DataFrame: One column per statistic, indexed by bucket start.
+    """
+    df = get(series, level, start=start, end=end, rollups_dir=rollups_dir)
+    df = df[[f"{column}_{stat}" for stat in statistics]]
+    df.columns = statistics
+    return df
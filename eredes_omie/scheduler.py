@@ -0,0 +1,231 @@
+from dataclasses import asdict, dataclass
+import json
+
+import numpy as np
+import pandas as pd
+
+import omie.energy_prices
+import providers.repsol as repsol
+import utils
+
+# Quarter-hours are scheduled in local time
+TIMEZONE = "Europe/Lisbon"
+
+# Duration of a quarter-hour slot
+SLOT_MINUTES = 15
+
+
+@dataclass
+class Load:
+    """
+    Dataclass to represent a deferrable load.
+
+    The allowed window is given in local time; a `latest` time at or before the
+    `earliest` time ends on the next day, so "22:00" to "07:00" is an overnight window.
+    """
+
+    name: str
+    duration_minutes: int
+    power_kW: float
+    earliest: str = "00:00"
+    latest: str = "00:00"
+    contiguous: bool = True
+
+    @property
+    def slots(self) -> int:
+        """The number of quarter-hours needed to run the load."""
+        return -(-self.duration_minutes // SLOT_MINUTES)
+
+
+def load_loads(path: str) -> list[Load]:
+    """
+    Loads a list of deferrable loads from a JSON file with one object per load.
+    """
+    with open(path) as file:
+        return [Load(**load) for load in json.load(file)]
+
+
+def cheapest_contiguous(
+    prices: np.ndarray, slots: int, valid: np.ndarray = None
+) -> tuple[int, float]:
+    """
+    Finds the start of the cheapest run of consecutive slots, using prefix sums
+    so that every window sum is a single subtraction.
+
+    Args:
+        prices (np.ndarray): The prices of the slots.
+        slots (int): The number of slots of the run.
+        valid (np.ndarray, optional): Whether a run can start at each slot, one
+            per run. Defaults to every run.
+
+    Returns:
+        tuple[int, float]: The index of the first slot and the sum of the prices
+        of the run, or -1 and NaN if no run can start.
+    """
+    prefix = np.concatenate([[0.0], np.cumsum(prices)])
+    window_sums = prefix[slots:] - prefix[:-slots]
+    if valid is not None:
+        window_sums = np.where(valid, window_sums, np.inf)
+    start = int(np.argmin(window_sums))
+    if np.isinf(window_sums[start]):
+        return -1, float("nan")
+    return start, float(window_sums[start])
+
+
+def cheapest_slots(prices: np.ndarray, slots: int) -> tuple[np.ndarray, float]:
+    """
+    Finds the cheapest slots, not necessarily consecutive.
+
+    Returns:
+        tuple[np.ndarray, float]: The sorted indexes of the slots and the sum of their prices.
+    """
+    chosen = np.sort(np.argpartition(prices, slots - 1)[:slots])
+    return chosen, float(prices[chosen].sum())
+
+
+def _window(load: Load, day: pd.Timestamp, index: pd.DatetimeIndex) -> tuple[int, int]:
+    """
+    Finds the [first, last) slot indexes of the window of a load on a local day.
+
+    The window ends are local wall-clock times, so a window keeps its hours on
+    the days the clocks change, taking the first of a repeated hour.
+    """
+    local_day = pd.Timestamp(day.date())
+    earliest = pd.Timedelta(f"{load.earliest}:00")
+    latest = pd.Timedelta(f"{load.latest}:00")
+    if latest <= earliest:
+        latest += pd.Timedelta(days=1)
+
+    return tuple(
+        int(
+            index.searchsorted(
+                (local_day + time_of_day)
+                .tz_localize(TIMEZONE, ambiguous=True, nonexistent="shift_forward")
+                .tz_convert("UTC")
+            )
+        )
+        for time_of_day in (earliest, latest)
+    )
+
+
+def _spans_duration(index: pd.DatetimeIndex, slots: int) -> np.ndarray:
+    """
+    Checks which runs of consecutive slot timestamps span exactly their duration,
+    so that the runs across missing slots are not taken as contiguous.
+    """
+    span = index[slots - 1 :] - index[: len(index) - slots + 1]
+    return np.asarray(span == pd.Timedelta(minutes=SLOT_MINUTES * (slots - 1)))
+
+
+def _slot_runs(timestamps: pd.DatetimeIndex) -> list[dict]:
+    """
+    Groups consecutive slot timestamps into runs with a start and an end.
+    """
+    runs = []
+    for timestamp in timestamps:
+        if runs and runs[-1]["end"] == timestamp:
+            runs[-1]["end"] = timestamp + pd.Timedelta(minutes=SLOT_MINUTES)
+        else:
+            runs.append(
+                {"start": timestamp, "end": timestamp + pd.Timedelta(minutes=SLOT_MINUTES)}
+            )
+
+    return [{key: value.isoformat() for key, value in run.items()} for run in runs]
+
+
+def schedule(
+    loads: list[Load],
+    day: pd.Timestamp = None,
+    days: int = 1,
+    prices_df: pd.DataFrame = None,
+    now: pd.Timestamp = None,
+) -> list[dict]:
+    """
+    Schedules each load once per day at its cheapest allowed quarter-hours.
+
+    The quarter-hours already past are not offered, so a load scheduled for
+    today starts no earlier than the current quarter-hour.
+
+    Args:
+        loads (list[Load]): The loads to schedule.
+        day (pd.Timestamp, optional): The first day to schedule. Defaults to tomorrow
+            if its prices are available, or today otherwise.
+        days (int): The number of days to schedule. Defaults to 1.
+        prices_df (pd.DataFrame, optional): The Repsol prices. Defaults to the saved prices of the horizon.
+        now (pd.Timestamp, optional): The current time. Defaults to the clock.
+
+    Returns:
+        list[dict]: One entry per load and day, with the chosen runs of slots, the
+        energy and the cost, or an error if the window does not have enough priced slots.
+    """
+    # Default to tomorrow, if its prices are already published
+    if day is None:
+        day = utils.tomorrow()
+        if not omie.energy_prices.is_available(day):
+            day = utils.today()
+
+    # Load the prices of the horizon, including the overnight windows of the last day
+    if prices_df is None:
+        prices_df = repsol.get_prices(
+            start=day - pd.Timedelta(days=1), end=day + pd.Timedelta(days=days + 1)
+        )
+    prices_df = prices_df.set_index("starting_datetime").sort_index()
+    index = prices_df.index
+    prices = prices_df["€/kWh"].to_numpy(dtype="float64")
+
+    # Skip the quarter-hours already past, but the current one
+    if now is None:
+        now = pd.Timestamp.now(tz="UTC")
+    not_before = int(index.searchsorted(now.floor(f"{SLOT_MINUTES}min")))
+
+    entries = []
+    for offset in range(days):
+        current_day = day + pd.Timedelta(days=offset)
+
+        for load in loads:
+            first, last = _window(load, current_day, index)
+            first = max(first, not_before)
+            entry = {"name": load.name, "day": str(current_day.date())}
+
+            if last - first < load.slots or load.slots == 0:
+                entry["error"] = "Not enough priced slots in the allowed window"
+                entries.append(entry)
+                continue
+
+            window_prices = prices[first:last]
+            if load.contiguous:
+                # Take only the runs without missing slots
+                start, price_sum = cheapest_contiguous(
+                    window_prices,
+                    load.slots,
+                    valid=_spans_duration(index[first:last], load.slots),
+                )
+                if start < 0:
+                    entry["error"] = (
+                        "No run of consecutive priced slots in the allowed window"
+                    )
+                    entries.append(entry)
+                    continue
+                chosen = np.arange(start, start + load.slots)
+            else:
+                chosen, price_sum = cheapest_slots(window_prices, load.slots)
+
+            energy = load.power_kW * SLOT_MINUTES / 60 * load.slots
+            entry["runs"] = _slot_runs(index[first + chosen])
+            entry["energy_kWh"] = round(energy, 6)
+            entry["cost_€"] = round(load.power_kW * SLOT_MINUTES / 60 * price_sum, 6)
+            entry["mean_€/kWh"] = round(price_sum / load.slots, 6)
+            entries.append(entry)
+
+    return entries
+
+
+def schedule_to_json(loads: list[Load], entries: list[dict]) -> str:
+    """
+    Serializes the loads and their schedule to JSON.
+    """
+    return json.dumps(
+        {"loads": [asdict(load) for load in loads], "schedule": entries},
+        ensure_ascii=False,
+        indent=2,
+    )
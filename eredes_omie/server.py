@@ -0,0 +1,249 @@
+from email.utils import format_datetime, parsedate_to_datetime
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import re
+import threading
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+import utils
+
+
+class Dataset:
+    """
+    A dataset kept in memory, indexed by timestamp, and reloaded only when one of
+    its files changes.
+    """
+
+    def __init__(self, name: str, paths: list[str]) -> None:
+        self.name = name
+        self.paths = paths
+        self.df = None
+        self.version = None
+        self.lock = threading.Lock()
+
+    def _stat(self) -> tuple:
+        """The modification time and size of every file, as the dataset version."""
+        return tuple(
+            (os.stat(path).st_mtime_ns, os.stat(path).st_size)
+            if os.path.exists(path)
+            else (0, 0)
+            for path in self.paths
+        )
+
+    def _load(self) -> pd.DataFrame:
+        """Loads and concatenates the files, indexed by timestamp."""
+        dfs = []
+        for path in self.paths:
+            if os.path.exists(path):
+                df = pd.read_csv(path, index_col=0)
+                df.index = pd.to_datetime(df.index, utc=True)
+                df.index.name = "starting_datetime"
+                dfs.append(df)
+
+        if len(dfs) == 0:
+            return pd.DataFrame(index=pd.DatetimeIndex([], tz="UTC"))
+
+        df = pd.concat(dfs).sort_index()
+        return df[~df.index.duplicated(keep="last")]
+
+    def get(self) -> tuple[pd.DataFrame, tuple]:
+        """
+        Gets the dataset and its version, reloading it first if its files changed.
+        """
+        version = self._stat()
+        if version != self.version:
+            with self.lock:
+                if version != self.version:
+                    self.df = self._load()
+                    self.version = version
+        return self.df, self.version
+
+    def last_modified(self) -> pd.Timestamp:
+        """The latest modification time of the files."""
+        return pd.Timestamp(max(mtime for mtime, _ in self.version), unit="ns", tz="UTC")
+
+
+# Datasets served, by name
+DATASETS = {
+    "prices": Dataset("prices", [utils.shared_path("repsol_indexed_prices.csv")]),
+    "omie_prices": Dataset("omie_prices", [utils.shared_path("energy_prices.csv")]),
+    "losses": Dataset("losses", [utils.shared_path("losses_profiles.csv")]),
+    "consumption": Dataset(
+        "consumption",
+        [
+            utils.data_path("consumption_history.csv"),
+            utils.data_path("current_month_consumption_history.csv"),
+        ],
+    ),
+    "shelly": Dataset("shelly", [utils.data_path("shelly_energy_history.csv")]),
+}
+
+
+def parse_period(period: str) -> tuple[pd.Timestamp, pd.Timestamp]:
+    """
+    Converts a named period into a [start, end) range of UTC days.
+
+    Supported periods are "today", "tomorrow", "yesterday" and "last_N_days",
+    where the last N days end today, inclusive.
+    """
+    if period == "today":
+        return utils.today(), utils.tomorrow()
+    if period == "tomorrow":
+        return utils.tomorrow(), utils.tomorrow() + pd.Timedelta(days=1)
+    if period == "yesterday":
+        return utils.yesterday(), utils.today()
+
+    match = re.fullmatch(r"last_(\d+)_days", period)
+    if match:
+        return utils.tomorrow() - pd.Timedelta(days=int(match.group(1))), utils.tomorrow()
+
+    raise ValueError(f"Invalid period: {period}")
+
+
+def query(
+    name: str, start: pd.Timestamp = None, end: pd.Timestamp = None
+) -> pd.DataFrame:
+    """
+    Gets the rows of a dataset in [start, end), with binary searches on its index.
+    """
+    df, _ = DATASETS[name].get()
+    first = 0 if start is None else df.index.searchsorted(start)
+    last = len(df) if end is None else df.index.searchsorted(end)
+    return df.iloc[first:last]
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    Serves range queries over the datasets:
+
+        GET /                                   lists the datasets
+        GET /<dataset>?period=tomorrow          a named period, see `parse_period`
+        GET /<dataset>?start=2024-05-01&end=2024-05-08&format=csv   (end excluded)
+
+    Responses are JSON by default, or CSV with `format=csv`. Every response has
+    an ETag and a Last-Modified header, and conditional requests get a 304 until
+    the dataset files change.
+    """
+
+    def _send(
+        self, status: int, body: bytes, content_type: str, headers: dict = None
+    ) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _send_error(self, status: int, message: str) -> None:
+        body = json.dumps({"error": message}).encode()
+        self._send(status, body, "application/json")
+
+    def do_HEAD(self) -> None:
+        self.do_GET()
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        name = url.path.strip("/")
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        if name == "":
+            body = json.dumps({"datasets": list(DATASETS)}).encode()
+            self._send(200, body, "application/json")
+            return
+
+        if name not in DATASETS:
+            self._send_error(404, f"Unknown dataset: {name}")
+            return
+
+        output_format = params.get("format", "json")
+        if output_format not in ("json", "csv"):
+            self._send_error(400, f"Invalid format: {output_format}")
+            return
+
+        try:
+            if "period" in params:
+                start, end = parse_period(params["period"])
+            else:
+                start = utils.parse_date(params["start"]) if "start" in params else None
+                end = utils.parse_date(params["end"]) if "end" in params else None
+        except ValueError as e:
+            self._send_error(400, str(e))
+            return
+
+        dataset = DATASETS[name]
+        _, version = dataset.get()
+
+        # The response only depends on the dataset version and the resolved query
+        etag = '"{}"'.format(
+            hashlib.sha1(
+                repr((version, name, str(start), str(end), output_format)).encode()
+            ).hexdigest()
+        )
+        last_modified = dataset.last_modified().floor("s")
+        headers = {
+            "ETag": etag,
+            "Last-Modified": format_datetime(last_modified.to_pydatetime(), usegmt=True),
+            "Cache-Control": "no-cache",
+        }
+
+        # Answer conditional requests without serializing the data
+        if_none_match = self.headers.get("If-None-Match")
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_none_match is not None:
+            if etag in [tag.strip() for tag in if_none_match.split(",")]:
+                self._send(304, b"", "application/json", headers)
+                return
+        elif if_modified_since is not None:
+            try:
+                if last_modified <= parsedate_to_datetime(if_modified_since):
+                    self._send(304, b"", "application/json", headers)
+                    return
+            except (TypeError, ValueError):
+                pass
+
+        df = query(name, start=start, end=end).reset_index()
+        if output_format == "csv":
+            body = df.to_csv(index=False).encode()
+            content_type = "text/csv; charset=utf-8"
+        else:
+            body = df.to_json(orient="records", date_format="iso").encode()
+            content_type = "application/json"
+
+        self._send(200, body, content_type, headers)
+
+    def log_message(self, format: str, *args) -> None:
+        # Keep the console quiet, requests are frequent
+        pass
+
+
+def serve(host: str = "127.0.0.1", port: int = 8765, debug: bool = False) -> None:
+    """
+    Loads all the datasets and serves range queries over them until interrupted.
+
+    Args:
+        host (str): The address to listen on. Defaults to localhost only.
+        port (int): The port to listen on. Defaults to 8765.
+        debug (bool): If True, logs every request. Defaults to False.
+    """
+    # Warm up all the datasets before accepting requests
+    for dataset in DATASETS.values():
+        dataset.get()
+
+    if debug:
+        QueryHandler.log_message = BaseHTTPRequestHandler.log_message
+
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    print(f"\nServing {', '.join(DATASETS)} on http://{host}:{port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
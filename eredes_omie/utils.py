@@ -1,6 +1,56 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import fcntl
+import io
+import os
+from typing import Callable, Iterator
+
 import pandas as pd
 
+# Root of the data of the account the pipeline runs for, see `accounts`
+DATA_DIR = os.getenv("EREDES_OMIE_DATA_DIR") or "/workspace/data"
+
+# Root of the datasets shared by every account: the OMIE prices, the ERSE
+# losses profiles and the indexed prices derived from them
+SHARED_DIR = os.getenv("EREDES_OMIE_SHARED_DIR") or DATA_DIR
+
+# Directory of the charts and the dashboard site
+OUTPUT_DIR = os.getenv("EREDES_OMIE_OUTPUT_DIR") or "/workspace"
+
+# Directory where the browser saves the E-REDES exports
+DOWNLOADS_DIR = os.getenv("EREDES_OMIE_DOWNLOADS_DIR") or "/workspace/downloads"
+
+
+def data_path(*parts: str) -> str:
+    """The path of a file of the account, under `DATA_DIR`."""
+    return os.path.join(DATA_DIR, *parts)
+
+
+def shared_path(*parts: str) -> str:
+    """The path of a file shared by every account, under `SHARED_DIR`."""
+    return os.path.join(SHARED_DIR, *parts)
+
+
+def output_path(*parts: str) -> str:
+    """The path of a chart or page, under `OUTPUT_DIR`."""
+    return os.path.join(OUTPUT_DIR, *parts)
+
+
+@contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    """
+    Holds an exclusive lock on a file while the block runs, so that processes
+    sharing a resource, such as a downloads directory, take turns.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
 
 def parse_date(date_str: str) -> pd.Timestamp:
     return pd.Timestamp(date_str, tz="UTC").normalize()
@@ -28,6 +78,228 @@ def repsol_start_date(start_date: str = "2024-03-16") -> pd.Timestamp:
     return parse_date(start_date)
 
 
+def _line_timestamp(line: bytes) -> pd.Timestamp:
+    """
+    Parses the timestamp stored in the first field of a CSV line as UTC.
+    """
+    timestamp = pd.Timestamp(line.split(b",", 1)[0].decode().strip())
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize("UTC")
+    return timestamp
+
+
+def _bisect_offset(file, data_start: int, size: int, timestamp: pd.Timestamp) -> int:
+    """
+    Finds the offset of the first line whose timestamp is at or after the given
+    timestamp, in a file sorted by its first column.
+    """
+    lo, hi = data_start, size
+    while lo < hi:
+        mid = (lo + hi) // 2
+
+        # Align to the first line starting at or after mid
+        file.seek(mid - 1 if mid > data_start else mid)
+        if mid > data_start:
+            file.readline()
+        line = file.readline()
+
+        # Lines at the end of the file always satisfy the condition
+        if not line.strip():
+            hi = mid
+            continue
+
+        if _line_timestamp(line) >= timestamp:
+            hi = mid
+        else:
+            lo = mid + 1
+
+    # Return the start of the first line at or after lo
+    file.seek(lo - 1 if lo > data_start else lo)
+    if lo > data_start:
+        file.readline()
+    return file.tell()
+
+
+def csv_offset(path: str, timestamp: pd.Timestamp) -> int:
+    """
+    Finds the byte offset of the first row at or after the given timestamp in a CSV
+    file with a header line, sorted by the timestamp stored in its first column.
+
+    Args:
+        path (str): The path to the CSV file.
+        timestamp (pd.Timestamp): The timestamp to look for.
+
+    Returns:
+        int: The offset of the row, or the size of the file if there is none.
+    """
+    with open(path, "rb") as file:
+        file.readline()
+        data_start = file.tell()
+        file.seek(0, io.SEEK_END)
+        return _bisect_offset(file, data_start, file.tell(), timestamp)
+
+
+def read_csv_range(
+    path: str,
+    start: pd.Timestamp = None,
+    end: pd.Timestamp = None,
+    **kwargs,
+) -> pd.DataFrame:
+    """
+    Reads only the rows of a CSV file whose timestamp falls in [start, end).
+
+    The file must have a header line and be sorted by a timestamp stored in its
+    first column, as all the CSV files written by this package are. The range
+    boundaries are found with a binary search over the file offsets, so the cost
+    depends on the size of the range and not on the size of the file. Rows out
+    of order are not detected and may be skipped, so files written unsorted by
+    earlier versions are sorted once with `sort_csv`.
+
+    Args:
+        path (str): The path to the CSV file.
+        start (pd.Timestamp, optional): The first timestamp to include. Defaults to the start of the file.
+        end (pd.Timestamp, optional): The first timestamp to exclude. Defaults to the end of the file.
+        **kwargs: Extra arguments passed to `pd.read_csv`.
+
+    Returns:
+        pd.DataFrame: The rows in the requested range.
+    """
+    with open(path, "rb") as file:
+        # Keep the header line so that `pd.read_csv` sees the same layout
+        header = file.readline()
+        data_start = file.tell()
+        file.seek(0, io.SEEK_END)
+        size = file.tell()
+
+        # Find the byte range covering the requested timestamps
+        first = (
+            data_start if start is None else _bisect_offset(file, data_start, size, start)
+        )
+        last = size if end is None else _bisect_offset(file, data_start, size, end)
+
+        file.seek(first)
+        body = file.read(max(last - first, 0))
+
+    return pd.read_csv(io.BytesIO(header + body), **kwargs)
+
+
+def sort_csv(path: str) -> bool:
+    """
+    Sorts a CSV file by the timestamp stored in its first column, the last row
+    of each timestamp winning, so that it can be read with `read_csv_range`.
+
+    The file is parsed in full, so this is meant for files written before their
+    writers kept them sorted, and is not called on every run.
+
+    Args:
+        path (str): The path to the CSV file.
+
+    Returns:
+        bool: True if the file was not sorted and was rewritten.
+    """
+    df = pd.read_csv(path, dtype=str, keep_default_na=False)
+    timestamps = pd.to_datetime(df.iloc[:, 0], utc=True)
+    if timestamps.is_monotonic_increasing and timestamps.is_unique:
+        return False
+
+    # Keep the last row of each timestamp, in the order of the timestamps
+    timestamps = timestamps.sort_values(kind="stable")
+    df = df.loc[timestamps[~timestamps.duplicated(keep="last")].index]
+
+    # Write to a temporary file first, so that readers never see a partial file
+    df.to_csv(f"{path}.tmp", index=False)
+    os.replace(f"{path}.tmp", path)
+    return True
+
+
+def read_csv_chunks(
+    path: str,
+    start: pd.Timestamp = None,
+    chunk_rows: int = 100_000,
+    **kwargs,
+) -> Iterator[pd.DataFrame]:
+    """
+    Reads the rows of a CSV file from a timestamp in chunks of rows, so that
+    memory use does not grow with the length of the file.
+
+    The file must be sorted as for `read_csv_range`, and the start of the rows
+    is found the same way.
+
+    Args:
+        path (str): The path to the CSV file.
+        start (pd.Timestamp, optional): The first timestamp to include. Defaults to the start of the file.
+        chunk_rows (int): The rows of each chunk.
+        **kwargs: Extra arguments passed to `pd.read_csv`.
+
+    Yields:
+        pd.DataFrame: The next rows of the file.
+    """
+    with open(path, "rb") as file:
+        names = file.readline().decode().rstrip("\r\n").split(",")
+        data_start = file.tell()
+        file.seek(0, io.SEEK_END)
+        size = file.tell()
+
+        file.seek(
+            data_start if start is None else _bisect_offset(file, data_start, size, start)
+        )
+        yield from pd.read_csv(
+            file, header=None, names=names, chunksize=chunk_rows, **kwargs
+        )
+
+
+def _read_excel(
+    file: str, transform: Callable[[pd.DataFrame], pd.DataFrame], kwargs: dict
+) -> pd.DataFrame:
+    """
+    Parses a workbook and transforms it, in a worker process.
+    """
+    df = pd.read_excel(file, **kwargs)
+    return df if transform is None else transform(df)
+
+
+def read_excel_files(
+    files: list[str],
+    transform: Callable[[pd.DataFrame], pd.DataFrame] = None,
+    workers: int = None,
+    **kwargs,
+) -> list[pd.DataFrame]:
+    """
+    Parses workbooks concurrently in a process pool, as openpyxl parsing is
+    CPU-bound and single-threaded.
+
+    Each worker also applies `transform` to its workbook, so that only the
+    final columns are sent back to the parent. The transform must be a
+    module-level function, to be sent to the workers, and must work row by row,
+    so that concatenating the transformed workbooks gives the same result as
+    transforming their concatenation.
+
+    Args:
+        files (list[str]): The paths of the workbooks.
+        transform (Callable, optional): Applied to each parsed workbook in its worker.
+        workers (int, optional): The number of worker processes. Defaults to the number of CPUs.
+        **kwargs: Passed to `pd.read_excel`.
+
+    Returns:
+        list[pd.DataFrame]: The transformed workbooks, in the order of the files.
+    """
+    workers = min(workers or os.cpu_count() or 1, len(files))
+
+    # A pool is not worth starting for a single workbook
+    if workers <= 1:
+        return [_read_excel(file, transform, kwargs) for file in files]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(
+            executor.map(
+                _read_excel,
+                files,
+                [transform] * len(files),
+                [kwargs] * len(files),
+            )
+        )
+
+
 def parser_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -38,9 +310,224 @@ def parser_args() -> argparse.Namespace:
         "--no-shelly", action="store_true", help="Do not update Shelly PM data"
     )
     parser.add_argument("--losses", action="store_true", help="Update losses profiles")
+    parser.add_argument(
+        "--pack-prices",
+        action="store_true",
+        help="Pack the OMIE prices files of closed months into monthly archives",
+    )
+    parser.add_argument(
+        "--export",
+        action="store_true",
+        help="Export the changed datasets as Arrow IPC files (needs pyarrow)",
+    )
+    parser.add_argument(
+        "--dashboard",
+        action="store_true",
+        help="Rebuild the changed pages of the static dashboard site",
+    )
     parser.add_argument("--override", action="store_true", help="Override images")
     parser.add_argument(
         "--start-date", type=str, help="Start date in YYYY-MM-DD format"
     )
+    parser.add_argument(
+        "--window-days",
+        type=int,
+        default=7,
+        help="Number of days shown in the energy consumption chart",
+    )
+    parser.add_argument(
+        "--window-start",
+        type=str,
+        help="Energy consumption chart start date in YYYY-MM-DD format",
+    )
+    parser.add_argument(
+        "--window-end",
+        type=str,
+        help="Energy consumption chart end date (inclusive) in YYYY-MM-DD format",
+    )
+    parser.add_argument(
+        "--show",
+        action="store_true",
+        help="Show the energy consumption chart, waiting until its window is closed",
+    )
     parser.add_argument("--debug", action="store_true", help="Turn on debug mode")
+
+    # Optional commands, run instead of the update pipeline
+    subparsers = parser.add_subparsers(dest="command")
+    schedule_parser = subparsers.add_parser(
+        "schedule", help="Schedule deferrable loads at the cheapest quarter-hours"
+    )
+    schedule_parser.add_argument(
+        "loads", type=str, help="JSON file with the list of loads to schedule"
+    )
+    schedule_parser.add_argument(
+        "--date", type=str, help="First day to schedule in YYYY-MM-DD format"
+    )
+    schedule_parser.add_argument(
+        "--days", type=int, default=1, help="Number of days to schedule"
+    )
+
+    gaps_parser = subparsers.add_parser(
+        "gaps", help="Find the missing quarter-hours of each dataset"
+    )
+    gaps_parser.add_argument(
+        "datasets",
+        nargs="*",
+        help="Datasets to check: omie, repsol, losses, consumption, shelly (default: all)",
+    )
+    gaps_parser.add_argument("--start", type=str, help="Start date in YYYY-MM-DD format")
+    gaps_parser.add_argument(
+        "--end", type=str, help="End date (inclusive) in YYYY-MM-DD format"
+    )
+    gaps_parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Rebuild the coverage bitmaps from the data files first",
+    )
+    gaps_parser.add_argument(
+        "--backfill",
+        action="store_true",
+        help="Queue the missing ranges as backfill jobs and run them",
+    )
+    gaps_parser.add_argument(
+        "--workers", type=int, default=1, help="Backfill worker processes (default: 1)"
+    )
+
+    query_parser = subparsers.add_parser(
+        "query", help="Run a SQL query over the datasets, synced to SQLite tables"
+    )
+    query_parser.add_argument(
+        "sql",
+        nargs="?",
+        type=str,
+        help='Query, e.g. \'SELECT AVG("€/kWh") FROM repsol_prices\' (default: list the tables)',
+    )
+    query_parser.add_argument(
+        "--csv", action="store_true", help="Print the result as CSV"
+    )
+    query_parser.add_argument(
+        "--force", action="store_true", help="Reload every table from its sources first"
+    )
+
+    jobs_parser = subparsers.add_parser("jobs", help="Manage the backfill job queue")
+    jobs_subparsers = jobs_parser.add_subparsers(dest="action")
+    jobs_add_parser = jobs_subparsers.add_parser(
+        "add", help="Queue the backfill of a date range"
+    )
+    jobs_add_parser.add_argument(
+        "dataset", choices=["omie", "repsol", "losses", "consumption", "shelly"]
+    )
+    jobs_add_parser.add_argument(
+        "--start", type=str, required=True, help="Start date in YYYY-MM-DD format"
+    )
+    jobs_add_parser.add_argument(
+        "--end", type=str, required=True, help="End date (inclusive) in YYYY-MM-DD format"
+    )
+    jobs_run_parser = jobs_subparsers.add_parser("run", help="Run the due jobs")
+    jobs_run_parser.add_argument(
+        "--workers", type=int, default=1, help="Worker processes (default: 1)"
+    )
+    jobs_subparsers.add_parser("retry", help="Queue the failed jobs again")
+    jobs_subparsers.add_parser("status", help="Count the jobs in each state")
+
+    forecast_parser = subparsers.add_parser(
+        "forecast", help="Forecast the energy and cost of a day"
+    )
+    forecast_parser.add_argument(
+        "--date",
+        type=str,
+        help="Day to forecast in YYYY-MM-DD format (default: tomorrow if priced)",
+    )
+    forecast_parser.add_argument(
+        "--model",
+        type=str,
+        default="regression",
+        choices=["profile", "regression"],
+        help="Forecast model",
+    )
+
+    tariffs_parser = subparsers.add_parser(
+        "tariffs",
+        help="Compare the cost of the consumption with fixed-price tariffs and Repsol",
+    )
+    tariffs_parser.add_argument(
+        "--tariffs",
+        type=str,
+        default="/workspace/tariffs.json",
+        help="JSON file with the list of tariffs (default: /workspace/tariffs.json)",
+    )
+    tariffs_parser.add_argument("--start", type=str, help="Start date in YYYY-MM-DD format")
+    tariffs_parser.add_argument(
+        "--end", type=str, help="End date (inclusive) in YYYY-MM-DD format"
+    )
+    tariffs_parser.add_argument(
+        "--repsol-daily-charge",
+        type=float,
+        default=0.0,
+        help="Daily fixed charge of the Repsol tariff in € (default: 0)",
+    )
+
+    export_parser = subparsers.add_parser(
+        "export", help="Export the datasets as Arrow IPC files (needs pyarrow)"
+    )
+    export_parser.add_argument(
+        "datasets",
+        nargs="*",
+        help="Datasets to export: omie_prices, repsol_prices, losses, consumption, "
+        "shelly, cost_ledger (default: all)",
+    )
+    export_parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Export the datasets even if their sources did not change",
+    )
+
+    subparsers.add_parser(
+        "dtypes",
+        help="Compare the memory used by the datasets in their current and compact dtypes",
+    )
+
+    dashboard_parser = subparsers.add_parser(
+        "dashboard", help="Build the static dashboard site, only the changed pages"
+    )
+    dashboard_parser.add_argument(
+        "--force", action="store_true", help="Rebuild every page"
+    )
+
+    accounts_parser = subparsers.add_parser(
+        "accounts",
+        help="Run the pipeline of many accounts in parallel, the shared prices updated once",
+    )
+    accounts_parser.add_argument(
+        "names", nargs="*", help="Accounts to run (default: all)"
+    )
+    accounts_parser.add_argument(
+        "--profiles",
+        type=str,
+        default="/workspace/accounts.json",
+        help="JSON file with the account profiles",
+    )
+    accounts_parser.add_argument(
+        "--workers", type=int, help="Number of accounts run at once (default: all)"
+    )
+
+    daemon_parser = subparsers.add_parser(
+        "daemon", help="Keep running, updating each source on its own cadence"
+    )
+    daemon_parser.add_argument(
+        "--once", action="store_true", help="Run the due jobs once and exit"
+    )
+    daemon_parser.add_argument(
+        "--export",
+        action="store_true",
+        help="Export the updated datasets as Arrow IPC files (needs pyarrow)",
+    )
+
+    serve_parser = subparsers.add_parser(
+        "serve", help="Serve the datasets over a local HTTP query API"
+    )
+    serve_parser.add_argument(
+        "--host", type=str, default="127.0.0.1", help="Address to listen on"
+    )
+    serve_parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
     return parser.parse_args()
@@ -0,0 +1,22 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+# Keep the files written by the tests apart from the real datasets, before the
+# modules read their locations from the environment
+DATA_DIR = tempfile.mkdtemp(prefix="eredes_omie_tests_")
+for name in ("DATA_DIR", "SHARED_DIR", "OUTPUT_DIR", "DOWNLOADS_DIR"):
+    os.environ[f"EREDES_OMIE_{name}"] = DATA_DIR
+
+
+@pytest.fixture(autouse=True)
+def data_dir():
+    """Starts each test with an empty data directory and cache."""
+    import cache
+
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+    os.makedirs(DATA_DIR)
+    cache.invalidate()
+    yield DATA_DIR
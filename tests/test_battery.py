@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import battery
+
+
+def _history(prices: list[float], start: str) -> pd.DataFrame:
+    index = pd.date_range(start, periods=len(prices), freq="15min", tz="UTC")
+    return pd.DataFrame({"grid_kWh": 0.0, "€/kWh": prices}, index=index)
+
+
+def test_cheap_slots_need_a_later_price_worth_the_losses():
+    history_df = pd.concat(
+        [
+            _history([0.20, 0.05, 0.30, 0.10, 0.06, 0.065, 0.04, 0.045], "2024-01-01"),
+            _history([0.01, 0.02], "2024-01-02"),
+        ]
+    )
+
+    cheap = battery.cheap_slots(history_df, quantile=0.5, efficiency=0.9)
+
+    # 0.06 is only followed by 0.065 * 0.9, and the last slots of a day by nothing
+    assert cheap.tolist() == [
+        False, True, False, False, False, False, True, False, True, False
+    ]
+
+
+def test_arbitrage_recovers_the_charge_cost():
+    history_df = _history([0.05, 0.30], "2024-01-01")
+    history_df["grid_kWh"] = [0.0, 1.0]
+
+    totals = battery.dispatch(
+        history_df["grid_kWh"].to_numpy(),
+        history_df["€/kWh"].to_numpy(),
+        battery.cheap_slots(history_df, quantile=0.5),
+        capacity=np.array([4.0]),
+        power=np.array([4.0]),
+        strategy="arbitrage",
+    )
+
+    # 1 kWh bought at 0.05 covers 0.9 kWh of the 0.30 quarter-hour
+    assert totals["discharged_kWh"][0] == pytest.approx(0.9)
+    assert totals["cost_€"][0] == pytest.approx(0.05 + 0.1 * 0.30)
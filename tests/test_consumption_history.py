@@ -0,0 +1,110 @@
+import os
+
+import pandas as pd
+
+from e_redes import consumption_history
+import utils
+
+
+def _readings(timestamps: list[str], kwh: list[float]) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "starting_datetime": pd.to_datetime(timestamps, utc=True),
+            "consumption_kwh": kwh,
+            "injection_kwh": 0.0,
+        }
+    )
+
+
+def _read(path) -> pd.DataFrame:
+    return pd.read_csv(path, parse_dates=["starting_datetime"])
+
+
+def test_upsert_latest_export_wins(tmp_path):
+    path = str(tmp_path / "consumption_history.csv")
+    consumption_history.upsert(
+        path,
+        _readings(
+            ["2024-01-01 00:00", "2024-01-01 00:15", "2024-01-01 00:30"],
+            [0.1, 0.2, 0.3],
+        ),
+    )
+
+    # A later export revises a slot, repeats another and adds a new one
+    upserted = consumption_history.upsert(
+        path,
+        _readings(
+            ["2024-01-01 00:15", "2024-01-01 00:15", "2024-01-01 00:45"],
+            [0.5, 0.25, 0.4],
+        ),
+    )
+
+    df = _read(path)
+    assert upserted == 2
+    assert df["starting_datetime"].is_monotonic_increasing
+    assert df["consumption_kwh"].tolist() == [0.1, 0.25, 0.3, 0.4]
+
+
+def test_upsert_keeps_slots_before_the_readings(tmp_path):
+    path = str(tmp_path / "consumption_history.csv")
+    timestamps = pd.date_range("2024-01-01", periods=8, freq="15min", tz="UTC")
+    consumption_history.upsert(path, _readings(timestamps, [0.1] * 8))
+
+    consumption_history.upsert(path, _readings(timestamps[[2, 6]], [0.9, 0.9]))
+
+    df = _read(path)
+    assert len(df) == 8
+    assert df["consumption_kwh"].tolist() == [0.1, 0.1, 0.9, 0.1, 0.1, 0.1, 0.9, 0.1]
+
+
+def test_upsert_replaces_the_file(tmp_path):
+    path = str(tmp_path / "consumption_history.csv")
+    timestamps = pd.date_range("2024-01-01", periods=4, freq="15min", tz="UTC")
+    consumption_history.upsert(path, _readings(timestamps, [0.1] * 4))
+
+    consumption_history.upsert(path, _readings(timestamps[2:], [0.3, 0.3]))
+
+    assert sorted(os.listdir(tmp_path)) == ["consumption_history.csv"]
+    assert _read(path)["consumption_kwh"].tolist() == [0.1, 0.1, 0.3, 0.3]
+
+
+def test_later_export_revises_slot_to_zero(tmp_path):
+    path = str(tmp_path / "consumption_history.csv")
+
+    def export(consumption_kw: list[float]) -> pd.DataFrame:
+        return consumption_history.process_dataframe(
+            pd.DataFrame(
+                {
+                    "date": "2024-01-01",
+                    "time": ["00:15", "00:30"],
+                    "consumption_kw": consumption_kw,
+                    "injection_kw": 0.0,
+                }
+            )
+        )
+
+    consumption_history.upsert(path, export([0.4, 0.8]))
+    consumption_history.upsert(path, export([0.4, 0.0]))
+
+    assert _read(path)["consumption_kwh"].tolist() == [0.1, 0.0]
+
+
+def test_sort_concatenated_exports(tmp_path):
+    path = str(tmp_path / "current_month_consumption_history.csv")
+
+    # Two overlapping exports concatenated as they came, the later one second
+    timestamps = pd.date_range("2024-01-01", periods=4, freq="15min", tz="UTC")
+    pd.concat(
+        [
+            _readings(timestamps[2:], [0.3, 0.4]),
+            _readings(timestamps[:3], [0.1, 0.2, 0.9]),
+        ]
+    ).to_csv(path, index=False)
+
+    assert utils.sort_csv(path)
+    assert not utils.sort_csv(path)
+
+    df = utils.read_csv_range(
+        path, start=timestamps[1], parse_dates=["starting_datetime"]
+    )
+    assert df["consumption_kwh"].tolist() == [0.2, 0.9, 0.4]
@@ -0,0 +1,38 @@
+import pandas as pd
+
+import coverage
+
+START = pd.Timestamp("2024-01-01", tz="UTC")
+
+
+def _slots(first: int, last: int) -> pd.DatetimeIndex:
+    """The quarter-hours [first, last) after `START`."""
+    return pd.date_range(
+        START + first * coverage.SLOT, periods=last - first, freq=coverage.SLOT
+    )
+
+
+def test_gaps_span_bitmap_words(tmp_path):
+    coverage_dir = str(tmp_path)
+    coverage.mark("shelly", _slots(0, 60), coverage_dir=coverage_dir)
+    coverage.mark("shelly", _slots(70, 200), coverage_dir=coverage_dir)
+
+    end = START + 210 * coverage.SLOT
+    assert coverage.count("shelly", START, end, coverage_dir=coverage_dir) == 190
+    assert coverage.gaps("shelly", START, end, coverage_dir=coverage_dir) == [
+        (START + 60 * coverage.SLOT, START + 70 * coverage.SLOT),
+        (START + 200 * coverage.SLOT, end),
+    ]
+    assert coverage.first_slot("shelly", coverage_dir=coverage_dir) == START
+
+
+def test_mark_floors_to_the_slot(tmp_path):
+    coverage_dir = str(tmp_path)
+    minutes = pd.date_range(START + pd.Timedelta(minutes=16), periods=3, freq="1min")
+    coverage.mark("shelly", minutes, coverage_dir=coverage_dir)
+
+    end = START + pd.Timedelta(hours=1)
+    assert coverage.gaps("shelly", START, end, coverage_dir=coverage_dir) == [
+        (START, START + coverage.SLOT),
+        (START + 2 * coverage.SLOT, end),
+    ]
@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+import daemon
+
+
+@pytest.fixture
+def failing_round(monkeypatch):
+    """Runs the daemon with one job, in rounds that fail before the next runs."""
+    job = daemon.Job("prices", lambda debug: None, lambda now, last: now, [], [])
+    monkeypatch.setattr(daemon, "JOBS", [job])
+    monkeypatch.setattr(daemon, "warm", lambda debug=False: None)
+
+    def versions(paths):
+        raise OSError("Stale file handle")
+
+    monkeypatch.setattr(daemon, "_versions", versions)
+
+
+def test_failed_round_sleeps_until_the_retry(monkeypatch, failing_round, data_dir):
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(daemon.time, "sleep", sleep)
+    daemon.run(status_path=os.path.join(data_dir, "daemon_status.json"))
+
+    assert sleeps == [min(daemon.RETRY.total_seconds(), daemon.MAX_SLEEP_SECONDS)]
+
+
+def test_failed_round_raises_when_run_once(failing_round, data_dir):
+    with pytest.raises(OSError):
+        daemon.run(
+            status_path=os.path.join(data_dir, "daemon_status.json"), once=True
+        )
@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+
+import forecast
+
+
+def _history(days: int, end: pd.Timestamp) -> pd.DataFrame:
+    """A history repeating the same day: 1 kWh consumed per quarter-hour at night, 3 by day."""
+    index = pd.date_range(
+        end - pd.Timedelta(days=days), end, freq="15min", inclusive="left", tz="UTC"
+    )
+    day = (index.hour >= 8) & (index.hour < 20)
+    return pd.DataFrame(
+        {
+            "consumed_kWh": np.where(day, 3.0, 1.0),
+            "solar_kWh": np.where(day, 2.0, 0.0),
+        },
+        index=index,
+    )
+
+
+def test_day_index_follows_clock_changes():
+    assert len(forecast._day_index(pd.Timestamp("2024-03-31"))) == 92
+    assert len(forecast._day_index(pd.Timestamp("2024-10-27"))) == 100
+    assert len(forecast._day_index(pd.Timestamp("2024-06-01"))) == 96
+
+
+def test_profile_repeats_recent_days():
+    day = pd.Timestamp("2024-01-20")
+    history_df = _history(14, end=pd.Timestamp("2024-01-19", tz="UTC"))
+
+    forecast_df = forecast.predict(history_df, day, model="profile")
+
+    # Lisbon is on UTC in winter, so the local quarter-hours match the UTC ones
+    expected = _history(1, end=pd.Timestamp("2024-01-21", tz="UTC"))
+    np.testing.assert_allclose(forecast_df["consumed_kWh"], expected["consumed_kWh"])
+    np.testing.assert_allclose(forecast_df["grid_kWh"], [1.0] * 96)
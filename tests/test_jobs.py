@@ -0,0 +1,77 @@
+import time
+
+import pandas as pd
+import pytest
+
+import jobs
+
+START = pd.Timestamp("2024-01-01", tz="UTC")
+END = pd.Timestamp("2024-03-01", tz="UTC")
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "jobs.sqlite")
+
+
+@pytest.fixture
+def connection(path):
+    connection = jobs.connect(path)
+    yield connection
+    connection.close()
+
+
+def test_enqueue_splits_months_once(path):
+    assert jobs.enqueue("consumption", START, END, path=path) == 2
+    assert jobs.enqueue("consumption", START, END, path=path) == 0
+
+
+def test_enqueue_queues_done_units_again(path, connection):
+    jobs.enqueue("consumption", START, END, path=path)
+
+    job = jobs.claim(connection, "worker-1")
+    jobs._checkpoint(connection, job, job.start + pd.Timedelta(days=10))
+    assert jobs._finish(connection, job, None) == "done"
+
+    assert jobs.enqueue("consumption", START, END, path=path) == 1
+    again = jobs.claim(connection, "worker-1")
+    assert again.id == job.id
+    assert again.attempts == 0
+    assert again.checkpoint is None
+
+
+def test_claim_reclaims_expired_lease(path, connection):
+    jobs.enqueue("shelly", START, END, path=path)
+
+    job = jobs.claim(connection, "worker-1")
+    assert jobs.claim(connection, "worker-2") is None
+
+    # The first worker crashed, and its lease ran out
+    connection.execute(
+        "UPDATE jobs SET lease_until = ? WHERE id = ?", (time.time() - 1, job.id)
+    )
+    reclaimed = jobs.claim(connection, "worker-2")
+    assert reclaimed.id == job.id
+    worker, state = connection.execute(
+        "SELECT worker, state FROM jobs WHERE id = ?", (job.id,)
+    ).fetchone()
+    assert (worker, state) == ("worker-2", "running")
+
+
+def test_finish_retries_with_backoff_then_fails(path, connection):
+    jobs.enqueue("shelly", START, END, path=path)
+    job = jobs.claim(connection, "worker-1")
+
+    assert jobs._finish(connection, job, RuntimeError("timeout")) == "pending"
+    not_before = connection.execute(
+        "SELECT not_before FROM jobs WHERE id = ?", (job.id,)
+    ).fetchone()[0]
+    assert not_before >= time.time() + jobs.RETRY_SECONDS - 5
+    assert jobs.claim(connection, "worker-1") is None
+
+    job.attempts = jobs.MAX_ATTEMPTS - 1
+    assert jobs._finish(connection, job, RuntimeError("timeout")) == "failed"
+
+    failed = jobs.PermanentError("month no longer exported")
+    job.attempts = 0
+    assert jobs._finish(connection, job, failed) == "failed"
@@ -0,0 +1,73 @@
+import pandas as pd
+import pytest
+
+import ledger
+import utils
+
+DAY_1 = pd.Timestamp("2024-01-01", tz="UTC")
+DAY_2 = pd.Timestamp("2024-01-02", tz="UTC")
+SLOTS = [DAY_1, DAY_1 + pd.Timedelta(minutes=15), DAY_2]
+
+
+def _save_history(slots: list[pd.Timestamp], grid: list[float], solar: list[float]):
+    pd.DataFrame(
+        {
+            "timestamp_utc": slots,
+            "grid_kWh": grid,
+            "solar_kWh": solar,
+            "consumed_kWh": [g + s for g, s in zip(grid, solar)],
+        }
+    ).to_csv(utils.data_path("shelly_energy_history.csv"), index=False)
+
+
+def _save_prices(slots: list[pd.Timestamp], prices: list[float]):
+    pd.DataFrame({"starting_datetime": slots, "€/kWh": prices}).to_csv(
+        utils.shared_path("repsol_indexed_prices.csv"), index=False
+    )
+
+
+@pytest.fixture
+def path(tmp_path):
+    # Bought at 0.10, bought at a negative price, and exported with solar
+    _save_history(SLOTS, grid=[1.0, 0.5, -0.5], solar=[0.0, 0.0, 1.0])
+    _save_prices(SLOTS, [0.10, -0.02, 0.20])
+    return str(tmp_path / "cost_ledger_daily.csv")
+
+
+def test_update_daily_costs_clips_each_quarter_hour(path):
+    daily_df = ledger.update_daily_costs(path=path)
+
+    assert daily_df["slots"].tolist() == [2, 1]
+    assert daily_df["bought_kWh"].tolist() == pytest.approx([1.5, 0.0])
+    assert daily_df["exported_kWh"].tolist() == pytest.approx([0.0, 0.5])
+    assert daily_df["bought_€"].tolist() == pytest.approx([0.10, 0.0])
+    assert daily_df["exported_€"].tolist() == pytest.approx([0.01, 0.10])
+    assert daily_df["solar_production_€"].tolist() == pytest.approx([0.0, 0.20])
+    assert daily_df["solar_consumption_€"].tolist() == pytest.approx([-0.01, 0.10])
+    assert daily_df["consumed_€"].tolist() == pytest.approx([0.09, 0.10])
+
+
+def test_get_totals_sums_the_days(path):
+    ledger.update_daily_costs(path=path)
+
+    totals_df = ledger.get_totals("month", path=path)
+
+    assert len(totals_df) == 1
+    assert totals_df["slots"].iloc[0] == 3
+    assert totals_df["bought_€"].iloc[0] == pytest.approx(0.10)
+    assert totals_df["exported_€"].iloc[0] == pytest.approx(0.11)
+    assert totals_df["consumed_€"].iloc[0] == pytest.approx(0.19)
+
+
+def test_update_daily_costs_recomputes_the_last_day(path):
+    ledger.update_daily_costs(path=path)
+
+    # The last day gets another quarter-hour, bought at 0.30
+    slots = SLOTS + [DAY_2 + pd.Timedelta(minutes=15)]
+    _save_history(slots, grid=[1.0, 0.5, -0.5, 2.0], solar=[0.0, 0.0, 1.0, 0.0])
+    _save_prices(slots, [0.10, -0.02, 0.20, 0.30])
+    daily_df = ledger.update_daily_costs(path=path)
+
+    assert daily_df["slots"].tolist() == [2, 2]
+    assert daily_df["bought_€"].tolist() == pytest.approx([0.10, 0.60])
+    assert ledger.get_daily_costs(path)["bought_€"].tolist() == pytest.approx([0.10, 0.60])
@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+
+import plot
+
+
+def _series(values: list[float], freq: str = "15min") -> pd.Series:
+    index = pd.date_range("2024-01-01", periods=len(values), freq=freq, tz="UTC")
+    return pd.Series(values, index=index, dtype="float64")
+
+
+def test_downsample_keeps_short_series():
+    series = _series(np.arange(168.0), freq="1h")
+
+    assert plot.downsample(series, 1162) is series
+
+
+def test_downsample_keeps_the_envelope_of_each_bucket():
+    values = np.zeros(96 * 365)
+    values[1000] = 5.0
+    values[20000] = -3.0
+    series = _series(values)
+
+    downsampled = plot.downsample(series, 100)
+
+    assert len(downsampled) <= 200
+    assert downsampled.index.is_monotonic_increasing
+    assert downsampled.max() == 5.0
+    assert downsampled.min() == -3.0
+    assert series.index[1000] in downsampled.index
+
+
+def test_downsample_keeps_the_gaps():
+    values = np.ones(1000)
+    values[400:600] = np.nan
+    series = _series(values)
+
+    downsampled = plot.downsample(series, 10)
+
+    # The buckets inside the gap keep a missing point, so the line is broken there
+    assert downsampled.isna().any()
+    assert downsampled.notna().sum() > 0
@@ -0,0 +1,56 @@
+import os
+
+import pandas as pd
+import pytest
+
+import reconcile
+import utils
+
+
+def test_update_daily_skips_without_shelly_history(tmp_path, capsys):
+    path = str(tmp_path / "reconciliation_daily.csv")
+    pd.DataFrame(
+        {
+            "starting_datetime": ["2024-01-01 00:00:00+00:00"],
+            "consumption_kwh": [0.2],
+            "injection_kwh": [0.0],
+        }
+    ).to_csv(utils.data_path("consumption_history.csv"), index=False)
+
+    daily_df = reconcile.update_daily(path=path)
+
+    assert len(daily_df) == 0
+    assert not os.path.exists(path)
+    assert "no Shelly energy history" in capsys.readouterr().out
+
+
+def test_align_compares_net_grid_energy():
+    slots = pd.date_range("2024-01-01", periods=3, freq="15min", tz="UTC")
+    pd.DataFrame(
+        {
+            "starting_datetime": slots,
+            "consumption_kwh": [0.5, 0.0, 0.2],
+            "injection_kwh": [0.0, 0.3, 0.0],
+        }
+    ).to_csv(utils.data_path("consumption_history.csv"), index=False)
+    # The Shelly misses the last quarter-hour
+    pd.DataFrame(
+        {
+            "timestamp_utc": slots[:2],
+            "grid_kWh": [0.6, -0.25],
+            "solar_kWh": [0.0, 0.5],
+            "consumed_kWh": [0.6, 0.25],
+        }
+    ).to_csv(utils.data_path("shelly_energy_history.csv"), index=False)
+
+    aligned_df = reconcile.align()
+
+    assert aligned_df.index.tolist() == slots[:2].tolist()
+    assert aligned_df["shelly_bought_kWh"].tolist() == [0.6, 0.0]
+    assert aligned_df["shelly_exported_kWh"].tolist() == [0.0, 0.25]
+    assert aligned_df["delta_kWh"].tolist() == pytest.approx([0.1, 0.05])
+
+    daily_df = reconcile.rollup_daily(aligned_df)
+    assert daily_df["slots"].tolist() == [2]
+    assert daily_df["abs_delta_kWh"].tolist() == pytest.approx([0.15])
+    assert daily_df["max_abs_delta_kWh"].tolist() == pytest.approx([0.1])
@@ -0,0 +1,78 @@
+import pandas as pd
+
+import rollups
+
+SLOTS = pd.date_range("2024-01-01", periods=4, freq="15min", tz="UTC")
+
+
+def _history(grid_kwh: list[float]) -> pd.DataFrame:
+    return pd.DataFrame(
+        {"grid_kWh": grid_kwh, "solar_kWh": 0.0, "consumed_kWh": grid_kwh},
+        index=pd.DatetimeIndex(SLOTS[: len(grid_kwh)], name="timestamp_utc"),
+    )
+
+
+def test_ingest_leaves_partial_slot_for_later(tmp_path):
+    rollups_dir = str(tmp_path)
+
+    # The last quarter-hour was still receiving readings
+    rollups.ingest(
+        "shelly", _history([1.0, 1.0, 0.2]), rollups_dir=rollups_dir, end=SLOTS[2]
+    )
+    assert rollups.get_watermark("shelly", rollups_dir) == SLOTS[1]
+
+    rollups.ingest("shelly", _history([1.0, 1.0, 1.0, 1.0]), rollups_dir=rollups_dir)
+
+    hour_df = rollups.get("shelly", "hour", rollups_dir=rollups_dir)
+    assert hour_df["grid_kWh_sum"].tolist() == [4.0]
+    assert hour_df["grid_kWh_count"].tolist() == [4]
+
+
+def _save_consumption(path: str, slots: pd.DatetimeIndex, kwh: list[float]) -> None:
+    pd.DataFrame(
+        {"starting_datetime": slots, "consumption_kwh": kwh, "injection_kwh": 0.0}
+    ).to_csv(path, index=False)
+
+
+def test_ingest_skips_quarter_hours_up_to_watermark(tmp_path):
+    rollups_dir = str(tmp_path)
+
+    assert rollups.ingest("shelly", _history([1.0, 2.0]), rollups_dir=rollups_dir) == 2
+    assert (
+        rollups.ingest("shelly", _history([5.0, 5.0, 3.0]), rollups_dir=rollups_dir) == 1
+    )
+
+    assert rollups.get_watermark("shelly", rollups_dir) == SLOTS[2]
+    hour_df = rollups.get("shelly", "hour", rollups_dir=rollups_dir)
+    assert hour_df["grid_kWh_sum"].tolist() == [6.0]
+    assert hour_df["grid_kWh_min"].tolist() == [1.0]
+    assert hour_df["grid_kWh_max"].tolist() == [3.0]
+    assert hour_df["grid_kWh_mean"].tolist() == [2.0]
+
+
+def test_revise_matches_rebuild(tmp_path):
+    rollups_dir = str(tmp_path / "rollups")
+    path = rollups.SERIES["consumption"]["paths"][0]
+    slots = pd.date_range("2024-01-31 22:00", periods=16, freq="1h", tz="UTC")
+    _save_consumption(path, slots, [1.0] * 16)
+    rollups.update_series("consumption", rollups_dir=rollups_dir)
+
+    # A later export revises a quarter-hour of the previous day, and adds one
+    kwh = [1.0] * 16 + [2.0]
+    kwh[1] = 0.0
+    end = slots[-1] + SLOTS.freq
+    _save_consumption(path, slots.append(pd.DatetimeIndex([end])), kwh)
+    rollups.revise("consumption", slots[1], rollups_dir=rollups_dir)
+    revised = {
+        level: rollups.get("consumption", level, rollups_dir=rollups_dir)
+        for level in rollups.LEVELS
+    }
+
+    rollups.rebuild("consumption", rollups_dir=rollups_dir)
+    for level in rollups.LEVELS:
+        pd.testing.assert_frame_equal(
+            revised[level], rollups.get("consumption", level, rollups_dir=rollups_dir)
+        )
+    assert revised["day"]["consumption_kwh_sum"].tolist() == [1.0, 16.0]
+    assert revised["month"]["consumption_kwh_sum"].tolist() == [1.0, 16.0]
+    assert rollups.get_watermark("consumption", rollups_dir) == end
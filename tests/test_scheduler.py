@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+
+import scheduler
+
+
+def _prices(start: str, end: str, drop: list[str] = ()) -> pd.DataFrame:
+    index = pd.date_range(start, end, freq="15min", tz="UTC", inclusive="left")
+    index = index.drop(pd.to_datetime(list(drop), utc=True))
+    return pd.DataFrame({"starting_datetime": index, "€/kWh": 0.20})
+
+
+def test_window_keeps_wall_clock_hours_across_dst():
+    index = pd.date_range("2026-03-27", "2026-10-27", freq="15min", tz="UTC")
+    overnight = scheduler.Load("dishwasher", 60, 1.0, "22:00", "07:00")
+    full_day = scheduler.Load("heater", 60, 1.0)
+
+    def hours(load, day):
+        first, last = scheduler._window(load, pd.Timestamp(day, tz="UTC"), index)
+        return (last - first) / 4
+
+    assert hours(overnight, "2026-03-28") == 8
+    assert hours(overnight, "2026-10-24") == 10
+    assert hours(overnight, "2026-10-25") == 9
+    assert hours(full_day, "2026-10-25") == 25
+
+
+def test_contiguous_run_skips_missing_slots():
+    # The two cheapest priced slots are around a missing one
+    prices_df = _prices("2026-06-01 23:00", "2026-06-03", drop=["2026-06-02 10:15"])
+    cheap = prices_df["starting_datetime"].isin(
+        pd.to_datetime(["2026-06-02 10:00", "2026-06-02 10:30"], utc=True)
+    )
+    prices_df.loc[cheap, "€/kWh"] = 0.05
+    load = scheduler.Load("washer", 30, 2.0)
+
+    (entry,) = scheduler.schedule(
+        [load],
+        day=pd.Timestamp("2026-06-02", tz="UTC"),
+        prices_df=prices_df,
+        now=pd.Timestamp("2026-06-01", tz="UTC"),
+    )
+
+    (run,) = entry["runs"]
+    assert pd.Timestamp(run["end"]) - pd.Timestamp(run["start"]) == pd.Timedelta("30min")
+    assert entry["mean_€/kWh"] == np.mean([0.05, 0.20])
+
+
+def test_today_starts_at_the_current_slot():
+    prices_df = _prices("2026-06-01 23:00", "2026-06-03")
+    morning = prices_df["starting_datetime"] < pd.Timestamp("2026-06-02 08:00", tz="UTC")
+    prices_df.loc[morning, "€/kWh"] = 0.05
+    afternoon = prices_df["starting_datetime"].between(
+        pd.Timestamp("2026-06-02 15:00", tz="UTC"),
+        pd.Timestamp("2026-06-02 15:45", tz="UTC"),
+    )
+    prices_df.loc[afternoon, "€/kWh"] = 0.10
+    load = scheduler.Load("washer", 60, 2.0)
+
+    (entry,) = scheduler.schedule(
+        [load],
+        day=pd.Timestamp("2026-06-02", tz="UTC"),
+        prices_df=prices_df,
+        now=pd.Timestamp("2026-06-02 12:05", tz="UTC"),
+    )
+
+    assert entry["runs"][0]["start"] == "2026-06-02T15:00:00+00:00"
+
+
+def test_no_run_without_enough_consecutive_slots():
+    # Local midnight is 23:00 UTC, and every hour of the window misses a slot
+    prices_df = _prices(
+        "2026-06-01 23:00",
+        "2026-06-03",
+        drop=["2026-06-01 23:45", "2026-06-02 00:45", "2026-06-02 01:45"],
+    )
+    load = scheduler.Load("washer", 60, 2.0, "00:00", "03:00")
+
+    (entry,) = scheduler.schedule(
+        [load],
+        day=pd.Timestamp("2026-06-02", tz="UTC"),
+        prices_df=prices_df,
+        now=pd.Timestamp("2026-06-01", tz="UTC"),
+    )
+
+    assert "error" in entry
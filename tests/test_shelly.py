@@ -0,0 +1,41 @@
+import os
+
+import pandas as pd
+
+import energy_meters.shelly as shelly
+import rollups
+
+
+def _write_em_data(save_path: str, minutes: int) -> None:
+    """Writes `minutes` readings of 1 Wh bought and 2 Wh produced per minute."""
+    timestamps = pd.date_range("2024-01-01", periods=minutes, freq="1min")
+    stamps = timestamps.strftime("%Y-%m-%d %H:%M")
+    os.makedirs(save_path, exist_ok=True)
+    pd.DataFrame(
+        {"Date/time UTC": stamps, "a": 1.0, "b": 0.0, "min": 230.0, "max": 231.0}
+    ).to_csv(f"{save_path}/em_data.grid.csv", index=False)
+    pd.DataFrame(
+        {"Date/time UTC": stamps, "a": 2.0, "b": 0.0, "min": 230.0, "max": 231.0}
+    ).to_csv(f"{save_path}/em_data.solar.csv", index=False)
+
+
+def test_aggregate_completes_last_slot_in_next_run(tmp_path):
+    path = str(tmp_path / "shelly_energy_history.csv")
+    save_path = str(tmp_path / "shelly")
+
+    # The readings end 10 minutes into the third quarter-hour
+    _write_em_data(save_path, 40)
+    assert shelly.aggregate_energy_history(path, save_path, chunk_rows=7) == 3
+    assert rollups.get_watermark("shelly") == pd.Timestamp("2024-01-01 00:15", tz="UTC")
+
+    _write_em_data(save_path, 60)
+    assert shelly.aggregate_energy_history(path, save_path, chunk_rows=7) == 4
+
+    history_df = shelly.get_energy_history(path=path)
+    assert history_df["grid_kWh"].tolist() == [0.015] * 4
+
+    # The completed quarter-hour was ingested once, with all its readings
+    hour_df = rollups.get("shelly", "hour")
+    assert hour_df["grid_kWh_sum"].round(6).tolist() == [0.045]
+    assert hour_df["solar_kWh_sum"].round(6).tolist() == [0.09]
+